@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Contour Next Link 2.4 codec benchmarks
+#
+#  Description:
+#
+#    Microbenchmarks of the CNL2.4 codec and decoding hot paths. The frames
+#    are built with the emulator (encrypted pump responses, Bayer envelopes,
+#    64 byte USB reports, history segments with and without LZO), so no CNL
+#    or pump is needed. The results can be saved as a JSON baseline and a
+#    later run compared against it:
+#
+#      python3 cnl24bench.py --save baseline-rpi3.json
+#      python3 cnl24bench.py --compare baseline-rpi3.json --threshold 0.2
+#
+#    The exit status is 1 if a benchmark got slower than the baseline by
+#    more than the threshold.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#
+###############################################################################
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import struct
+import sys
+import timeit
+import lzo    # pip install python-lzo
+
+from cnl24driverlib import Medtronic600SeriesDriver, MedtronicSession, MedtronicMessage, MedtronicReceiveMessage, \
+    BayerBinaryMessage, PumpStatusResponseMessage, PumpTimeResponseMessage, PumpTimeRequestMessage, \
+    PumpStatusRequestMessage, UsbReader, COM_D_COMMAND, HISTORY_DATA_TYPE
+from cnl24emulator import Cnl24Emulator
+from helpers import DateTimeHelper
+
+BASELINE_VERSION = 1
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.2 # Allowed slowdown against the baseline (0.2 = 20%)
+
+HISTORY_DAYS = 3 # Pump and sensor history of a typical catch-up read
+
+def usbReports( frame ):
+    # Splits a frame into 64 byte HID reports, the way the CNL sends it
+    reports = []
+    for i in range( 0, len( frame ), 60 ):
+        chunk = frame[i:i + 60]
+        report = bytearray( Medtronic600SeriesDriver.MAGIC_HEADER ) + bytearray( [ len( chunk ) ] ) + chunk
+        report.extend( b'\x00' * ( Medtronic600SeriesDriver.USB_BLOCKSIZE - len( report ) ) )
+        reports.append( report )
+    return reports
+
+def packets( segment, packetSize ):
+    return [ segment[i:i + packetSize] for i in range( 0, len( segment ), packetSize ) ]
+
+class Frames( object ):
+    # Synthetic frames of one live data cycle and of a history read
+
+    def __init__( self, historyDays = HISTORY_DAYS ):
+        emulator = Cnl24Emulator()
+        pump = emulator.pump
+        emulator.networkChannel = pump.channel
+
+        self.session = MedtronicSession()
+        self.session.linkMAC = emulator.linkMAC
+        self.session.pumpMAC = pump.mac
+        self.session.KEY = emulator.linkKey
+        self.session.radioChannel = pump.channel
+
+        self.encodedDateTime = pump.encodedDateTime()
+        self.timeMessage = emulator.pumpResponse( 1, COM_D_COMMAND.TIME_RESPONSE, struct.pack( '>BQ', 0x01, self.encodedDateTime ) )
+        self.statusMessage = emulator.pumpResponse( 2, COM_D_COMMAND.READ_PUMP_STATUS_RESPONSE, pump.statusPayload() )
+        self.timeFrame = emulator.bayerMessage( 0x80, self.timeMessage )
+        self.statusFrame = emulator.bayerMessage( 0x80, self.statusMessage )
+        self.timeReports = usbReports( self.timeFrame )
+        self.statusReports = usbReports( self.statusFrame )
+
+        # A request as sent by the driver and its clear payload
+        self.requestPayload = PumpStatusRequestMessage( self.session ).encode()
+        self.clearPayload = bytes( bytearray( range( 96 ) ) )
+        self.encryptedPayload = self.session.cipher.encrypt( self.clearPayload )
+        self.ccittBlock = bytes( bytearray( i & 0xff for i in range( 2048 ) ) )
+
+        # Pump history: BG readings, boluses and temp basals, sensor history: one reading every 5 minutes
+        pumpEvents = []
+        for hour in range( historyDays * 24, 0, -1 ):
+            minutesAgo = hour * 60
+            if hour % 4 == 0:
+                pumpEvents.append( pump.bgReadingEvent( minutesAgo + 5, 100 + hour % 80 ) )
+                pumpEvents.append( pump.normalBolusDeliveredEvent( minutesAgo, 1.5 + hour % 5, hour & 0xff, 0.8 ) )
+            pumpEvents.append( pump.tempBasalProgrammedEvent( minutesAgo, 0.0, 80 + hour % 40, 30 ) )
+        sensorEvents = [ pump.sensorReadingsEvent( minutesAgo, [ ( 100 + minutesAgo % 150, 25.5, 0.5 ) ] )
+                         for minutesAgo in range( historyDays * 24 * 60, 0, -5 ) ]
+
+        # The whole history as one segment, split into radio packets
+        emulator.blocksPerSegment = 1000
+        self.packetSize = emulator.packetSize
+        self.pumpSegment = emulator.historySegments( HISTORY_DATA_TYPE.PUMP_DATA, pumpEvents )[0]
+        self.sensorSegment = emulator.historySegments( HISTORY_DATA_TYPE.SENSOR_DATA, sensorEvents )[0]
+        self.headerSize = struct.calcsize( '>HBIIB' )
+        self.pumpBlocks = self.pumpSegment[self.headerSize:]
+        self.sensorBlocks = self.sensorSegment[self.headerSize:]
+
+        # The pump sends compressed segments, python-lzo produces the same format (LZO1X without header)
+        try:
+            compressed = lzo.compress( bytes( self.sensorBlocks ), 1, False )
+        except Exception as e:
+            logging.warning( 'LZO compression not available, LZO benchmarks skipped: {0}'.format( e ) )
+            self.sensorSegmentLzo = None
+        else:
+            self.sensorSegmentLzo = struct.pack( '>HBIIB', COM_D_COMMAND.UNMERGED_HISTORY_RESPONSE, HISTORY_DATA_TYPE.SENSOR_DATA,
+                                                 len( compressed ), len( self.sensorBlocks ), 1 ) + compressed
+
+def benchmarks( frames ):
+    # Returns ( name, function, bytes per call ) of all benchmarks
+    session = frames.session
+    mt = Medtronic600SeriesDriver()
+    mt.session = session
+    mt.reader = UsbReader( None, Medtronic600SeriesDriver.USB_BLOCKSIZE, Medtronic600SeriesDriver.MAGIC_HEADER )
+    message = MedtronicMessage( session = session )
+
+    def bayerEncode():
+        return BayerBinaryMessage( 0x12, session, frames.requestPayload ).encode()
+
+    def bayerDecode():
+        return BayerBinaryMessage.decode( frames.statusFrame )
+
+    def medtronicEncrypt():
+        return message.encrypt( frames.clearPayload )
+
+    def medtronicDecrypt():
+        return message.decrypt( frames.encryptedPayload )
+
+    def medtronicReceiveDecode():
+        return MedtronicReceiveMessage.decode( frames.statusMessage, session )
+
+    def ccitt():
+        return MedtronicMessage.calculateCcitt( frames.ccittBlock )
+
+    def readMessage():
+        for report in frames.statusReports:
+            mt.reader.handleReport( report )
+        return mt.readMessage( timeout_ms = 1000 )
+
+    def pumpStatus():
+        return PumpStatusResponseMessage.decode( frames.statusMessage, session ).snapshot.to_dict()
+
+    def decodeDateTime():
+        return DateTimeHelper.decodeDateTime( frames.encodedDateTime )
+
+    def liveCycle():
+        # All decoding of one live data cycle: time and status request sent, responses
+        # reassembled from the USB reports and decoded
+        responses = []
+        for request, reports, decode in [ ( PumpTimeRequestMessage, frames.timeReports, PumpTimeResponseMessage ),
+                                          ( PumpStatusRequestMessage, frames.statusReports, PumpStatusResponseMessage ) ]:
+            BayerBinaryMessage( 0x12, session, request( session ).encode() ).encode()
+            for report in reports:
+                mt.reader.handleReport( report )
+            responses.append( decode.decode( BayerBinaryMessage.decode( mt.readMessage( timeout_ms = 1000 ) ).payload, session ) )
+        return ( responses[0].datetime, responses[1].snapshot.to_dict() )
+
+    pumpPackets = packets( frames.pumpSegment, frames.packetSize )
+    sensorPackets = packets( frames.sensorSegment, frames.packetSize )
+    pumpBlocks = mt.decodePumpSegment( pumpPackets, HISTORY_DATA_TYPE.PUMP_DATA )
+
+    def decodePumpSegment():
+        return mt.decodePumpSegment( sensorPackets, HISTORY_DATA_TYPE.SENSOR_DATA )
+
+    def decodeEvents():
+        return mt.decodeEvents( pumpBlocks )
+
+    def decodeSensorHistory():
+        return mt.decodeSensorHistory( [ sensorPackets ] )
+
+    result = [
+        ( 'bayerEncode', bayerEncode, None ),
+        ( 'bayerDecode', bayerDecode, None ),
+        ( 'medtronicEncrypt', medtronicEncrypt, None ),
+        ( 'medtronicDecrypt', medtronicDecrypt, None ),
+        ( 'medtronicReceiveDecode', medtronicReceiveDecode, None ),
+        ( 'calculateCcitt', ccitt, len( frames.ccittBlock ) ),
+        ( 'readMessage', readMessage, None ),
+        ( 'pumpStatus', pumpStatus, None ),
+        ( 'decodeDateTime', decodeDateTime, None ),
+        ( 'liveCycle', liveCycle, None ),
+        ( 'decodePumpSegment', decodePumpSegment, len( frames.sensorBlocks ) ),
+        ( 'decodeEvents', decodeEvents, len( frames.pumpBlocks ) ),
+        ( 'decodeSensorHistory', decodeSensorHistory, len( frames.sensorBlocks ) ),
+    ]
+
+    if frames.sensorSegmentLzo is not None:
+        lzoPackets = packets( frames.sensorSegmentLzo, frames.packetSize )
+
+        def decodePumpSegmentLzo():
+            return mt.decodePumpSegment( lzoPackets, HISTORY_DATA_TYPE.SENSOR_DATA )
+
+        result.append( ( 'decodePumpSegmentLzo', decodePumpSegmentLzo, len( frames.sensorBlocks ) ) )
+
+    return result
+
+def measure( function, repeat ):
+    # Best and median time per call. The number of calls per run is chosen
+    # so that one run takes at least 0.2 s.
+    timer = timeit.Timer( function )
+    number, _ = timer.autorange()
+    times = sorted( t / number for t in timer.repeat( repeat, number ) )
+    return times[0], times[len( times ) // 2]
+
+def run( names = None, repeat = DEFAULT_REPEAT, historyDays = HISTORY_DAYS ):
+    frames = Frames( historyDays )
+    selected = benchmarks( frames )
+    unknown = set( names or [] ) - set( name for name, _, _ in selected )
+    if unknown:
+        raise ValueError( 'Unknown benchmarks: {0}'.format( ', '.join( sorted( unknown ) ) ) )
+
+    results = {}
+    for name, function, size in selected:
+        if names and name not in names:
+            continue
+        best, median = measure( function, repeat )
+        results[name] = { 'seconds': best, 'median': median, 'bytes': size }
+        print( formatResult( name, results[name] ) )
+        sys.stdout.flush()
+
+    return { 'version': BASELINE_VERSION,
+             'date': datetime.datetime.now().isoformat( timespec = 'seconds' ),
+             'machine': platform.machine(),
+             'processor': platform.processor(),
+             'platform': platform.platform(),
+             'python': platform.python_version(),
+             'historyDays': historyDays,
+             'results': results,
+             'derived': derived( results ) }
+
+def derived( results ):
+    # Decode cost of one live data cycle and of one MB of (uncompressed) history
+    values = {}
+    if 'liveCycle' in results:
+        values['cycleSeconds'] = results['liveCycle']['seconds']
+    for name, segment in [ ( 'historySecondsPerMB', 'decodePumpSegment' ), ( 'historyLzoSecondsPerMB', 'decodePumpSegmentLzo' ) ]:
+        if segment in results and 'decodeEvents' in results:
+            values[name] = ( results[segment]['seconds'] / results[segment]['bytes'] +
+                             results['decodeEvents']['seconds'] / results['decodeEvents']['bytes'] ) * 1000000
+    return values
+
+def formatResult( name, result ):
+    line = '{0:24} {1:12.2f} us'.format( name, result['seconds'] * 1000000 )
+    if result['bytes']:
+        line += ' {0:10.1f} MB/s'.format( result['bytes'] / result['seconds'] / 1000000 )
+    return line
+
+def compare( current, baseline, threshold ):
+    # Returns the names of the benchmarks which are slower than the baseline by more than the threshold
+    if baseline.get( 'version' ) != BASELINE_VERSION:
+        raise ValueError( 'Unsupported baseline version {0}'.format( baseline.get( 'version' ) ) )
+    if baseline.get( 'machine' ) != current['machine'] or baseline.get( 'python' ) != current['python']:
+        print( 'Note: baseline from {0} / Python {1}, this run on {2} / Python {3}'.format(
+            baseline.get( 'machine' ), baseline.get( 'python' ), current['machine'], current['python'] ) )
+
+    regressions = []
+    print( '{0:24} {1:>12} {2:>12} {3:>9}'.format( 'benchmark', 'baseline us', 'current us', 'change' ) )
+    for name, result in sorted( current['results'].items() ):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['seconds']
+        change = result['seconds'] / before - 1.0
+        flag = ''
+        if change > threshold:
+            regressions.append( name )
+            flag = ' REGRESSION'
+        print( '{0:24} {1:12.2f} {2:12.2f} {3:+8.1f}%{4}'.format( name, before * 1000000, result['seconds'] * 1000000, change * 100, flag ) )
+    for name, value in sorted( current['derived'].items() ):
+        if name in baseline.get( 'derived', {} ):
+            print( '{0:24} {1:12.6f} {2:12.6f} {3:+8.1f}%'.format( name, baseline['derived'][name], value,
+                                                                   ( value / baseline['derived'][name] - 1.0 ) * 100 ) )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser( description = 'Benchmarks of the CNL2.4 codec and decoding hot paths' )
+    parser.add_argument( 'names', nargs = '*', help = 'run only these benchmarks' )
+    parser.add_argument( '--save', metavar = 'FILE', help = 'save the results as JSON baseline' )
+    parser.add_argument( '--compare', metavar = 'FILE', help = 'compare the results with a JSON baseline' )
+    parser.add_argument( '--threshold', type = float, default = DEFAULT_THRESHOLD,
+                         help = 'allowed slowdown against the baseline (default {0})'.format( DEFAULT_THRESHOLD ) )
+    parser.add_argument( '--repeat', type = int, default = DEFAULT_REPEAT,
+                         help = 'runs per benchmark, the fastest one counts (default {0})'.format( DEFAULT_REPEAT ) )
+    parser.add_argument( '--days', type = int, default = HISTORY_DAYS,
+                         help = 'days of synthetic history (default {0})'.format( HISTORY_DAYS ) )
+    args = parser.parse_args()
+
+    logging.basicConfig( level = logging.WARNING )
+
+    current = run( args.names, args.repeat, args.days )
+    for name, value in sorted( current['derived'].items() ):
+        print( '{0:24} {1:12.6f} s'.format( name, value ) )
+
+    if args.save:
+        with open( args.save, 'w' ) as f:
+            json.dump( current, f, indent = 2, sort_keys = True )
+
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline = json.load( f )
+        regressions = compare( current, baseline, args.threshold )
+        if regressions:
+            print( 'Slower than the baseline by more than {0:.0f}%: {1}'.format( args.threshold * 100, ', '.join( regressions ) ) )
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
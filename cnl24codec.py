@@ -0,0 +1,188 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 message codec
+#
+#  Description:
+#
+#    Low level encoding and decoding of the CNL2.4 messages, used by the
+#    CNL2.4 driver library. All binary layouts are precompiled struct.Struct
+#    objects, received frames are parsed in place via memoryview and
+#    unpack_from, and the AES cipher of a session is set up only once.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#    17/10/2026: History segment assembly and block verification
+#    17/10/2026: Layouts of the pump settings responses
+#
+###############################################################################
+
+import binascii
+import struct
+import Crypto.Cipher.AES # pip install PyCrypto
+
+UINT8     = struct.Struct( '>B' )
+UINT16_LE = struct.Struct( '<H' )
+UINT16_BE = struct.Struct( '>H' )
+UINT32_BE = struct.Struct( '>I' )
+INT32_BE  = struct.Struct( '>i' )
+UINT64_LE = struct.Struct( '<Q' )
+UINT64_BE = struct.Struct( '>Q' )
+
+# Bayer envelope: 0x51, 3, serial, padding, operation, sequence, padding, payload size,
+# followed by a one byte checksum
+BAYER_ENVELOPE    = struct.Struct( '<BB6s10sBI5sI' )
+BAYER_HEADER_SIZE = BAYER_ENVELOPE.size + 1
+BAYER_OPERATION   = 0x12 # Offset of the link device operation
+BAYER_CHECKSUM    = BAYER_ENVELOPE.size
+
+# Medtronic message: command, size, payload, CCITT checksum
+MEDTRONIC_ENVELOPE = struct.Struct( '<BB' )
+MEDTRONIC_CRC      = UINT16_LE
+
+# Transmit packet payload: pump MAC, minimed sequence, mode flags, size, encrypted data
+SEND_HEADER = struct.Struct( '<QBBB' )
+# Encrypted data: sequence, message type, body, CCITT checksum (big endian)
+SEND_DATA_HEADER = struct.Struct( '>BH' )
+SEND_DATA_CRC    = UINT16_BE
+
+RESPONSE_ENVELOPE_SIZE = 22
+
+# Multipacket segment fields in the decrypted response payload
+PACKET_NUMBER      = UINT16_BE
+SEGMENT_PARAMETERS = struct.Struct( '>IHHH' ) # segment size, packet size, last packet size, packets to fetch
+
+# Pump status response fields from offset 0x03 to 0x58, see PumpStatusSnapshot
+PUMP_STATUS = struct.Struct( '>BI4xHBxIIBxBIIBHIBIBBIHQBBBxHBhBHHQBH' )
+PUMP_STATUS_OFFSET = 0x03
+
+# History segment header: message type, data type, compressed size, uncompressed size, compressed flag
+HISTORY_SEGMENT_HEADER = struct.Struct( '>HBIIB' )
+HISTORY_BLOCK_SIZE     = 2048
+HISTORY_BLOCK_TRAILER  = struct.Struct( '>HH' ) # used size, CCITT checksum of the used part
+
+# Pump settings responses: counted lists of schedule items from offset 0x03
+# (after the pattern number for basal patterns), each item ends with its start
+# time in 30 minute steps. Layouts as decoded by the 600SeriesAndroidUploader.
+SETTINGS_OFFSET        = 0x03
+BASAL_RATE_ITEM        = struct.Struct( '>IB' )    # rate (U/h * 10000), start
+CARB_RATIO_ITEM        = struct.Struct( '>IIB' )   # g/U * 10, U/exchange * 1000, start
+SENSITIVITY_ITEM       = struct.Struct( '>HHB' )   # mg/dL per U, mmol/L per U * 10, start
+BG_TARGET_ITEM         = struct.Struct( '>HHHHB' ) # high mg/dL, high mmol/L * 10, low mg/dL, low mmol/L * 10, start
+DEVICE_CHARACTERISTICS = struct.Struct( '>10sQ' )  # pump serial, pump MAC
+SCHEDULE_STEP_MINUTES  = 30
+
+ZERO_PADDING = [ bytes( bytearray( n ) ) for n in range( 16 ) ]
+
+def ccitt( data, crc = 0xffff ):
+    # CRC-16/XMODEM with initial value 0xffff, works on any buffer
+    return binascii.crc_hqx( data, crc )
+
+def bayerChecksum( envelope, payload = None ):
+    checksum = sum( envelope )
+    if payload:
+        checksum += sum( payload )
+    return checksum & 0xff
+
+def encodeBayerEnvelope( operation, sequence, payloadSize ):
+    return BAYER_ENVELOPE.pack( 0x51, 3, b'000000', b'\x00' * 10,
+                                operation, sequence, b'\x00' * 5, payloadSize )
+
+def splitBayerMessage( message ):
+    # Returns envelope and payload as views of the received message, after
+    # checking the checksum. Raises ValueError with checksums on mismatch.
+    view = memoryview( message )
+    checksum = view[BAYER_CHECKSUM]
+    calcChecksum = ( sum( view ) - checksum ) & 0xff
+    if checksum != calcChecksum:
+        raise ValueError( calcChecksum, checksum )
+    return view[0:BAYER_HEADER_SIZE], view[BAYER_HEADER_SIZE:]
+
+def splitMedtronicMessage( message ):
+    # Returns envelope and payload as views of the message, after checking
+    # the checksum. Raises ValueError with checksums on mismatch.
+    view = memoryview( message )
+    end = len( view ) - MEDTRONIC_CRC.size
+    checksum = MEDTRONIC_CRC.unpack_from( view, end )[0]
+    calcChecksum = ccitt( view[0:end] )
+    if checksum != calcChecksum:
+        raise ValueError( calcChecksum, checksum )
+    return view[0:MEDTRONIC_ENVELOPE.size], view[MEDTRONIC_ENVELOPE.size:end]
+
+def encodeMedtronicMessage( commandAction, payload ):
+    message = MEDTRONIC_ENVELOPE.pack( commandAction, len( payload ) + MEDTRONIC_ENVELOPE.size ) + payload
+    return message + MEDTRONIC_CRC.pack( ccitt( message ) )
+
+class CipherContext( object ):
+    # AES-CFB with 128 bit segments, equivalent to Java's AES/CFB/NoPadding mode.
+    # One context is kept per session key and radio channel (the IV).
+
+    __slots__ = ( 'key', 'iv', 'ecb' )
+
+    def __init__( self, key, iv ):
+        self.key = bytes( key )
+        self.iv = bytes( iv )
+        self.ecb = Crypto.Cipher.AES.new( self.key, Crypto.Cipher.AES.MODE_ECB )
+
+    def encrypt( self, clear ):
+        # Each cipher block depends on the previous one, so the library does the chaining
+        cipher = Crypto.Cipher.AES.new( self.key, Crypto.Cipher.AES.MODE_CFB, self.iv, segment_size = 128 )
+        size = len( clear )
+        return cipher.encrypt( bytes( clear ) + ZERO_PADDING[-size % 16] )[0:size]
+
+    def decrypt( self, encrypted ):
+        # The key stream of a received message only depends on the IV and the
+        # cipher blocks, so it is computed with a single ECB call
+        size = len( encrypted )
+        if size == 0:
+            return b''
+        blocks = ( size + 15 ) // 16 * 16
+        keyStream = self.ecb.encrypt( b''.join( ( self.iv, encrypted[0:blocks - 16] ) ) )
+        clear = int.from_bytes( encrypted, 'big' ) ^ int.from_bytes( keyStream[0:size], 'big' )
+        return clear.to_bytes( size, 'big' )
+
+def decodeScheduleItems( payload, offset, item ):
+    # Unpacks the list of schedule items whose count is at offset
+    count = payload[offset]
+    if offset + 1 + count * item.size > len( payload ):
+        raise ValueError( 'Schedule of {0} items exceeds the payload'.format( count ) )
+    return [ item.unpack_from( payload, offset + 1 + i * item.size ) for i in range( count ) ]
+
+def joinPackets( packets ):
+    # Copies the packets of a multipacket segment into one preallocated buffer
+    buffer = bytearray( sum( len( packet ) for packet in packets ) )
+    view = memoryview( buffer )
+    pos = 0
+    for packet in packets:
+        view[pos:pos + len( packet )] = packet
+        pos += len( packet )
+    return buffer
+
+def historyBlockTrailer( blocks, index ):
+    # Used size and checksum of a history block
+    return HISTORY_BLOCK_TRAILER.unpack_from( blocks, ( index + 1 ) * HISTORY_BLOCK_SIZE - HISTORY_BLOCK_TRAILER.size )
+
+def verifyHistoryBlocks( blocks ):
+    # Checks the checksums of all history blocks at once and returns the
+    # numbers of the broken blocks
+    view = memoryview( blocks )
+    broken = []
+    for index in range( len( view ) // HISTORY_BLOCK_SIZE ):
+        blockSize, checksum = historyBlockTrailer( view, index )
+        start = index * HISTORY_BLOCK_SIZE
+        if blockSize > HISTORY_BLOCK_SIZE - HISTORY_BLOCK_TRAILER.size or ccitt( view[start:start + blockSize] ) != checksum:
+            broken.append( index )
+    return broken
+
+def iterHistoryBlocks( blocks, verify = True ):
+    # Yields the used part of each history block as view, after checking its
+    # checksum. Raises ValueError with block number and checksums on mismatch.
+    view = memoryview( blocks )
+    for index in range( len( view ) // HISTORY_BLOCK_SIZE ):
+        blockSize, checksum = historyBlockTrailer( view, index )
+        start = index * HISTORY_BLOCK_SIZE
+        block = view[start:start + min( blockSize, HISTORY_BLOCK_SIZE - HISTORY_BLOCK_TRAILER.size )]
+        if verify:
+            calcChecksum = ccitt( block )
+            if calcChecksum != checksum:
+                raise ValueError( index, calcChecksum, checksum )
+        yield block
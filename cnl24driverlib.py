@@ -16,6 +16,27 @@
 #    13/04/2020: Return complete pump status data in statusDownload()
 #    28/06/2020: Updated syntax for Python3
 #    09/11/2020: Add calculation of pump time drift
+#    17/10/2026: Add persistent session mode which survives across upload cycles
+#    17/10/2026: Cache handshake credentials and sequence numbers in config database
+#    17/10/2026: Rank radio channels by observed success rate, latency and RSSI
+#    17/10/2026: Allow to replace the HID device, e.g. by the CNL emulator
+#    17/10/2026: Read USB reports in a background thread, add read deadlines and cancellation
+#    17/10/2026: Clear the message stream only when needed, drop duplicated pump responses
+#    17/10/2026: Move message encoding, decoding and encryption to cnl24codec
+#    17/10/2026: Decode the pump status only once into a PumpStatusSnapshot
+#    17/10/2026: Derive read timeouts from the observed latency of each protocol phase
+#    17/10/2026: Retry failed pump requests within the open session
+#    17/10/2026: Resend lost history packets, resume interrupted history transfers
+#    17/10/2026: Decode history events with the streaming decoder in cnl24history
+#    17/10/2026: Assemble history segments without copies, yield the verified blocks
+#    17/10/2026: Download the pump history since the last sync
+#    17/10/2026: Limit the history sync to a time window, add the pump serial to the live data
+#    17/10/2026: Decode the sensor history into columns
+#    17/10/2026: Convert pump times with the cached UTC offset table in cnl24time
+#    17/10/2026: Select the CNL by USB serial number or path, keep the session state per instance
+#    17/10/2026: Trace the handshake stages, pump requests and USB reads and writes with cnl24trace
+#    17/10/2026: Count cleared messages, keep session statistics for monitoring
+#    17/10/2026: Read the pump settings, cache them per pump with a content hash
 #  
 ###############################################################################
 
@@ -24,16 +45,25 @@ import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s [%(name)s] %(message)s', level=logging.WARNING)
 import hid    # pip install hidapi - Platform independant
 import astm   # pip install astm
-import crc16  # pip install crc16
 import lzo    # pip install python-lzo
-import Crypto.Cipher.AES # pip install PyCrypto
 import struct
 import datetime
 import binascii
 import sqlite3
 import hashlib
+import json
+import time
 import re
+import threading
+import collections
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from helpers import DateTimeHelper
+import cnl24codec
+import cnl24history
+import cnl24trace
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +123,21 @@ class HISTORY_DATA_TYPE:
     PUMP_DATA = 0x02
     SENSOR_DATA = 0x03
 
+class PROTOCOL_PHASE:
+    DEVICE_INFO = 'deviceInfo'
+    CONTROL = 'control'
+    PASSTHROUGH = 'passthrough'
+    CONNECTION = 'connection'
+    LINK_INFO = 'linkInfo'
+    NEGOTIATE = 'negotiate'
+    EHSM = 'ehsm'
+    TIME = 'time'
+    STATUS = 'status'
+    HISTORY = 'history'
+    PACKET = 'packet' # Wait for the next packet of a multipacket segment
+    REQUEST = 'request'
+    CONTINUATION = 'continuation' # Wait for the next USB report of a message
+
 class TimeoutException( Exception ):
     pass
 
@@ -102,12 +147,24 @@ class ChecksumException( Exception ):
 class UnexpectedMessageException( Exception ):
     pass
 
+class NoPumpResponseException( UnexpectedMessageException ):
+    pass
+
+class ConnectionLostException( UnexpectedMessageException ):
+    pass
+
 class UnexpectedStateException( Exception ):
     pass
 
 class NegotiationException( Exception ):
     pass
 
+class CredentialsRejectedException( ChecksumException ):
+    pass
+
+class CancelledException( Exception ):
+    pass
+
 class InvalidMessageError( Exception ):
     pass
 
@@ -118,63 +175,257 @@ class DataIncompleteError( Exception ):
     pass
 
 class Config( object ):
+    # Columns added after the first release are created on demand,
+    # so that existing databases keep working
+    EXTRA_COLUMNS = [ ( 'link_mac',    'TEXT' ),
+                      ( 'pump_mac',    'TEXT' ),
+                      ( 'bayer_seq',   'INTEGER' ),
+                      ( 'minimed_seq', 'INTEGER' ),
+                      ( 'send_seq',    'INTEGER' ),
+                      ( 'credential_failures', 'INTEGER' ) ]
+
     def __init__( self, stickSerial ):
-        self.conn = sqlite3.connect( 'read_minimed.db' )
+        # A PersistentSession may be used from a different thread in each cycle,
+        # e.g. a timer thread, and writes the sequence numbers after each of them
+        self.conn = sqlite3.connect( 'read_minimed.db', check_same_thread = False )
+        self.lock = threading.RLock()
+        self.conn.row_factory = sqlite3.Row
         self.c = self.conn.cursor()
         self.c.execute( '''CREATE TABLE IF NOT EXISTS
             config ( stick_serial TEXT PRIMARY KEY, hmac TEXT, key TEXT, last_radio_channel INTEGER )''' )
-        self.c.execute( "INSERT OR IGNORE INTO config VALUES ( ?, ?, ?, ? )", ( stickSerial, '', '', 0x14 ) )
+        self.c.execute( 'PRAGMA table_info( config )' )
+        existingColumns = [ row[1] for row in self.c.fetchall() ]
+        for name, columnType in self.EXTRA_COLUMNS:
+            if name not in existingColumns:
+                self.c.execute( 'ALTER TABLE config ADD COLUMN {0} {1}'.format( name, columnType ) )
+        self.c.execute( "INSERT OR IGNORE INTO config ( stick_serial, hmac, key, last_radio_channel ) VALUES ( ?, ?, ?, ? )", ( stickSerial, '', '', 0x14 ) )
+        self.c.execute( '''CREATE TABLE IF NOT EXISTS
+            channel_stats ( stick_serial TEXT, channel INTEGER, attempts REAL, successes REAL,
+                            success_ms REAL, failure_ms REAL, rssi INTEGER, PRIMARY KEY ( stick_serial, channel ) )''' )
         self.conn.commit()
 
         self.loadConfig( stickSerial )
 
     def loadConfig( self, stickSerial ):
-        self.c.execute( 'SELECT * FROM config WHERE stick_serial = ?', ( stickSerial, ) )
-        self.data = self.c.fetchone()
+        with self.lock:
+            self.c.execute( 'SELECT * FROM config WHERE stick_serial = ?', ( stickSerial, ) )
+            self.data = self.c.fetchone()
+
+    def update( self, **values ):
+        assignments = ', '.join( '{0} = ?'.format( name ) for name in values )
+        with self.lock:
+            self.c.execute( 'UPDATE config SET {0} WHERE stick_serial = ?'.format( assignments ), tuple( values.values() ) + ( self.stickSerial, ) )
+            self.conn.commit()
+            self.loadConfig( self.stickSerial )
 
     @property
     def stickSerial( self ):
-        return self.data[0]
+        return self.data['stick_serial']
 
     @property
     def lastRadioChannel( self ):
-        return self.data[3]
+        return self.data['last_radio_channel']
 
     @lastRadioChannel.setter
     def lastRadioChannel( self, value ):
-        self.c.execute( "UPDATE config SET last_radio_channel = ? WHERE stick_serial = ?", ( value, self.stickSerial ) )
-        self.conn.commit()
-        self.loadConfig( self.stickSerial )
+        self.update( last_radio_channel = value )
 
     @property
     def hmac( self ):
-        return self.data[1]
+        return self.data['hmac']
 
     @hmac.setter
     def hmac( self, value ):
-        self.c.execute( "UPDATE config SET hmac = ? WHERE stick_serial = ?", ( value, self.stickSerial ) )
-        self.conn.commit()
-        self.loadConfig( self.stickSerial )
+        self.update( hmac = value )
 
     @property
     def key( self ):
-        return self.data[2]
+        return self.data['key']
 
     @key.setter
     def key( self, value ):
-        self.c.execute( "UPDATE config SET key = ? WHERE stick_serial = ?", ( value, self.stickSerial ) )
+        self.update( key = value )
+
+    @property
+    def linkMAC( self ):
+        return int( self.data['link_mac'], 16 ) if self.data['link_mac'] else None
+
+    @property
+    def pumpMAC( self ):
+        return int( self.data['pump_mac'], 16 ) if self.data['pump_mac'] else None
+
+    def storeInfo( self, linkMAC, pumpMAC ):
+        self.update( link_mac = '{0:016x}'.format( linkMAC ), pump_mac = '{0:016x}'.format( pumpMAC ) )
+
+    @property
+    def credentialFailures( self ):
+        # Pump messages in a row which could not be decrypted with the cached credentials
+        return self.data['credential_failures'] or 0
+
+    @credentialFailures.setter
+    def credentialFailures( self, value ):
+        self.update( credential_failures = value )
+
+    def clearCredentials( self ):
+        self.update( link_mac = None, pump_mac = None, key = '', credential_failures = 0 )
+
+    def channelStats( self ):
+        # channel: ( attempts, successes, total success ms, total failure ms, last RSSI )
+        with self.lock:
+            self.c.execute( 'SELECT channel, attempts, successes, success_ms, failure_ms, rssi FROM channel_stats WHERE stick_serial = ?', ( self.stickSerial, ) )
+            return dict( ( row[0], tuple( row[1:] ) ) for row in self.c.fetchall() )
+
+    def recordChannelResults( self, results, decay ):
+        # results: list of ( channel, success, latency ms, RSSI )
+        # Older statistics are decayed first, so that the ranking follows the pump
+        # when it is moved to a place with different radio conditions
+        if not results:
+            return
+        with self.lock:
+            self.c.execute( 'UPDATE channel_stats SET attempts = attempts * ?, successes = successes * ?, success_ms = success_ms * ?, failure_ms = failure_ms * ? WHERE stick_serial = ?',
+                            ( decay, decay, decay, decay, self.stickSerial ) )
+            for channel, success, latency, rssi in results:
+                self.c.execute( 'INSERT OR IGNORE INTO channel_stats VALUES ( ?, ?, 0, 0, 0, 0, NULL )', ( self.stickSerial, channel ) )
+                if success:
+                    self.c.execute( 'UPDATE channel_stats SET attempts = attempts + 1, successes = successes + 1, success_ms = success_ms + ?, rssi = ? WHERE stick_serial = ? AND channel = ?',
+                                    ( latency, rssi, self.stickSerial, channel ) )
+                else:
+                    self.c.execute( 'UPDATE channel_stats SET attempts = attempts + 1, failure_ms = failure_ms + ? WHERE stick_serial = ? AND channel = ?',
+                                    ( latency, self.stickSerial, channel ) )
+            self.conn.commit()
+
+    @property
+    def sequenceNumbers( self ):
+        if self.data['bayer_seq'] is None:
+            return None
+        return ( self.data['bayer_seq'], self.data['minimed_seq'], self.data['send_seq'] )
+
+    @sequenceNumbers.setter
+    def sequenceNumbers( self, value ):
+        self.update( bayer_seq = value[0], minimed_seq = value[1], send_seq = value[2] )
+
+class HistorySyncState( object ):
+    # Time of the newest history event which was uploaded, per pump serial and
+    # history data type. Kept in the same database as the CNL configuration.
+
+    def __init__( self, database = 'read_minimed.db' ):
+        self.database = database
+        self.conn = sqlite3.connect( database, check_same_thread = False )
+        self.c = self.conn.cursor()
+        self.c.execute( '''CREATE TABLE IF NOT EXISTS
+            history_sync ( pump_serial TEXT, data_type INTEGER, last_sync REAL, PRIMARY KEY ( pump_serial, data_type ) )''' )
+        self.conn.commit()
+
+    def lastSync( self, pumpSerial, historyType ):
+        # Returns the time as seconds since the epoch, None if never synced
+        self.c.execute( 'SELECT last_sync FROM history_sync WHERE pump_serial = ? AND data_type = ?', ( pumpSerial, historyType ) )
+        row = self.c.fetchone()
+        return row[0] if row else None
+
+    def store( self, pumpSerial, historyType, lastSync ):
+        self.c.execute( 'INSERT OR REPLACE INTO history_sync VALUES ( ?, ?, ? )', ( pumpSerial, historyType, lastSync ) )
+        self.conn.commit()
+
+class PumpSettingsCache( object ):
+    # Pump settings (settingsDownload()) per pump serial, with a hash of their
+    # content. They are read again only if they are older than REFRESH_INTERVAL,
+    # so the radio reads happen a few times a day. A switch of the active basal
+    # pattern in the pump status only updates the cached entry, all patterns are
+    # in the settings already. Kept in the same database as the CNL configuration.
+    REFRESH_INTERVAL = 6 * 3600
+    RETRY_INTERVAL   = 30 * 60 # After a failed read
+
+    def __init__( self, database = 'read_minimed.db' ):
+        self.database = database
+        self.conn = sqlite3.connect( database, check_same_thread = False )
+        self.c = self.conn.cursor()
+        self.c.execute( '''CREATE TABLE IF NOT EXISTS
+            pump_settings ( pump_serial TEXT PRIMARY KEY, hash TEXT, settings TEXT, read_at REAL, active_basal_pattern INTEGER )''' )
         self.conn.commit()
-        self.loadConfig( self.stickSerial )
+
+        # The uploaders read the settings from memory
+        self.entries = {}
+        self.c.execute( 'SELECT pump_serial, hash, settings, read_at, active_basal_pattern FROM pump_settings' )
+        for pumpSerial, contentHash, settings, readAt, activeBasalPattern in self.c.fetchall():
+            self.entries[pumpSerial] = { 'hash': contentHash, 'settings': json.loads( settings ), 'readAt': readAt,
+                                         'changedAt': readAt, 'activeBasalPattern': activeBasalPattern }
+        self.failedAt = {}
+
+    @staticmethod
+    def contentHash( settings ):
+        return hashlib.sha256( json.dumps( settings, sort_keys = True ).encode( 'utf-8' ) ).hexdigest()
+
+    @staticmethod
+    def version( entry ):
+        # The uploaded profile depends on the settings and the active basal pattern
+        return ( entry['hash'], entry['activeBasalPattern'] )
+
+    def get( self, pumpSerial ):
+        # Returns { 'hash', 'settings', 'readAt', 'changedAt', 'activeBasalPattern' }, None if never read
+        return self.entries.get( pumpSerial )
+
+    def needsRefresh( self, pumpSerial ):
+        now = time.time()
+        if now - self.failedAt.get( pumpSerial, 0 ) < self.RETRY_INTERVAL:
+            return False
+        entry = self.entries.get( pumpSerial )
+        return entry is None or now - entry['readAt'] > self.REFRESH_INTERVAL
+
+    def failed( self, pumpSerial ):
+        self.failedAt[pumpSerial] = time.time()
+
+    def setActiveBasalPattern( self, pumpSerial, activeBasalPattern ):
+        # Returns True if the version changed, i.e. the pump switched to another
+        # basal pattern since the settings were read
+        entry = self.entries.get( pumpSerial )
+        if entry is None or entry['activeBasalPattern'] == activeBasalPattern:
+            return False
+        # A new entry, the previous one may still be used by an uploader
+        self.entries[pumpSerial] = dict( entry, activeBasalPattern = activeBasalPattern, changedAt = time.time() )
+        self.c.execute( 'UPDATE pump_settings SET active_basal_pattern = ? WHERE pump_serial = ?',
+                        ( activeBasalPattern, pumpSerial ) )
+        self.conn.commit()
+        return True
+
+    def store( self, pumpSerial, settings, activeBasalPattern ):
+        # Returns True if the version (content or active basal pattern) changed
+        now = time.time()
+        entry = { 'hash': self.contentHash( settings ), 'settings': settings,
+                  'readAt': now, 'changedAt': now, 'activeBasalPattern': activeBasalPattern }
+        previous = self.entries.get( pumpSerial )
+        if previous is not None and self.version( previous ) == self.version( entry ):
+            entry['changedAt'] = previous['changedAt']
+        self.entries[pumpSerial] = entry
+        self.failedAt.pop( pumpSerial, None )
+        self.c.execute( 'INSERT OR REPLACE INTO pump_settings VALUES ( ?, ?, ?, ?, ? )',
+                        ( pumpSerial, entry['hash'], json.dumps( settings, sort_keys = True ), entry['readAt'], activeBasalPattern ) )
+        self.conn.commit()
+        return previous is None or self.version( previous ) != self.version( entry )
 
 class MedtronicSession( object ):
-    radioChannel = None
-    bayerSequenceNumber = 1
-    minimedSequenceNumber = 1
-    sendSequenceNumber = 0
+    def __init__( self ):
+        # All state is kept per instance, so that several CNL sticks can be
+        # used at the same time
+        self.radioChannel = None
+        self.bayerSequenceNumber = 1
+        self.minimedSequenceNumber = 1
+        self.sendSequenceNumber = 0
+
+        # Set when the MACs and link key were taken from the config database instead
+        # of the CNL. They are trusted once a pump message was decrypted with them.
+        self.credentialsFromCache = False
+        self.credentialsVerified = False
+
+        self._cipher = None
+        self._cipherParameters = None
 
     @property
     def HMAC( self ):
-        serial = bytearray( re.sub( r"\d+-", "", self.stickSerial ), 'ascii' ) 
+        return self._hmac
+
+    @staticmethod
+    def calculateHMAC( stickSerial ):
+        serial = bytearray( re.sub( r"\d+-", "", stickSerial ), 'ascii' ) 
         paddingKey = b"A4BD6CED9A42602564F413123"
         digest = hashlib.sha256(serial + paddingKey).hexdigest()
         return "".join(reversed([digest[i:i+2] for i in range(0, len(digest), 2)]))
@@ -195,6 +446,25 @@ class MedtronicSession( object ):
         self.config = Config( self.stickSerial )
         self.radioChannel = self.config.lastRadioChannel
 
+        # The HMAC only depends on the stick serial, so it is computed once per session
+        self._hmac = self.calculateHMAC( self.stickSerial )
+        if self.config.hmac != self._hmac:
+            self.config.hmac = self._hmac
+
+        if self.config.sequenceNumbers:
+            self.bayerSequenceNumber, self.minimedSequenceNumber, self.sendSequenceNumber = self.config.sequenceNumbers
+
+    def saveSequenceNumbers( self ):
+        self.config.sequenceNumbers = ( self.bayerSequenceNumber, self.minimedSequenceNumber, self.sendSequenceNumber )
+
+    def nextMinimedSequenceNumber( self ):
+        # Sent as a single byte, 0 is never used
+        self.minimedSequenceNumber = self.minimedSequenceNumber % 0xFF + 1
+
+    def nextSendSequenceNumber( self ):
+        # Sent as 7 bits, the high bit flags the high speed mode command
+        self.sendSequenceNumber = ( self.sendSequenceNumber + 1 ) & 0x7F
+
     @property
     def linkMAC( self ):
         return self._linkMAC
@@ -229,10 +499,17 @@ class MedtronicSession( object ):
 
     @property
     def IV( self ):
-        tmp = bytearray()
-        tmp.append(self.radioChannel)
-        tmp += self.KEY[1:]
-        return bytes(tmp)
+        return self.cipher.iv
+
+    @property
+    def cipher( self ):
+        # The cipher context only changes with the key and the radio channel
+        if self._cipher is None or self._cipherParameters != ( self._key, self.radioChannel ):
+            iv = bytearray( self._key )
+            iv[0] = self.radioChannel
+            self._cipher = cnl24codec.CipherContext( self._key, iv )
+            self._cipherParameters = ( self._key, self.radioChannel )
+        return self._cipher
 
 class MedtronicMessage( object ):
     ENVELOPE_SIZE = 2
@@ -245,60 +522,37 @@ class MedtronicMessage( object ):
 
     def setPayload( self, payload ):
         self.payload = payload
-        self.envelope = struct.pack( '<BB', self.commandAction,
+        self.envelope = cnl24codec.MEDTRONIC_ENVELOPE.pack( self.commandAction,
             len( self.payload ) + self.ENVELOPE_SIZE )
 
     @classmethod
     def calculateCcitt( self, data ):
-        crc = crc16.crc16xmodem( bytes(data), 0xffff )
-        return crc & 0xffff
-
-    def pad( self, x, n = 16 ):
-        p = n - ( len( x ) % n )
-        return x + bytes(bytearray(p))#chr(p) * p
+        return cnl24codec.ccitt( data )
 
     # Encrpytion equivalent to Java's AES/CFB/NoPadding mode
     def encrypt( self, clear ):
-        cipher = Crypto.Cipher.AES.new(
-            key=self.session.KEY,
-            mode=Crypto.Cipher.AES.MODE_CFB,
-            IV=self.session.IV,
-            segment_size=128
-        )
-
-        encrypted = cipher.encrypt(self.pad(clear))[0:len(clear)]
-        return encrypted
+        return self.session.cipher.encrypt( clear )
 
     # Decryption equivalent to Java's AES/CFB/NoPadding mode
     def decrypt( self, encrypted ):
-        cipher = Crypto.Cipher.AES.new(
-            key=self.session.KEY,
-            mode=Crypto.Cipher.AES.MODE_CFB,
-            IV=self.session.IV,
-            segment_size=128
-        )
-
-        decrypted = cipher.decrypt(self.pad(encrypted))[0:len(encrypted)]
-        return decrypted
+        return self.session.cipher.decrypt( encrypted )
 
     def encode( self ):
         # Increment the Minimed Sequence Number
-        self.session.minimedSequenceNumber += 1
+        self.session.nextMinimedSequenceNumber()
         message = self.envelope + self.payload
-        crc = struct.pack( '<H', crc16.crc16xmodem( message, 0xffff ) & 0xffff )
-        return message + crc
+        return message + cnl24codec.MEDTRONIC_CRC.pack( cnl24codec.ccitt( message ) )
 
     @classmethod
     def decode( cls, message, session ):
         response = cls()
         response.session = session
-        response.envelope = message[0:2]
-        response.payload = message[2:-2]
         response.originalMessage = message
-
-        checksum = struct.unpack( '<H', message[-2:] )[0]
-        calcChecksum = MedtronicMessage.calculateCcitt( response.envelope + response.payload )
-        if( checksum != calcChecksum ):
+        # envelope and payload are views of the original message
+        try:
+            response.envelope, response.payload = cnl24codec.splitMedtronicMessage( message )
+        except ValueError as e:
+            calcChecksum, checksum = e.args
             raise ChecksumException( 'Expected to get {0}. Got {1}'.format( calcChecksum, checksum ) )
 
         return response
@@ -326,15 +580,14 @@ class MedtronicSendMessage( MedtronicMessage ):
         else:
             seqNo = self.session.sendSequenceNumber
 
-        encryptedPayload = struct.pack( '>BH', seqNo, messageType )
+        encryptedPayload = cnl24codec.SEND_DATA_HEADER.pack( seqNo, messageType )
         if payload:
             encryptedPayload += payload
-        crc = crc16.crc16xmodem( encryptedPayload, 0xffff )
-        encryptedPayload += struct.pack( '>H', crc & 0xffff )
+        encryptedPayload += cnl24codec.SEND_DATA_CRC.pack( cnl24codec.ccitt( encryptedPayload ) )
         #logger.debug("### PAYLOAD")
         #logger.debug(binascii.hexlify( encryptedPayload ))
 
-        mmPayload = struct.pack( '<QBBB',
+        mmPayload = cnl24codec.SEND_HEADER.pack(
             self.session.pumpMAC,
             self.session.minimedSequenceNumber,
             0x11, # Mode flags
@@ -343,7 +596,7 @@ class MedtronicSendMessage( MedtronicMessage ):
         mmPayload += self.encrypt( encryptedPayload )
 
         self.setPayload( mmPayload )
-        self.session.sendSequenceNumber += 1
+        self.session.nextSendSequenceNumber()
 
 class MedtronicReceiveMessage( MedtronicMessage ):
     @classmethod
@@ -351,8 +604,9 @@ class MedtronicReceiveMessage( MedtronicMessage ):
         response = MedtronicMessage.decode( message, session )
 
         # TODO - check validity of the envelope
-        response.responseEnvelope = response.payload[0:22]
-        decryptedResponsePayload = response.decrypt( bytes(response.payload[22:]) )
+        size = cnl24codec.RESPONSE_ENVELOPE_SIZE
+        response.responseEnvelope = response.payload[0:size]
+        decryptedResponsePayload = response.decrypt( response.payload[size:] )
 
         response.responsePayload = decryptedResponsePayload[0:-2]
 
@@ -360,8 +614,8 @@ class MedtronicReceiveMessage( MedtronicMessage ):
         #logger.debug(binascii.hexlify( response.responsePayload ))
 
         if len( response.responsePayload ) > 2:
-            checksum = struct.unpack( '>H', decryptedResponsePayload[-2:])[0]
-            calcChecksum = MedtronicMessage.calculateCcitt( response.responsePayload )
+            checksum = cnl24codec.SEND_DATA_CRC.unpack_from( decryptedResponsePayload, len( decryptedResponsePayload ) - 2 )[0]
+            calcChecksum = cnl24codec.ccitt( memoryview( decryptedResponsePayload )[0:-2] )
             if( checksum != calcChecksum ):
                 raise ChecksumException( 'Expected to get {0}. Got {1}'.format( calcChecksum, checksum ) )
 
@@ -379,12 +633,22 @@ class MedtronicReceiveMessage( MedtronicMessage ):
             response.__class__ = MultiPacketSegment
         elif response.messageType == COM_D_COMMAND.END_HISTORY_TRANSMISSION:
             response.__class__ = MultiPacketSegment
+        elif response.messageType == COM_D_COMMAND.READ_BASAL_PATTERN_RESPONSE:
+            response.__class__ = PumpBasalPatternResponseMessage
+        elif response.messageType == COM_D_COMMAND.READ_BOLUS_WIZARD_CARB_RATIOS_RESPONSE:
+            response.__class__ = PumpCarbRatiosResponseMessage
+        elif response.messageType == COM_D_COMMAND.READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_RESPONSE:
+            response.__class__ = PumpSensitivityFactorsResponseMessage
+        elif response.messageType == COM_D_COMMAND.READ_BOLUS_WIZARD_BG_TARGETS_RESPONSE:
+            response.__class__ = PumpBgTargetsResponseMessage
+        elif response.messageType == COM_D_COMMAND.DEVICE_CHARACTERISTICS_RESPONSE:
+            response.__class__ = DeviceCharacteristicsResponseMessage
 
         return response
 
     @property
     def messageType( self ):
-        return struct.unpack( '>H', self.responsePayload[1:3] )[0]
+        return cnl24codec.UINT16_BE.unpack_from( self.responsePayload, 1 )[0]
 
 class ReadInfoResponseMessage( object ):
     @classmethod
@@ -449,7 +713,7 @@ class PumpTimeResponseMessage( MedtronicReceiveMessage ):
 
     @property
     def encodedDatetime( self ):
-        return struct.unpack( '>Q', self.responsePayload[4:] )[0]
+        return cnl24codec.UINT64_BE.unpack_from( self.responsePayload, 4 )[0]
 
     @property
     def datetime( self ):
@@ -473,15 +737,15 @@ class PumpHistoryInfoResponseMessage( MedtronicReceiveMessage ):
 
     @property
     def historySize( self ):
-        return struct.unpack( '>I', self.responsePayload[4:8] )[0]
+        return cnl24codec.UINT32_BE.unpack_from( self.responsePayload, 4 )[0]
 
     @property
     def encodedDatetimeStart( self ):
-        return struct.unpack( '>Q', self.responsePayload[8:16] )[0]
+        return cnl24codec.UINT64_BE.unpack_from( self.responsePayload, 8 )[0]
 
     @property
     def encodedDatetimeEnd( self ):
-        return struct.unpack( '>Q', self.responsePayload[16:24] )[0]
+        return cnl24codec.UINT64_BE.unpack_from( self.responsePayload, 16 )[0]
 
     @property
     def datetimeStart( self ):
@@ -503,318 +767,279 @@ class MultiPacketSegment( MedtronicReceiveMessage ):
 
     @property
     def packetNumber( self ):
-        return struct.unpack( '>H', self.responsePayload[3:5] )[0]
+        return cnl24codec.PACKET_NUMBER.unpack_from( self.responsePayload, 3 )[0]
 
     @property
     def payload( self ):
         return self.responsePayload[5:]
 
+    @property
+    def segmentParameters( self ):
+        # segment size, packet size, last packet size, packets to fetch
+        return cnl24codec.SEGMENT_PARAMETERS.unpack_from( self.responsePayload, 3 )
+
     @property
     def segmentSize( self ):
-        return struct.unpack( '>I', self.responsePayload[3:7] )[0]
+        return self.segmentParameters[0]
 
     @property
     def packetSize( self ):
-        return struct.unpack( '>H', self.responsePayload[7:9] )[0]
+        return self.segmentParameters[1]
 
     @property
     def lastPacketSize( self ):
-        return struct.unpack( '>H', self.responsePayload[9:11] )[0]
+        return self.segmentParameters[2]
 
     @property
     def packetsToFetch( self ):
-        return struct.unpack( '>H', self.responsePayload[11:13] )[0]
+        return self.segmentParameters[3]
 
-class PumpStatusResponseMessage( MedtronicReceiveMessage ):
-    MMOL = 1
-    MGDL = 2
-
-    @classmethod
-    def decode( cls, message, session ):
-        response = MedtronicReceiveMessage.decode( message, session )
-        if response.messageType != COM_D_COMMAND.READ_PUMP_STATUS_RESPONSE:
-            raise UnexpectedMessageException( "Expected to get a Status Response message '{0}'. Got {1}.".format( COM_D_COMMAND.READ_PUMP_STATUS_RESPONSE, response.messageType ) )
-
-        # Since we only add behaviour, we can cast this class to ourselves
-        response.__class__ = PumpStatusResponseMessage
-        return response
-
-    # see https://github.com/pazaan/600SeriesAndroidUploader/blob/master/app/src/main/java/info/nightscout/android/medtronic/message/PumpStatusResponseMessage.java
+# The settings responses are decoded into plain lists and dicts, so that they
+# can be stored as JSON. Start times are minutes after midnight.
 
+class PumpBasalPatternResponseMessage( MedtronicReceiveMessage ):
     @property
-    def isPumpStatusSuspended( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x01 :
-            return 1
-        else:
-            return 0
+    def patternNumber( self ):
+        return self.responsePayload[cnl24codec.SETTINGS_OFFSET]
 
     @property
-    def isPumpStatusBolusingNormal( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x02 :
-            return 1
-        else:
-            return 0
+    def rates( self ):
+        # Empty for patterns which are not set up
+        items = cnl24codec.decodeScheduleItems( self.responsePayload, cnl24codec.SETTINGS_OFFSET + 1, cnl24codec.BASAL_RATE_ITEM )
+        return [ { 'start': start * cnl24codec.SCHEDULE_STEP_MINUTES, 'rate': rate / 10000.0 }
+                 for rate, start in items ]
 
+class PumpCarbRatiosResponseMessage( MedtronicReceiveMessage ):
     @property
-    def isPumpStatusBolusingSquare( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x04 :
-            return 1
-        else:
-            return 0
+    def carbRatios( self ):
+        items = cnl24codec.decodeScheduleItems( self.responsePayload, cnl24codec.SETTINGS_OFFSET, cnl24codec.CARB_RATIO_ITEM )
+        return [ { 'start': start * cnl24codec.SCHEDULE_STEP_MINUTES, 'grams': grams / 10.0, 'exchanges': exchanges / 1000.0 }
+                 for grams, exchanges, start in items ]
 
+class PumpSensitivityFactorsResponseMessage( MedtronicReceiveMessage ):
     @property
-    def isPumpStatusBolusingDual( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x08 :
-            return 1
-        else:
-            return 0
+    def sensitivityFactors( self ):
+        items = cnl24codec.decodeScheduleItems( self.responsePayload, cnl24codec.SETTINGS_OFFSET, cnl24codec.SENSITIVITY_ITEM )
+        return [ { 'start': start * cnl24codec.SCHEDULE_STEP_MINUTES, 'mgdl': mgdl, 'mmol': mmol / 10.0 }
+                 for mgdl, mmol, start in items ]
 
+class PumpBgTargetsResponseMessage( MedtronicReceiveMessage ):
     @property
-    def isPumpStatusDeliveringInsulin( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x10 :
-            return 1
-        else:
-            return 0
-
-    @property
-    def isPumpStatusTempBasalActive( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x20 :
-            return 1
-        else:
-            return 0
-
-    @property
-    def isPumpStatusCgmActive( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x03:0x04] )[0] )  & 0x40 :
-            return 1
-        else:
-            return 0
-
-    @property
-    def bolusingDelivered( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x04:0x08] )[0] ) / 10000
-
-    @property
-    def bolusingMinutesRemaining( self ):
-        return int( struct.unpack( '>H', self.responsePayload[0x0c:0x0e] )[0] )
-
-    @property
-    def bolusingReference( self ):
-        return int( struct.unpack( '>B', self.responsePayload[0x0e:0x0f] )[0] )
-
-
-    @property
-    def lastBolusAmount(self):
-        return float(struct.unpack('>I', self.responsePayload[0x10:0x14])[0]) / 10000
-
-
-    @property
-    def lastBolusTime(self):
-        dateTimeData = struct.unpack('>L', self.responsePayload[0x14:0x18])[0]
-        return DateTimeHelper.decodeDateTime(dateTimeData, 0)
-
-    @property
-    def lastBolusReference( self ):
-        return int( struct.unpack( '>B', self.responsePayload[0x18:0x19] )[0] )
-
-    @property
-    def activeBasalPattern( self ):
-        return int( struct.unpack( '>B', self.responsePayload[0x1a:0x1b] )[0] ) & 0x0F
-
-    @property
-    def activeTempBasalPattern( self ):
-        return int( (struct.unpack( '>B', self.responsePayload[0x1a:0x1b] )[0] ) >> 4 ) & 0x0F
-
-    @property
-    def currentBasalRate( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x1b:0x1f] )[0] ) / 10000
-
-    @property
-    def tempBasalRate( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x1f:0x23] )[0] ) / 10000
-
-    @property
-    def tempBasalPercentage( self ):
-        return int( struct.unpack( '>B', self.responsePayload[0x23:0x24] )[0] )
-
-    @property
-    def tempBasalMinutesRemaining( self ):
-        return int( struct.unpack( '>H', self.responsePayload[0x24:0x26] )[0] )
-
-    @property
-    def basalUnitsDeliveredToday( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x26:0x2a] )[0] ) / 10000
-
-    @property
-    def batteryLevelPercentage( self ):
-        return int( struct.unpack( '>B', self.responsePayload[0x2a:0x2b] )[0] )
-
-    @property
-    def insulinUnitsRemaining( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x2b:0x2f] )[0] ) / 10000
-
-    @property
-    def minutesOfInsulinRemaining( self ):
-        Hours = int(struct.unpack('>B', self.responsePayload[0x2f:0x30])[0])
-        Minutes = int( struct.unpack( '>B', self.responsePayload[0x30:0x31] )[0] )
-        return int ((Hours * 60) + Minutes)
-
-    @property
-    def activeInsulin( self ):
-        return float( struct.unpack( '>I', self.responsePayload[0x31:0x35] )[0] ) / 10000
+    def bgTargets( self ):
+        items = cnl24codec.decodeScheduleItems( self.responsePayload, cnl24codec.SETTINGS_OFFSET, cnl24codec.BG_TARGET_ITEM )
+        return [ { 'start': start * cnl24codec.SCHEDULE_STEP_MINUTES, 'highMgdl': highMgdl, 'highMmol': highMmol / 10.0,
+                   'lowMgdl': lowMgdl, 'lowMmol': lowMmol / 10.0 }
+                 for highMgdl, highMmol, lowMgdl, lowMmol, start in items ]
 
+class DeviceCharacteristicsResponseMessage( MedtronicReceiveMessage ):
     @property
-    def sensorBGL( self ):
-        # // In mg/DL. 0x0000 = no CGM reading, 0x03NN = sensor exception
-        return int( struct.unpack( '>H', self.responsePayload[0x35:0x37] )[0] )
+    def serial( self ):
+        serial, _ = cnl24codec.DEVICE_CHARACTERISTICS.unpack_from( self.responsePayload, cnl24codec.SETTINGS_OFFSET )
+        return serial.decode( 'ascii', 'replace' ).rstrip( '\x00' )
 
     @property
-    def sensorBGLTimestamp( self ):
-        dateTimeData = struct.unpack( '>Q', self.responsePayload[0x37:0x3f] )[0]
-        return DateTimeHelper.decodeDateTime( dateTimeData )
+    def pumpMAC( self ):
+        return cnl24codec.DEVICE_CHARACTERISTICS.unpack_from( self.responsePayload, cnl24codec.SETTINGS_OFFSET )[1]
 
-    @property
-    def isPlgmAlertOnHigh(self):
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x01:
-            return 1
-        else:
-            return 0
+class PumpStatusSnapshot( object ):
+    # Pump status decoded from a READ_PUMP_STATUS_RESPONSE payload. All fields are
+    # unpacked with a single unpack_from, flags and timestamps are decoded only once.
+    # see https://github.com/pazaan/600SeriesAndroidUploader/blob/master/app/src/main/java/info/nightscout/android/medtronic/message/PumpStatusResponseMessage.java
 
-    @property
-    def isPlgmAlertOnLow(self):
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x02:
-            return 1
-        else:
-            return 0
+    __slots__ = ( 'isPumpStatusSuspended', 'isPumpStatusBolusingNormal', 'isPumpStatusBolusingSquare',
+                  'isPumpStatusBolusingDual', 'isPumpStatusDeliveringInsulin', 'isPumpStatusTempBasalActive',
+                  'isPumpStatusCgmActive',
+                  'bolusingDelivered', 'bolusingMinutesRemaining', 'bolusingReference',
+                  'lastBolusAmount', 'lastBolusTime', 'lastBolusReference',
+                  'activeBasalPattern', 'activeTempBasalPattern', 'currentBasalRate', 'tempBasalRate',
+                  'tempBasalPercentage', 'tempBasalMinutesRemaining', 'basalUnitsDeliveredToday',
+                  'batteryLevelPercentage', 'insulinUnitsRemaining', 'minutesOfInsulinRemaining', 'activeInsulin',
+                  'sensorBGL', 'sensorBGLTimestamp',
+                  'isPlgmAlertOnHigh', 'isPlgmAlertOnLow', 'isPlgmAlertBeforeHigh', 'isPlgmAlertBeforeLow',
+                  'isPlgmAlertSuspend', 'islgmAlertSuspendLow',
+                  'trendArrow',
+                  'isSensorStatusCalibrating', 'isSensorStatusCalibrationComplete', 'isSensorStatusException',
+                  'sensorCalMinutesRemaining', 'sensorBatteryLevelPercentage', 'sensorRateOfChange',
+                  'recentBolusWizard', 'recentBGL',
+                  'alert', 'alertDate', 'isAlertSilenceHigh', 'isAlertSilenceHighLow', 'isAlertSilenceAll',
+                  'alertSilenceMinutesRemaining' )
+
+    TREND_ARROWS = { 0xc0:  3,   # 3 arrows up
+                     0xa0:  2,   # 2 arrows up
+                     0x80:  1,   # 1 arrow up
+                     0x60:  0,   # No arrows
+                     0x40: -1,   # 1 arrow down
+                     0x20: -2,   # 2 arrows down
+                     0x00: -3 }  # 3 arrows down
 
-    @property
-    def isPlgmAlertBeforeHigh(self):
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x04:
-            return 1
-        else:
-            return 0
-    @property
-    def isPlgmAlertBeforeLow(self):
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x08:
-            return 1
-        else:
-            return 0
-    @property
-    def isPlgmAlertSuspend(self):
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x80:
-            return 1
-        else:
-            return 0
-    @property
-    def islgmAlertSuspendLow(self):
+    @classmethod
+    def decode( cls, responsePayload ):
+        ( pumpStatus, bolusingDelivered, bolusingMinutesRemaining, bolusingReference,
+          lastBolusAmount, lastBolusTime, lastBolusReference, basalPatterns, currentBasalRate,
+          tempBasalRate, tempBasalPercentage, tempBasalMinutesRemaining, basalUnitsDeliveredToday,
+          batteryLevel, insulinUnitsRemaining, insulinHours, insulinMinutes, activeInsulin,
+          sensorBGL, sensorBGLTimestamp, plgmAlert, trend, sensorStatus, sensorCalMinutesRemaining,
+          sensorBattery, sensorRateOfChange, bolusWizard, recentBGL, alert, alertDate,
+          alertSilence, alertSilenceMinutesRemaining ) = \
+            cnl24codec.PUMP_STATUS.unpack_from( responsePayload, cnl24codec.PUMP_STATUS_OFFSET )
+
+        status = cls()
+        status.isPumpStatusSuspended         = pumpStatus & 0x01
+        status.isPumpStatusBolusingNormal    = pumpStatus >> 1 & 0x01
+        status.isPumpStatusBolusingSquare    = pumpStatus >> 2 & 0x01
+        status.isPumpStatusBolusingDual      = pumpStatus >> 3 & 0x01
+        status.isPumpStatusDeliveringInsulin = pumpStatus >> 4 & 0x01
+        status.isPumpStatusTempBasalActive   = pumpStatus >> 5 & 0x01
+        status.isPumpStatusCgmActive         = pumpStatus >> 6 & 0x01
+
+        status.bolusingDelivered        = bolusingDelivered / 10000.0
+        status.bolusingMinutesRemaining = bolusingMinutesRemaining
+        status.bolusingReference        = bolusingReference
+        status.lastBolusAmount          = lastBolusAmount / 10000.0
+        status.lastBolusTime            = DateTimeHelper.decodeDateTime( lastBolusTime, 0 )
+        status.lastBolusReference       = lastBolusReference
+
+        status.activeBasalPattern        = basalPatterns & 0x0F
+        status.activeTempBasalPattern    = basalPatterns >> 4 & 0x0F
+        status.currentBasalRate          = currentBasalRate / 10000.0
+        status.tempBasalRate             = tempBasalRate / 10000.0
+        status.tempBasalPercentage       = tempBasalPercentage
+        status.tempBasalMinutesRemaining = tempBasalMinutesRemaining
+        status.basalUnitsDeliveredToday  = basalUnitsDeliveredToday / 10000.0
+
+        status.batteryLevelPercentage    = batteryLevel
+        status.insulinUnitsRemaining     = insulinUnitsRemaining / 10000.0
+        status.minutesOfInsulinRemaining = insulinHours * 60 + insulinMinutes
+        status.activeInsulin             = activeInsulin / 10000.0
+
+        # In mg/DL. 0x0000 = no CGM reading, 0x03NN = sensor exception
+        status.sensorBGL          = sensorBGL
+        status.sensorBGLTimestamp = DateTimeHelper.decodeDateTime( sensorBGLTimestamp )
+
+        status.isPlgmAlertOnHigh     = plgmAlert & 0x01
+        status.isPlgmAlertOnLow      = plgmAlert >> 1 & 0x01
+        status.isPlgmAlertBeforeHigh = plgmAlert >> 2 & 0x01
+        status.isPlgmAlertBeforeLow  = plgmAlert >> 3 & 0x01
+        status.isPlgmAlertSuspend    = plgmAlert >> 7 & 0x01
         # needs discovery confirmation!
-        if (struct.unpack('>B', self.responsePayload[0x3f:0x40])[0]) & 0x10:
-            return 1
-        else:
-            return 0
-
-    @property
-    def trendArrow( self ):
-        status = int( struct.unpack( '>B', self.responsePayload[0x40:0x41] )[0] ) & 0xF0
-        if status == 0xc0:
-            return 3 #"3 arrows up"
-        elif status == 0xa0:
-            return 2 #"2 arrows up"
-        elif status == 0x80:
-            return 1 #"1 arrow up"
-        elif status == 0x60:
-            return 0 #"No arrows"
-        elif status == 0x40:
-            return -1 #"1 arrow down"
-        elif status == 0x20:
-            return -2 #"2 arrows down"
-        elif status == 0x00:
-            return -3 #"3 arrows down"
-        else:
-            return None #"Unknown trend"
-
-    @property
-    def isSensorStatusCalibrating( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x41:0x42] )[0] )  & 0x01 :
-            return 1
-        else:
-            return 0
-
-    @property
-    def isSensorStatusCalibrationComplete( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x41:0x42] )[0] )  & 0x02 :
-            return 1
-        else:
-            return 0
-
-    @property
-    def isSensorStatusException( self ):
-        if ( struct.unpack( '>B', self.responsePayload[0x41:0x42] )[0] )  & 0x04 :
-            return 1
-        else:
-            return 0
-
-
-    @property
-    def sensorCalMinutesRemaining( self ):
-        return int( struct.unpack( '>H', self.responsePayload[0x43:0x45] )[0] )
+        status.islgmAlertSuspendLow  = plgmAlert >> 4 & 0x01
 
-    @property
-    def sensorBatteryLevelPercentage( self ):
-        sbatt_raw = int( struct.unpack( '>B', self.responsePayload[0x45:0x46] )[0] )
-        return int(round(((sbatt_raw & 0x0F) * 100.0) / 15.0))
+        status.trendArrow = cls.TREND_ARROWS.get( trend & 0xF0 ) # None for unknown trend
 
-    @property
-    def sensorRateOfChange( self ):
-        return float( struct.unpack( '>h', self.responsePayload[0x46:0x48] )[0] ) / 100
+        status.isSensorStatusCalibrating         = sensorStatus & 0x01
+        status.isSensorStatusCalibrationComplete = sensorStatus >> 1 & 0x01
+        status.isSensorStatusException           = sensorStatus >> 2 & 0x01
+        status.sensorCalMinutesRemaining         = sensorCalMinutesRemaining
+        status.sensorBatteryLevelPercentage      = int( round( ( ( sensorBattery & 0x0F ) * 100.0 ) / 15.0 ) )
+        status.sensorRateOfChange                = sensorRateOfChange / 100.0
 
-    @property
-    def recentBolusWizard( self ):
         # Bitfield of the Bolus Wizard status. 0x01 if the Bolus Wizard has been used in the last 15 minutes
-        if self.responsePayload[0x48] == 0:
-            return 0
-        else:
-            return 1
-
-    @property
-    def recentBGL( self ):
+        status.recentBolusWizard = 1 if bolusWizard else 0
         # Blood Glucose Level entered into the Bolus Wizard, in mg/dL
-        return struct.unpack( '>H', self.responsePayload[0x49:0x4b] )[0]
-
-    #Active alert
-    @property
-    def alert( self ):
-        return struct.unpack( '>H', self.responsePayload[0x4b:0x4d] )[0]
+        status.recentBGL         = recentBGL
+
+        # Active alert
+        status.alert                        = alert
+        status.alertDate                    = DateTimeHelper.decodeDateTime( alertDate )
+        status.isAlertSilenceHigh           = alertSilence & 0x01
+        status.isAlertSilenceHighLow        = alertSilence >> 1 & 0x01
+        status.isAlertSilenceAll            = alertSilence >> 2 & 0x01
+        status.alertSilenceMinutesRemaining = alertSilenceMinutesRemaining
+
+        return status
+
+    def to_dict( self ):
+        # Pump status part of the statusDownload() result
+        return { # Pump status
+                 "pumpStatus":{"suspended":self.isPumpStatusSuspended,
+                               "bolusingNormal":self.isPumpStatusBolusingNormal,
+                               "bolusingSquare":self.isPumpStatusBolusingSquare,
+                               "bolusingDual":self.isPumpStatusBolusingDual,
+                               "deliveringInsulin":self.isPumpStatusDeliveringInsulin,
+                               "tempBasalActive":self.isPumpStatusTempBasalActive,
+                               "cgmActive":self.isPumpStatusCgmActive},
+
+                 # Pump alert
+                 "pumpAlert":{"alertOnHigh":self.isPlgmAlertOnHigh,
+                              "alertOnLow":self.isPlgmAlertOnLow,
+                              "alertBeforeHigh":self.isPlgmAlertBeforeHigh,
+                              "alertBeforeLow":self.isPlgmAlertBeforeLow,
+                              "alertSuspend":self.isPlgmAlertSuspend,
+                              "alertSuspendLow":self.islgmAlertSuspendLow},
+                 "alert":self.alert,
+                 "alertDate":self.alertDate,
+                 "isAlertSilenceHigh":self.isAlertSilenceHigh,
+                 "isAlertSilenceHighLow":self.isAlertSilenceHighLow,
+                 "isAlertSilenceAll":self.isAlertSilenceAll,
+                 "alertSilenceMinutesRemaining":self.alertSilenceMinutesRemaining,
+
+                 # Sensor status
+                 "sensorStatus":{"calibrating":self.isSensorStatusCalibrating,
+                                 "calibrationComplete":self.isSensorStatusCalibrationComplete,
+                                 "exception":self.isSensorStatusException},
+                 "sensorCalMinutesRemaining":self.sensorCalMinutesRemaining,
+                 "sensorBatteryLevelPercentage":self.sensorBatteryLevelPercentage,
+                 "sensorRateOfChange":self.sensorRateOfChange,
+
+                 # Bolus
+                 "bolusingDelivered":self.bolusingDelivered,
+                 "bolusingMinutesRemaining":self.bolusingMinutesRemaining,
+                 "bolusingReference":self.bolusingReference,
+                 "lastBolusAmount":self.lastBolusAmount,
+                 "lastBolusTime":self.lastBolusTime,
+                 "lastBolusReference":self.lastBolusReference,
+                 "recentBolusWizard":self.recentBolusWizard,
+                 "recentBGL":self.recentBGL,
+
+                 # Basal
+                 "activeBasalPattern":self.activeBasalPattern,
+                 "activeTempBasalPattern":self.activeTempBasalPattern,
+                 "currentBasalRate":self.currentBasalRate,
+                 "tempBasalRate":self.tempBasalRate,
+                 "tempBasalPercentage":self.tempBasalPercentage,
+                 "tempBasalMinutesRemaining":self.tempBasalMinutesRemaining,
+                 "basalUnitsDeliveredToday":self.basalUnitsDeliveredToday,
+
+                 # Battery
+                 "batteryLevelPercentage":self.batteryLevelPercentage,
+
+                 # Insulin
+                 "insulinUnitsRemaining":self.insulinUnitsRemaining,
+                 "minutesOfInsulinRemaining":self.minutesOfInsulinRemaining,
+                 "activeInsulin":self.activeInsulin,
+
+                 # BGL
+                 "sensorBGL":self.sensorBGL,
+                 "sensorBGLTimestamp":self.sensorBGLTimestamp,
+                 "trendArrow":self.trendArrow
+               }
 
-    @property
-    def alertDate( self ):
-        dateTimeData = struct.unpack( '>Q', self.responsePayload[0x4d:0x55] )[0]
-        return DateTimeHelper.decodeDateTime( dateTimeData )
+class PumpStatusResponseMessage( MedtronicReceiveMessage ):
+    MMOL = 1
+    MGDL = 2
 
-    @property
-    def isAlertSilenceHigh(self):
-        if (struct.unpack('>B', self.responsePayload[0x55:0x56])[0]) & 0x01:
-            return 1
-        else:
-            return 0
-    @property
+    @classmethod
+    def decode( cls, message, session ):
+        response = MedtronicReceiveMessage.decode( message, session )
+        if response.messageType != COM_D_COMMAND.READ_PUMP_STATUS_RESPONSE:
+            raise UnexpectedMessageException( "Expected to get a Status Response message '{0}'. Got {1}.".format( COM_D_COMMAND.READ_PUMP_STATUS_RESPONSE, response.messageType ) )
 
-    def isAlertSilenceHighLow(self):
-        if (struct.unpack('>B', self.responsePayload[0x55:0x56])[0]) & 0x02:
-            return 1
-        else:
-            return 0
+        # Since we only add behaviour, we can cast this class to ourselves
+        response.__class__ = PumpStatusResponseMessage
+        return response
 
     @property
-    def isAlertSilenceAll(self):
-        if (struct.unpack('>B', self.responsePayload[0x55:0x56])[0]) & 0x04:
-            return 1
-        else:
-            return 0
+    def snapshot( self ):
+        # Decoded on first access, the message is only cast to this class after decoding
+        if '_snapshot' not in self.__dict__:
+            self._snapshot = PumpStatusSnapshot.decode( self.responsePayload )
+        return self._snapshot
 
-    @property
-    def alertSilenceMinutesRemaining(self):
-        return struct.unpack( '>H', self.responsePayload[0x56:0x58] )[0]
+    def __getattr__( self, name ):
+        # The status fields (isPumpStatusSuspended, sensorBGL, ...) are read from the snapshot
+        if name.startswith( '_' ) or name not in PumpStatusSnapshot.__slots__:
+            raise AttributeError( name )
+        return getattr( self.snapshot, name )
 
 ##############################
 
@@ -860,6 +1085,28 @@ class AckMultipacketRequestMessage( MedtronicSendMessage ):
         payload = struct.pack( '>H', segmentCommand )
         MedtronicSendMessage.__init__( self, COM_D_COMMAND.ACK_MULTIPACKET_COMMAND, session, payload )
 
+class MultipacketResendPacketsMessage( MedtronicSendMessage ):
+    def __init__( self, session, packetNumber, packetCount ):
+        payload = struct.pack( '>HH', packetNumber, packetCount )
+        MedtronicSendMessage.__init__( self, COM_D_COMMAND.MULTIPACKET_RESEND_PACKETS, session, payload )
+
+class PumpBasalPatternRequestMessage( MedtronicSendMessage ):
+    def __init__( self, session, patternNumber ):
+        payload = struct.pack( '>B', patternNumber )
+        MedtronicSendMessage.__init__( self, COM_D_COMMAND.READ_BASAL_PATTERN_REQUEST, session, payload )
+
+class PumpCarbRatiosRequestMessage( MedtronicSendMessage ):
+    def __init__( self, session ):
+        MedtronicSendMessage.__init__( self, COM_D_COMMAND.READ_BOLUS_WIZARD_CARB_RATIOS_REQUEST, session )
+
+class PumpSensitivityFactorsRequestMessage( MedtronicSendMessage ):
+    def __init__( self, session ):
+        MedtronicSendMessage.__init__( self, COM_D_COMMAND.READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_REQUEST, session )
+
+class PumpBgTargetsRequestMessage( MedtronicSendMessage ):
+    def __init__( self, session ):
+        MedtronicSendMessage.__init__( self, COM_D_COMMAND.READ_BOLUS_WIZARD_BG_TARGETS_REQUEST, session )
+
 class BasicNgpParametersRequestMessage( MedtronicSendMessage ):
     def __init__( self, session ):
         MedtronicSendMessage.__init__( self, COM_D_COMMAND.NGP_PARAMETER_REQUEST, session )
@@ -905,21 +1152,12 @@ class BayerBinaryMessage( object ):
         self.payload = payload
         self.session = session
         if messageType and self.session:
-            self.envelope = struct.pack( '<BB6s10sBI5sI', 0x51, 3, b'000000', b'\x00' * 10,
-                messageType, self.session.bayerSequenceNumber, b'\x00' * 5, 
+            self.envelope = cnl24codec.encodeBayerEnvelope( messageType, self.session.bayerSequenceNumber,
                 len( self.payload ) if self.payload else 0 )
-            self.envelope += struct.pack( 'B', self.makeMessageCrc() )
+            self.envelope += cnl24codec.UINT8.pack( self.makeMessageCrc() )
 
     def makeMessageCrc( self ):
-        checksum = 0
-        for x in self.envelope[0:32]:
-            checksum += ord_hack(x)
-        #checksum = sum( bytearray(self.envelope[0:32], 'utf-8') )
-
-        if self.payload:
-            checksum += sum( bytearray( self.payload ) )
-
-        return checksum & 0xff
+        return cnl24codec.bayerChecksum( memoryview( self.envelope )[0:cnl24codec.BAYER_CHECKSUM], self.payload )
 
     def encode( self ):
         # Increment the Bayer Sequence Number
@@ -932,12 +1170,11 @@ class BayerBinaryMessage( object ):
     @classmethod
     def decode( cls, message ):
         response = cls()
-        response.envelope = message[0:33]
-        response.payload = message[33:] 
-
-        checksum = message[32]
-        calcChecksum = response.makeMessageCrc()
-        if( checksum != calcChecksum ):
+        # envelope and payload are views of the received message
+        try:
+            response.envelope, response.payload = cnl24codec.splitBayerMessage( message )
+        except ValueError as e:
+            calcChecksum, checksum = e.args
             logger.error('ChecksumException: Expected to get {0}. Got {1}'.format( calcChecksum, checksum ))
             raise ChecksumException( 'Expected to get {0}. Got {1}'.format( calcChecksum, checksum ) )
 
@@ -945,7 +1182,7 @@ class BayerBinaryMessage( object ):
 
     @property
     def linkDeviceOperation( self ):
-        return ord_hack(self.envelope[18])
+        return self.envelope[cnl24codec.BAYER_OPERATION]
 
     # HACK: This is just a debug try, session param shall not be there
     def checkLinkDeviceOperation( self, expectedValue, session = None ):
@@ -958,6 +1195,293 @@ class BayerBinaryMessage( object ):
                 logger.warning("#### Message type of caught 0x80: 0x{0:x}".format(response.messageType))
             raise UnexpectedMessageException( "Expected to get linkDeviceOperation {0:x}. Got {1:x}".format( expectedValue, self.linkDeviceOperation ) )
 
+class PhaseTimeouts( object ):
+    # Records how long the reads of each protocol phase had to wait for their
+    # message and derives the read timeout of the phase from these latencies
+    SAMPLES           = 50   # Latencies kept per phase
+    MIN_SAMPLES       = 5    # With less samples the latencies of the phase group are used
+    PERCENTILE        = 0.95
+    PERCENTILE_FACTOR = 4.0
+    MAX_FACTOR        = 2.0
+
+    # Floor and ceiling of the timeout in ms
+    LIMITS = { PROTOCOL_PHASE.DEVICE_INFO:  ( 1000, 25000 ),
+               PROTOCOL_PHASE.CONTROL:      ( 1000, 25000 ),
+               PROTOCOL_PHASE.PASSTHROUGH:  ( 1000, 25000 ),
+               PROTOCOL_PHASE.CONNECTION:   ( 1000, 25000 ),
+               PROTOCOL_PHASE.LINK_INFO:    ( 1000, 25000 ),
+               PROTOCOL_PHASE.NEGOTIATE:    ( 5000, 25000 ),
+               PROTOCOL_PHASE.EHSM:         ( 3000, 25000 ),
+               PROTOCOL_PHASE.TIME:         ( 3000, 25000 ),
+               PROTOCOL_PHASE.STATUS:       ( 3000, 25000 ),
+               PROTOCOL_PHASE.HISTORY:      ( 3000, 25000 ),
+               PROTOCOL_PHASE.PACKET:       ( 1000, 10000 ),
+               PROTOCOL_PHASE.REQUEST:      ( 3000, 25000 ),
+               PROTOCOL_PHASE.CONTINUATION: (  500, 10000 ) }
+    DEFAULT_LIMITS = ( 3000, 25000 )
+
+    # Phases which are only run once per connection take their timeout from the
+    # other phases with the same kind of round trip until they have enough samples
+    GROUPS = { PROTOCOL_PHASE.DEVICE_INFO: 'cnl',
+               PROTOCOL_PHASE.CONTROL:     'cnl',
+               PROTOCOL_PHASE.PASSTHROUGH: 'cnl',
+               PROTOCOL_PHASE.CONNECTION:  'cnl',
+               PROTOCOL_PHASE.LINK_INFO:   'cnl',
+               PROTOCOL_PHASE.NEGOTIATE:   'pump',
+               PROTOCOL_PHASE.EHSM:        'pump',
+               PROTOCOL_PHASE.TIME:        'pump',
+               PROTOCOL_PHASE.STATUS:      'pump',
+               PROTOCOL_PHASE.HISTORY:     'pump',
+               PROTOCOL_PHASE.PACKET:      'pump',
+               PROTOCOL_PHASE.REQUEST:     'pump' }
+
+    # Phases in which a timeout means a lost message rather than a too short timeout
+    LOSSY = ( PROTOCOL_PHASE.PACKET, )
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def record( self, phase, latencyMs ):
+        with self.lock:
+            for key in ( phase, self.GROUPS.get( phase ) ):
+                if key is None:
+                    continue
+                if key not in self.latencies:
+                    self.latencies[key] = collections.deque( maxlen = self.SAMPLES )
+                self.latencies[key].append( latencyMs )
+
+    def timedOut( self, phase, timeoutMs ):
+        # A timeout counts as a sample of the timeout length, so a timeout
+        # which was too short grows with every miss up to the ceiling
+        if phase not in self.LOSSY:
+            self.record( phase, timeoutMs )
+
+    def timeout( self, phase ):
+        floor, ceiling = self.LIMITS.get( phase, self.DEFAULT_LIMITS )
+        with self.lock:
+            samples = self.latencies.get( phase, () )
+            if len( samples ) < self.MIN_SAMPLES:
+                samples = self.latencies.get( self.GROUPS.get( phase ), () )
+            samples = sorted( samples )
+        if len( samples ) < self.MIN_SAMPLES:
+            return ceiling
+        percentile = samples[int( self.PERCENTILE * ( len( samples ) - 1 ) )]
+        timeout = max( percentile * self.PERCENTILE_FACTOR, samples[-1] * self.MAX_FACTOR )
+        return max( floor, min( ceiling, timeout ) )
+
+    def summary( self ):
+        # Number of samples, median and 95th percentile latency and current timeout per phase (ms)
+        result = {}
+        with self.lock:
+            phases = dict( ( phase, sorted( samples ) ) for phase, samples in self.latencies.items() )
+        for phase, samples in phases.items():
+            if phase not in self.LIMITS:
+                continue # Phase group
+            result[phase] = ( len( samples ), samples[( len( samples ) - 1 ) // 2],
+                              samples[int( self.PERCENTILE * ( len( samples ) - 1 ) )], self.timeout( phase ) )
+        return result
+
+class HistoryTransfer( object ):
+    # Completed segments and statistics of a multipacket history transfer.
+    # When the transfer is interrupted, the completed segments are kept as
+    # checkpoint and getPumpHistory() resumes after them with the same object.
+    # PersistentSession keeps unfinished transfers across reconnects (resume()).
+    RESEND_ATTEMPTS   = 3    # Resend requests per segment before the transfer fails
+    ACK_DELAY_STEP_MS = 50   # Added to the ACK delay after a segment with lost packets
+    ACK_DELAY_MAX_MS  = 1000
+
+    def __init__( self, requestType = HISTORY_DATA_TYPE.PUMP_DATA, since = None ):
+        self.requestType = requestType
+        self.since = since     # Requested start (seconds since the epoch)
+        self.segments = []     # Packets of the completed segments
+        self.resumeRtc = None  # Time of the newest event in the completed segments
+        self.completed = False
+        self.ackDelayMs = 0
+        self.bytes = 0         # Received packet payload, including resent packets
+        self.packets = 0       # Packets of the completed segments
+        self.resentPackets = 0
+        self.duration = 0.0
+        self.started = None
+
+    @classmethod
+    def resume( cls, transfers, pumpSerial, requestType, since ):
+        # Returns the unfinished transfer of the pump and history type from transfers
+        # if it started at or before since, otherwise a new one which is kept there
+        key = ( pumpSerial, requestType )
+        transfer = transfers.get( key )
+        if transfer is None or transfer.completed or transfer.since is None or transfer.since > since:
+            transfer = cls( requestType, since )
+            transfers[key] = transfer
+        elif transfer.segments:
+            logger.info("Resuming history transfer with {0} segments".format( len( transfer.segments ) ))
+        return transfer
+
+    def start( self ):
+        self.started = time.time()
+
+    def stop( self ):
+        if self.started is not None:
+            self.duration += time.time() - self.started
+            self.started = None
+
+    def checkpoint( self, packets, blocks, resentPackets ):
+        # blocks raises ChecksumError before the segment is kept
+        resumeRtc = self.resumeRtc
+        for block in blocks:
+            pos = 0
+            # Event header: type, source, size, RTC
+            while pos + 7 <= len( block ):
+                rtc = cnl24codec.UINT32_BE.unpack_from( block, pos + 3 )[0]
+                if resumeRtc is None or rtc > resumeRtc:
+                    resumeRtc = rtc
+                size = block[pos + 2]
+                if size == 0:
+                    break
+                pos += size
+        self.resumeRtc = resumeRtc
+        self.segments.append( packets )
+        self.packets += len( packets )
+        # Give the radio more time between segments while packets get lost
+        if resentPackets:
+            self.ackDelayMs = min( self.ACK_DELAY_MAX_MS, self.ackDelayMs + self.ACK_DELAY_STEP_MS )
+        else:
+            self.ackDelayMs = self.ackDelayMs // 2
+
+    @property
+    def bytesPerSecond( self ):
+        duration = self.duration + ( time.time() - self.started if self.started is not None else 0 )
+        return self.bytes / duration if duration > 0 else 0.0
+
+    @property
+    def resendRatio( self ):
+        return float( self.resentPackets ) / self.packets if self.packets else 0.0
+
+    @staticmethod
+    def missingRanges( packets ):
+        # Consecutive runs of missing packets as ( first packet, count )
+        ranges = []
+        for number, packet in enumerate( packets ):
+            if packet is not None:
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == number:
+                ranges[-1][1] += 1
+            else:
+                ranges.append( [ number, 1 ] )
+        return [ tuple( r ) for r in ranges ]
+
+class UsbReader( threading.Thread ):
+    # Drains the HID reports of the CNL as soon as they arrive and reassembles
+    # them into complete messages, which are handed over through a queue
+    POLL_TIMEOUT_MS = 100
+
+    CANCELLED = object() # Queue marker to wake up a waiting reader
+
+    def __init__( self, device, blockSize, magicHeader, timeScale = 1.0, timeouts = None ):
+        threading.Thread.__init__( self, name = 'cnl24-usb-reader' )
+        self.daemon = True
+        self.device = device
+        self.blockSize = blockSize
+        self.magicHeader = magicHeader
+        self.timeScale = timeScale
+        self.timeouts = timeouts or PhaseTimeouts()
+
+        self.messages = queue.Queue()
+        self.stopped = threading.Event()
+        self.cancelled = threading.Event()
+
+        self.payload = None # Message being reassembled
+        self.expectedSize = 0
+        self.lastReport = 0
+
+    def run( self ):
+        while not self.stopped.is_set():
+            try:
+                data = self.device.read( self.blockSize, timeout_ms = self.POLL_TIMEOUT_MS )
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logger.error("USB reader: device read failed: {0}".format( e ))
+                    self.messages.put( IOError( 'USB device read failed: {0}'.format( e ) ) )
+                return
+
+            if data:
+                self.handleReport( bytearray( data ) )
+            elif self.payload is not None:
+                timeoutMs = self.timeouts.timeout( PROTOCOL_PHASE.CONTINUATION )
+                if time.time() - self.lastReport > timeoutMs / 1000.0 * self.timeScale:
+                    logger.warning("USB reader: dropping incomplete message of {0} bytes".format( len( self.payload ) ))
+                    self.timeouts.timedOut( PROTOCOL_PHASE.CONTINUATION, timeoutMs )
+                    self.payload = None
+                    self.messages.put( TimeoutException( 'Timeout waiting for message' ) )
+
+    def handleReport( self, data ):
+        if data[0:3] != self.magicHeader:
+            logger.error('Recieved invalid USB packet')
+            self.payload = None
+            self.messages.put( RuntimeError( 'Recieved invalid USB packet' ) )
+            return
+
+        payloadSize = data[3]
+        now = time.time()
+        if self.payload is None:
+            self.payload = bytearray()
+            self.expectedSize = 0
+            # get the expected size for 0x80 or 0x81 messages as they may be on a block boundary
+            if payloadSize >= 0x21 and ((data[0x12 + 4] & 0xFF == 0x80) or (data[0x12 + 4] & 0xFF == 0x81)):
+                self.expectedSize = 0x21 + ((data[0x1C + 4] & 0x00FF) | (data[0x1D + 4] << 8 & 0xFF00))
+        else:
+            self.timeouts.record( PROTOCOL_PHASE.CONTINUATION, ( now - self.lastReport ) * 1000 / self.timeScale )
+        self.payload.extend( data[4:payloadSize + 4] )
+        self.lastReport = now
+
+        logger.debug('READ: bytesRead={0}, payloadSize={1}, expectedSize={2}'.format(len(data), payloadSize, self.expectedSize))
+
+        if payloadSize != self.blockSize - 4 or len( self.payload ) == self.expectedSize:
+            self.messages.put( self.payload )
+            self.payload = None
+
+    @property
+    def pending( self ):
+        # True if a message (or a part of it) was received but not yet read
+        return not self.messages.empty() or self.payload is not None
+
+    def get( self, timeout ):
+        if self.cancelled.is_set():
+            raise CancelledException( 'Read cancelled' )
+        try:
+            message = self.messages.get( timeout = timeout * self.timeScale )
+        except queue.Empty:
+            raise TimeoutException( 'Timeout waiting for message' )
+        if message is self.CANCELLED:
+            raise CancelledException( 'Read cancelled' )
+        if isinstance( message, Exception ):
+            raise message
+        return message
+
+    def cancel( self ):
+        self.cancelled.set()
+        self.messages.put( self.CANCELLED )
+
+    def resetCancel( self ):
+        # Makes reads possible again after cancel(), the queued markers are dropped
+        self.cancelled.clear()
+        kept = []
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message is not self.CANCELLED:
+                kept.append( message )
+        for message in kept:
+            self.messages.put( message )
+
+    def stop( self ):
+        self.stopped.set()
+        self.cancel()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join( 2 * self.POLL_TIMEOUT_MS / 1000.0 )
+
 class Medtronic600SeriesDriver( object ):
     USB_BLOCKSIZE = 64
     USB_VID = 0x1a79
@@ -965,75 +1489,141 @@ class Medtronic600SeriesDriver( object ):
     MAGIC_HEADER = b'ABC'
 
     ERROR_CLEAR_TIMEOUT_MS   = 25000
+    ERROR_CLEAR_IDLE_MS      = 2000
     PRESEND_CLEAR_TIMEOUT_MS = 50
+    PRESEND_CLEAR_IDLE_MS    = 5
     READ_TIMEOUT_MS          = 25000
     CNL_READ_TIMEOUT_MS      = 2000
 
     CHANNELS = [ 0x14, 0x11, 0x0e, 0x17, 0x1a ] # In the order that the CareLink applet requests them
 
+    CHANNEL_DEFAULT_SUCCESS_MS = 1000 # Assumed negotiation time for a channel without successes
+    CHANNEL_STATS_DECAY        = 0.9  # Weight of older channel statistics per negotiation
+
+    REQUEST_RETRIES = 2 # Retries of a single pump request within the open session
+    CREDENTIAL_FAILURE_LIMIT = 3 # Decryption failures in a row before the cached credentials are cleared
+
     session = None
 
-    def __init__( self ):
+    # Decoded ASTM device info headers, shared by all driver instances
+    deviceInfoCache = {}
+
+    # Latencies of the protocol phases, shared by all driver instances,
+    # so that they survive a reconnect
+    timeouts = PhaseTimeouts()
+
+    def __init__( self, deviceFactory = None, usbSerial = None, usbPath = None ):
         self.session = MedtronicSession()
         self.device = None
+        # Creates the HID device, can be replaced e.g. by the CNL emulator
+        self.deviceFactory = deviceFactory or hid.device
+        # Selects one of several CNL sticks, see enumerateDevices().
+        # Without them the first CNL stick is used.
+        self.usbSerial = usbSerial
+        self.usbPath = usbPath
+        self.reader = None
+        self.deadline = None # Absolute time after which all reads are cancelled
+        self.lastPumpResponse = None
+        self.phase = PROTOCOL_PHASE.DEVICE_INFO # Selects the read timeout
+        self.requestRetries = 0 # Number of retried pump requests
+        self.clearedMessages = 0 # Number of messages dropped by clearMessage()
+        self.rssi = None
 
         self.deviceInfo = None
 
+    @classmethod
+    def enumerateDevices( cls ):
+        # Returns the USB serial number and path of all connected CNL sticks
+        return [ { 'serial': device['serial_number'], 'path': device['path'] }
+                 for device in hid.enumerate( cls.USB_VID, cls.USB_PID ) ]
+
     def openDevice( self ):
         logger.info("# Opening device")
-        self.device = hid.device()
-        self.device.open( self.USB_VID, self.USB_PID )
+        self.device = self.deviceFactory()
+        if self.usbPath:
+            path = self.usbPath.encode( 'ascii' ) if not isinstance( self.usbPath, bytes ) else self.usbPath
+            self.device.open_path( path )
+        elif self.usbSerial:
+            self.device.open( self.USB_VID, self.USB_PID, self.usbSerial )
+        else:
+            self.device.open( self.USB_VID, self.USB_PID )
 
         logger.info("Manufacturer: %s" % self.device.get_manufacturer_string())
         logger.info("Product: %s" % self.device.get_product_string())
         logger.info("Serial No: %s" % self.device.get_serial_number_string())
 
+        # The emulator can run with scaled time, so the read timeouts have to follow
+        self.reader = UsbReader( self.device, self.USB_BLOCKSIZE, self.MAGIC_HEADER,
+                                 getattr( self.device, 'timeScale', 1.0 ), self.timeouts )
+        self.reader.start()
+
     def closeDevice( self ):
         logger.info("# Closing device")
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
         self.device.close()
 
-    def readMessage( self, timeout_ms=READ_TIMEOUT_MS ):
-        payload = bytearray()
-        bytesRead = 0
-        payloadSize = 0
-        expectedSize = 0
-        first = True
-
-        while first or (bytesRead > 0 and payloadSize == self.USB_BLOCKSIZE-4 and len(payload) != expectedSize):
-            t = timeout_ms if first else 10000
-            data = self.device.read( self.USB_BLOCKSIZE, timeout_ms = t )
-            first = False
-            if data:
-                bytesRead = len(data)
-                payloadSize = data[3]
-                if( bytearray( data[0:3] ) != self.MAGIC_HEADER ):
-                    logger.error('Recieved invalid USB packet')
-                    raise RuntimeError( 'Recieved invalid USB packet')
-                payload.extend( data[4:data[3] + 4] )
-
-                # get the expected size for 0x80 or 0x81 messages as they may be on a block boundary
-                if expectedSize == 0 and data[3] >= 0x21  and ((data[0x12 + 4] & 0xFF == 0x80) or (data[0x12 + 4] & 0xFF == 0x81)):
-                    expectedSize = 0x21 + ((data[0x1C + 4] & 0x00FF) | (data[0x1D + 4] << 8 & 0xFF00))
-
-                logger.debug('READ: bytesRead={0}, payloadSize={1}, expectedSize={2}'.format(bytesRead, payloadSize, expectedSize))
-
-            else:
-                #logger.warning('Timeout waiting for message')
-                raise TimeoutException( 'Timeout waiting for message' )
-
+    def cancel( self ):
+        # Can be called from any thread, wakes up a pending read
+        if self.reader is not None:
+            self.reader.cancel()
+
+    def resetCancel( self ):
+        if self.reader is not None:
+            self.reader.resetCancel()
+
+    def readMessage( self, timeout_ms=None ):
+        if self.reader is None:
+            raise IOError( 'USB device not open' )
+
+        # Without explicit timeout the learned timeout of the current protocol phase is used
+        phase = None
+        if timeout_ms is None:
+            phase = self.phase
+            timeout_ms = self.timeouts.timeout( phase )
+
+        timeout = timeout_ms / 1000.0
+        clipped = False
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise CancelledException( 'Deadline for pump communication expired' )
+            if remaining < timeout:
+                timeout = remaining
+                clipped = True
+                phase = None # The wait says nothing about the latency
+
+        start = time.time()
+        try:
+            with cnl24trace.span( 'hid.read' ):
+                payload = self.reader.get( timeout )
+        except TimeoutException:
+            if clipped:
+                raise CancelledException( 'Deadline for pump communication expired' )
+            if phase is not None:
+                logger.warning("Timeout after {0:.0f} ms in protocol phase {1}".format( timeout_ms, phase ))
+                self.timeouts.timedOut( phase, timeout_ms )
+            raise
+        if phase is not None:
+            self.timeouts.record( phase, ( time.time() - start ) * 1000 / self.reader.timeScale )
         # logger.debug("READ: " + binascii.hexlify( payload )) # Debugging
         return payload
 
     def sendMessage( self, payload ):
 
         # Clear any message in the receive buffer
-        self.clearMessage(timeout_ms=self.PRESEND_CLEAR_TIMEOUT_MS)
+        # The reader thread receives everything as soon as the CNL sends it, so there
+        # is only something to clear if a message is queued or partly received
+        if self.reader is not None and self.reader.pending:
+            self.clearMessage(timeout_ms=self.PRESEND_CLEAR_TIMEOUT_MS, idle_ms=self.PRESEND_CLEAR_IDLE_MS)
 
         # Split the message into 60 byte chunks
-        for packet in [ payload[ i: i+60 ] for i in range( 0, len( payload ), 60 ) ]:
-            message = struct.pack( '>3sB', self.MAGIC_HEADER, len( packet ) ) + packet
-            self.device.write( bytearray( message ) )
-            logger.debug("SEND: %s", binascii.hexlify( message )) # Debugging
+        with cnl24trace.span( 'hid.write' ):
+            for packet in [ payload[ i: i+60 ] for i in range( 0, len( payload ), 60 ) ]:
+                message = struct.pack( '>3sB', self.MAGIC_HEADER, len( packet ) ) + packet
+                self.device.write( bytearray( message ) )
+                logger.debug("SEND: %s", binascii.hexlify( message )) # Debugging
 
     # Intercept unexpected messages from the CNL
     # These usually come from pump requests as it can occasionally resend message responses several times 
@@ -1049,17 +1639,25 @@ class Medtronic600SeriesDriver( object ):
     # pre-clear: clear all messages in stream until timeout --> send request
     # consistently stable even with a small timeout, clears multiple messages with very rare miss
     # which will get caught using the post-clear method as fail-safe
+    #
+    # The clear ends when no message arrived for idle_ms, when one of the end of stream
+    # messages below was seen, or at the latest after timeout_ms
 
-    def clearMessage(self, timeout_ms=ERROR_CLEAR_TIMEOUT_MS):
+    def clearMessage(self, timeout_ms=ERROR_CLEAR_TIMEOUT_MS, idle_ms=ERROR_CLEAR_IDLE_MS):
 
-        logger.debug("## CLEAR: timeout={0}".format(timeout_ms))
+        logger.debug("## CLEAR: timeout={0}, idle={1}".format(timeout_ms, idle_ms))
 
         count = 0
         cleared = False
+        start = time.time()
+        end = start + timeout_ms / 1000.0
 
         while not cleared:
+            wait_ms = min( idle_ms, ( end - time.time() ) * 1000 )
+            if wait_ms <= 0:
+                break
             try:
-                payload = self.readMessage(timeout_ms)
+                payload = self.readMessage(wait_ms)
                 count+=1
 
                 # the following are always seen as the end of an incoming stream and can be considered as completed clear indicators
@@ -1089,6 +1687,9 @@ class Medtronic600SeriesDriver( object ):
 
         if count > 0:
            logger.warning("## CLEAR: message stream cleared " + str(count) + " messages.")
+           self.clearedMessages += count
+        if cnl24trace.tracer.enabled:
+            cnl24trace.tracer.record( 'clearMessage', start, time.time() - start, { 'cleared': count } )
 
         return count
 
@@ -1096,7 +1697,12 @@ class Medtronic600SeriesDriver( object ):
 
         logger.debug("## readResponse0x80")
 
-        payload = self.readMessage()
+        try:
+            payload = self.readMessage()
+        except TimeoutException:
+            # The CNL has sent the request (0x81), but the pump did not answer in time
+            logger.error("readResponse0x80: timeout waiting for 0x80 response")
+            raise NoPumpResponseException("Timeout waiting for 0x80 response")
 
         # minimum 0x80 message size?
         if len(payload) <= 0x21:
@@ -1120,21 +1726,21 @@ class Medtronic600SeriesDriver( object ):
         if len(payload) == 0x22:
             logger.error("readResponse0x80: message with 1 byte internal payload")
             # do not retry, end the session
-            raise UnexpectedMessageException("0x80 response message internal payload is 0x..., connection lost")
+            raise ConnectionLostException("0x80 response message internal payload is 0x..., connection lost")
 
         # internal 0x55 payload?
         elif payload[0x21] != 0x55:
             logger.error("readResponse0x80: message no internal 0x55")
             self.clearMessage()
             # do not retry, end the session
-            raise UnexpectedMessageException("0x80 response message internal payload not a 0x55, connection lost")
+            raise ConnectionLostException("0x80 response message internal payload not a 0x55, connection lost")
 
         if len(payload) == 0x2E:
             # no pump response?
             if payload[0x24] == 0x00 and payload[0x25] == 0x00 and payload[0x26] == 0x02 and payload[0x27] == 0x00:
                 logger.warning("## readResponse0x80: message containing '55 0B 00 00 00 02 00 00 03 00 00' (no pump response)")
                 # stream is always clear after this message
-                raise UnexpectedMessageException("no response from pump")
+                raise NoPumpResponseException("no response from pump")
 
             # no connect response?
             elif payload[0x24] == 0x00 and payload[0x25] == 0x20 and payload[0x26] == 0x00 and payload[0x27] == 0x00:
@@ -1150,7 +1756,7 @@ class Medtronic600SeriesDriver( object ):
             logger.error("readResponse0x80: message containing '55 0D 00 00 00 02 00 00 02 00 01 XX XX' (lost pump connection)")
             self.clearMessage()
             # do not retry, end the session
-            raise UnexpectedMessageException("connection lost")
+            raise ConnectionLostException("connection lost")
 
         # connection
         elif len(payload) == 0x4F:
@@ -1166,7 +1772,7 @@ class Medtronic600SeriesDriver( object ):
                 logger.error("readResponse0x80: message containing non-standard network connect (lost pump connection)")
                 # stream is always clear after this message
                 # do not retry, end the session
-                raise UnexpectedMessageException("connection lost")
+                raise ConnectionLostException("connection lost")
 
         return BayerBinaryMessage.decode(payload)
 
@@ -1200,7 +1806,7 @@ class Medtronic600SeriesDriver( object ):
             logger.error("readResponse0x81: message size <= 0x21")
             self.clearMessage()
             # do not retry, end the session
-            raise UnexpectedMessageException("0x81 response was empty, connection lost")
+            raise ConnectionLostException("0x81 response was empty, connection lost")
 
         # message and internal payload size correct?
         elif len(payload) != (0x21 + payload[0x1C] & 0x00FF | payload[0x1D] << 8 & 0xFF00):
@@ -1258,6 +1864,7 @@ class Medtronic600SeriesDriver( object ):
          
     def getDeviceInfo( self ):
         logger.info("# Read Device Info")
+        self.phase = PROTOCOL_PHASE.DEVICE_INFO
         self.sendMessage( struct.pack( '>B', 0x58 ) )
 
         while True:
@@ -1285,7 +1892,11 @@ class Medtronic600SeriesDriver( object ):
                     logger.error(' ### getDeviceInfo: Expected to get an 0x{0:x} control character, got message with length {1} and control char 0x{1:x}'.format( controlChar, len( ctrl_msg ), ctrl_msg[0] ))
                     raise RuntimeError( 'Expected to get an 0x{0:x} control character, got message with length {1} and control char 0x{1:x}'.format( controlChar, len( ctrl_msg ), ctrl_msg[0] ) )
 
-                self.deviceInfo = astm.codec.decode( bytes( astm_msg ) )
+                # The ASTM header of a stick never changes, so it is only decoded once
+                astm_msg = bytes( astm_msg )
+                if astm_msg not in self.deviceInfoCache:
+                    self.deviceInfoCache[astm_msg] = astm.codec.decode( astm_msg )
+                self.deviceInfo = self.deviceInfoCache[astm_msg]
                 self.session.stickSerial = self.deviceSerial
 
                 break
@@ -1301,6 +1912,7 @@ class Medtronic600SeriesDriver( object ):
 
     def enterControlMode( self ):
         logger.info("# enterControlMode")
+        self.phase = PROTOCOL_PHASE.CONTROL
         self.sendMessage( struct.pack( '>B', ascii['NAK'] ) )
         self.checkControlMessage( ascii['EOT'] )
         self.sendMessage( struct.pack( '>B', ascii['ENQ'] ) )
@@ -1308,6 +1920,7 @@ class Medtronic600SeriesDriver( object ):
 
     def exitControlMode( self ):
         logger.info("# exitControlMode")
+        self.phase = PROTOCOL_PHASE.CONTROL
         try:
             self.sendMessage( struct.pack( '>B', ascii['EOT'] ) )
             self.checkControlMessage( ascii['ENQ'] )
@@ -1316,6 +1929,7 @@ class Medtronic600SeriesDriver( object ):
 
     def enterPassthroughMode( self ):
         logger.info("# enterPassthroughMode")
+        self.phase = PROTOCOL_PHASE.PASSTHROUGH
         self.sendMessage( struct.pack( '>2s', b'W|' ) )
         self.checkControlMessage( ascii['ACK'] )
         self.sendMessage( struct.pack( '>2s', b'Q|' ) )
@@ -1325,6 +1939,7 @@ class Medtronic600SeriesDriver( object ):
 
     def exitPassthroughMode( self ):
         logger.info("# exitPassthroughMode")
+        self.phase = PROTOCOL_PHASE.PASSTHROUGH
         try:
             self.sendMessage( struct.pack( '>2s', b'W|' ) )
             self.checkControlMessage( ascii['ACK'] )
@@ -1337,6 +1952,7 @@ class Medtronic600SeriesDriver( object ):
 
     def openConnection( self ):
         logger.info("# Request Open Connection")
+        self.phase = PROTOCOL_PHASE.CONNECTION
 
         mtMessage = binascii.unhexlify( self.session.HMAC )
         bayerMessage = BayerBinaryMessage( 0x10, self.session, mtMessage )
@@ -1345,7 +1961,9 @@ class Medtronic600SeriesDriver( object ):
 
     def closeConnection( self ):
         logger.info("# Request Close Connection")
+        self.phase = PROTOCOL_PHASE.CONNECTION
         try:
+            self.session.saveSequenceNumbers()
             mtMessage = binascii.unhexlify( self.session.HMAC )
             bayerMessage = BayerBinaryMessage( 0x11, self.session, mtMessage )
             self.sendMessage( bayerMessage.encode() )
@@ -1354,53 +1972,128 @@ class Medtronic600SeriesDriver( object ):
             logger.warning("Unexpected error by requestCloseConnection, ignoring", exc_info = True);
 
     def readInfo( self ):
+        config = self.session.config
+        if config.linkMAC and config.pumpMAC and config.key:
+            logger.info("# Using cached link and pump MAC")
+            self.session.linkMAC = config.linkMAC
+            self.session.pumpMAC = config.pumpMAC
+            self.session.credentialsFromCache = True
+        else:
+            self.requestInfo()
+
+    def requestInfo( self ):
         logger.info("# Request Read Info")
+        self.phase = PROTOCOL_PHASE.LINK_INFO
         bayerMessage = BayerBinaryMessage( 0x14, self.session )
         self.sendMessage( bayerMessage.encode() )
         response = BayerBinaryMessage.decode( self.readMessage() ) # The response is a 0x14 as well
         info = ReadInfoResponseMessage.decode( response.payload )
         self.session.linkMAC = info.linkMAC
         self.session.pumpMAC = info.pumpMAC
+        self.session.credentialsFromCache = False
+        self.session.config.storeInfo( info.linkMAC, info.pumpMAC )
 
     def readLinkKey( self ):
+        if self.session.credentialsFromCache:
+            logger.info("# Using cached link key")
+            self.session.KEY = binascii.unhexlify( self.session.config.key )
+        else:
+            self.requestLinkKey()
+        logger.debug("LINK KEY: {0}".format(binascii.hexlify(self.session.KEY)))
+
+    def requestLinkKey( self ):
         logger.info("# Request Read Link Key")
+        self.phase = PROTOCOL_PHASE.LINK_INFO
         bayerMessage = BayerBinaryMessage( 0x16, self.session )
         self.sendMessage( bayerMessage.encode() )
         response = BayerBinaryMessage.decode( self.readMessage() ) # The response is a 0x14 as well
         keyRequest = ReadLinkKeyResponseMessage.decode( response.payload )
         self.session.KEY = bytes(keyRequest.linkKey( self.session.stickSerial ))
-        logger.debug("LINK KEY: {0}".format(binascii.hexlify(self.session.KEY)))
+        self.session.config.key = binascii.hexlify( self.session.KEY ).decode( 'ascii' )
+
+    def refreshCredentials( self ):
+        # Read the MACs and link key from the CNL again and return True if they
+        # differ from the cached ones. This is a local exchange with the CNL,
+        # so it is much cheaper than another channel scan.
+        cached = ( self.session.linkMAC, self.session.pumpMAC, self.session.KEY )
+        self.requestInfo()
+        self.requestLinkKey()
+        return cached != ( self.session.linkMAC, self.session.pumpMAC, self.session.KEY )
 
     def negotiateChannel( self ):
+        try:
+            self.scanChannels()
+        except NegotiationException:
+            if not self.session.credentialsFromCache:
+                raise
+            logger.warning("Channel negotiation failed with cached credentials, reading them from the CNL")
+            if not self.refreshCredentials():
+                raise
+            self.scanChannels()
+
+    def rankedChannels( self ):
+        # Order the channels by expected time to connect, based on the decayed
+        # success rate and latencies observed for this stick. Without any
+        # statistics this is the last connected channel followed by the CareLink order.
+        stats = self.session.config.channelStats()
+        ranking = []
+        for order, channel in enumerate( [ self.session.config.lastRadioChannel ] + self.CHANNELS ):
+            if channel in [ c for c, _ in ranking ]:
+                continue
+            attempts, successes, successMs, failureMs, rssi = stats.get( channel, ( 0, 0, 0, 0, 0 ) )
+            failures = attempts - successes
+            # Laplace smoothing, so that channels without history still get tried
+            probability = ( successes + 1.0 ) / ( attempts + 2.0 )
+            meanSuccessMs = successMs / successes if successes > 0 else self.CHANNEL_DEFAULT_SUCCESS_MS
+            meanFailureMs = failureMs / failures if failures > 0 else self.READ_TIMEOUT_MS
+            costMs = probability * meanSuccessMs + ( 1 - probability ) * meanFailureMs
+            ranking.append( ( channel, ( -probability / costMs, -( rssi or 0 ), order ) ) )
+        return [ channel for channel, _ in sorted( ranking, key = lambda r: r[1] ) ]
+
+    def scanChannels( self ):
         logger.info("# Negotiate pump comms channel")
+        self.phase = PROTOCOL_PHASE.NEGOTIATE
 
-        # Scan the last successfully connected channel first, since this could save us negotiating time
-        for self.session.radioChannel in [ self.session.config.lastRadioChannel ] + self.CHANNELS:
-            logger.debug("Negotiating on channel {0}".format( self.session.radioChannel ))
-
-            mtMessage = ChannelNegotiateMessage( self.session )
+        results = []
+        self.session.radioChannel = None
+        try:
+            for channel in self.rankedChannels():
+                logger.debug("Negotiating on channel {0}".format( channel ))
+                self.session.radioChannel = channel
+                start = time.time()
+                rssi = None
+                try:
+                    mtMessage = ChannelNegotiateMessage( self.session )
 
-            bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
-            self.sendMessage( bayerMessage.encode() )
-            self.readResponse0x81()
-            response = self.readResponse0x80()
-            if len( response.payload ) > 13:
-                # Check that the channel ID matches
-                responseChannel = response.payload[43]
-                if self.session.radioChannel == responseChannel:
-                    break
-                else:
-                    raise UnexpectedMessageException( "Expected to get a message for channel {0}. Got {1}".format( self.session.radioChannel, responseChannel ) )
-            else:
-                self.session.radioChannel = None
+                    bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
+                    self.sendMessage( bayerMessage.encode() )
+                    self.readResponse0x81()
+                    response = self.readResponse0x80()
+                    if len( response.payload ) > 13:
+                        # Check that the channel ID matches
+                        responseChannel = response.payload[43]
+                        if channel == responseChannel:
+                            rssi = response.payload[26]
+                            break
+                        else:
+                            raise UnexpectedMessageException( "Expected to get a message for channel {0}. Got {1}".format( channel, responseChannel ) )
+                    else:
+                        self.session.radioChannel = None
+                finally:
+                    results.append( ( channel, rssi is not None, ( time.time() - start ) * 1000, rssi ) )
+        finally:
+            self.session.config.recordChannelResults( results, self.CHANNEL_STATS_DECAY )
 
         if not self.session.radioChannel:
             raise NegotiationException( 'Could not negotiate a comms channel with the pump. Are you near to the pump?' )
         else:
+            self.rssi = rssi
+            logger.info("Connected on channel {0}, RSSI {1}".format( self.session.radioChannel, self.rssi ))
             self.session.config.lastRadioChannel = self.session.radioChannel
 
     def beginEHSM( self ):
         logger.info("# Begin Extended High Speed Mode Session")
+        self.phase = PROTOCOL_PHASE.EHSM
         mtMessage = BeginEHSMMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1409,6 +2102,7 @@ class Medtronic600SeriesDriver( object ):
 
     def finishEHSM( self ):
         logger.info("# Finish Extended High Speed Mode Session")
+        self.phase = PROTOCOL_PHASE.EHSM
         try:
             mtMessage = FinishEHSMMessage( self.session )
 
@@ -1439,15 +2133,72 @@ class Medtronic600SeriesDriver( object ):
         while messageReceived == False:
             #message = self.getBayerBinaryMessage(0x80)
             message = self.readResponse0x80()
-            medMessage = MedtronicReceiveMessage.decode(message.payload, self.session)
+            try:
+                medMessage = MedtronicReceiveMessage.decode(message.payload, self.session)
+            except ChecksumException:
+                if self.session.credentialsFromCache and not self.session.credentialsVerified:
+                    # A single failure can be a transmission error. If the cached key never
+                    # works, most likely the pump was paired again: read the new key next time.
+                    failures = self.session.config.credentialFailures + 1
+                    if failures >= self.CREDENTIAL_FAILURE_LIMIT:
+                        logger.error("getMedtronicMessage: cached link key rejected, clearing credential cache")
+                        self.session.config.clearCredentials()
+                        raise CredentialsRejectedException( "Cached link key rejected" )
+                    logger.warning("getMedtronicMessage: decryption with cached link key failed ({0}/{1})".format( failures, self.CREDENTIAL_FAILURE_LIMIT ))
+                    self.session.config.credentialFailures = failures
+                raise
+            if not self.session.credentialsVerified:
+                self.session.credentialsVerified = True
+                if self.session.config.credentialFailures:
+                    self.session.config.credentialFailures = 0
+            # The pump occasionally sends a response more than once. A copy carries the same
+            # sequence number and content as the response before, so it can be dropped right away
+            responsePayload = bytes( medMessage.responsePayload )
+            if responsePayload == self.lastPumpResponse:
+                logger.warning("## getMedtronicMessage: dropped duplicated response with sequence number {0}".format(responsePayload[0]))
+                continue
+            self.lastPumpResponse = responsePayload
             if medMessage.messageType in expectedMessageTypes:
                 messageReceived = True
             else:
                 logger.warning("## getMedtronicMessage: waiting for message of [{0}], got 0x{1:x}".format(''.join('%04x '%i for i in expectedMessageTypes) , medMessage.messageType))
         return medMessage
 
+    @staticmethod
+    def isRetryable( exception ):
+        # A corrupted, unexpected or missing pump response leaves the link intact,
+        # so the request can simply be sent again. This includes history transfers
+        # with lost packets or broken blocks, they resume after the completed segments.
+        # Lost connections, rejected credentials and CNL (0x81) timeouts need a
+        # reconnect instead.
+        if isinstance( exception, ( ConnectionLostException, CredentialsRejectedException ) ):
+            return False
+        return isinstance( exception, ( NoPumpResponseException, ChecksumException, UnexpectedMessageException,
+                                        DataIncompleteError, ChecksumError ) )
+
+    def retryRequest( self, request, *args ):
+        # Runs a pump request like getPumpStatus() and repeats only this request
+        # within the open EHSM session if it failed in a retryable way
+        attempt = 0
+        lastException = None
+        while True:
+            try:
+                with cnl24trace.span( request.__name__, { 'attempt': attempt } if attempt else None ):
+                    return request( *args )
+            except Exception as e:
+                if attempt >= self.REQUEST_RETRIES or not self.isRetryable( e ):
+                    raise
+                # Two missing pump responses in a row mean the pump is out of range
+                if isinstance( e, NoPumpResponseException ) and isinstance( lastException, NoPumpResponseException ):
+                    raise
+                lastException = e
+                attempt += 1
+                self.requestRetries += 1
+                logger.warning("{0} failed ({1}: {2}), retry {3}/{4}".format( request.__name__, type( e ).__name__, e, attempt, self.REQUEST_RETRIES ))
+
     def getPumpTime( self ):
         logger.info("# Get Pump Time")
+        self.phase = PROTOCOL_PHASE.TIME
         mtMessage = PumpTimeRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1461,6 +2212,7 @@ class Medtronic600SeriesDriver( object ):
 
     def getPumpStatus( self ):
         logger.info("# Get Pump Status")
+        self.phase = PROTOCOL_PHASE.STATUS
         mtMessage = PumpStatusRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1471,6 +2223,7 @@ class Medtronic600SeriesDriver( object ):
 
     def getPumpHistoryInfo( self, dateStart, dateEnd, requestType = HISTORY_DATA_TYPE.PUMP_DATA ):
         logger.info("# Get Pump History Info")
+        self.phase = PROTOCOL_PHASE.HISTORY
         mtMessage = PumpHistoryInfoRequestMessage( self.session, dateStart, dateEnd, self.offset, requestType )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1479,18 +2232,56 @@ class Medtronic600SeriesDriver( object ):
         response = self.getMedtronicMessage([COM_D_COMMAND.READ_HISTORY_INFO_RESPONSE])
         return response
 
-    def getPumpHistory( self, expectedSize, dateStart, dateEnd, requestType = HISTORY_DATA_TYPE.PUMP_DATA ):
+    def getPumpHistory( self, expectedSize, dateStart, dateEnd, requestType = HISTORY_DATA_TYPE.PUMP_DATA, transfer = None ):
         logger.info("# Get Pump History")
-        allSegments = []
+        self.phase = PROTOCOL_PHASE.HISTORY
+        # A transfer with completed segments is resumed after the newest event it contains.
+        # Events at the resume time are received again, they are dropped by decodeEvents().
+        if transfer is None:
+            transfer = HistoryTransfer( requestType )
+        if transfer.resumeRtc is not None:
+            dateStart = DateTimeHelper.dateFromRtc( transfer.resumeRtc, self.offset )
+            logger.info("## getPumpHistory resuming after {0} segments from {1}".format( len( transfer.segments ), dateStart ))
+        transfer.completed = False
+        transfer.start()
+        try:
+            self.transferPumpHistory( transfer, dateStart, dateEnd, requestType )
+        finally:
+            transfer.stop()
+
+        logger.info("## getPumpHistory {0} bytes in {1:.1f} s ({2:.0f} bytes/s), {3} of {4} packets resent".format(
+            transfer.bytes, transfer.duration, transfer.bytesPerSecond, transfer.resentPackets, transfer.packets ))
+        return transfer.segments
+
+    def transferPumpHistory( self, transfer, dateStart, dateEnd, requestType ):
         mtMessage = PumpHistoryRequestMessage( self.session, dateStart, dateEnd, self.offset, requestType )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
         self.sendMessage( bayerMessage.encode() )
         self.readResponse0x81() 
 
+        segmentParams = None
+        packets = None
+        numPackets = 0
+        resendAttempts = 0
+        resentPackets = 0
+        resendEnd = None
         transmissionCompleted = False
         while transmissionCompleted != True:
-            responseSegment = self.getMedtronicMessage([COM_D_COMMAND.HIGH_SPEED_MODE_COMMAND, COM_D_COMMAND.INITIATE_MULTIPACKET_TRANSFER, COM_D_COMMAND.MULTIPACKET_SEGMENT_TRANSMISSION, COM_D_COMMAND.END_HISTORY_TRANSMISSION])
+            try:
+                responseSegment = self.getMedtronicMessage([COM_D_COMMAND.HIGH_SPEED_MODE_COMMAND, COM_D_COMMAND.INITIATE_MULTIPACKET_TRANSFER, COM_D_COMMAND.MULTIPACKET_SEGMENT_TRANSMISSION, COM_D_COMMAND.END_HISTORY_TRANSMISSION])
+            except NoPumpResponseException:
+                # Lost packets at the end of a segment are only noticed by the missing response
+                if packets is None or numPackets == 0:
+                    raise
+                logger.warning("## getPumpHistory no packet received, {0} of {1} packets missing".format(segmentParams.packetsToFetch - numPackets, segmentParams.packetsToFetch))
+                if resendAttempts >= HistoryTransfer.RESEND_ATTEMPTS:
+                    logger.error("## getPumpHistory packets still missing after {0} resend requests".format(resendAttempts))
+                    raise DataIncompleteError("History packets missing after {0} resend requests".format(resendAttempts))
+                resendAttempts += 1
+                resendEnd, packetCount = self.requestMissingPackets( packets )
+                resentPackets += packetCount
+                continue
 
             if responseSegment.messageType == COM_D_COMMAND.HIGH_SPEED_MODE_COMMAND:
                 logger.debug("## getPumpHistory consumed HIGH_SPEED_MODE_COMMAND")
@@ -1504,39 +2295,62 @@ class Medtronic600SeriesDriver( object ):
                 segmentParams = responseSegment
                 packets = [None] * responseSegment.packetsToFetch
                 numPackets = 0
+                resendAttempts = 0
+                resentPackets = 0
+                resendEnd = None
                 ackMessage = AckMultipacketRequestMessage(self.session, AckMultipacketRequestMessage.SEGMENT_COMMAND__INITIATE_TRANSFER)
                 bayerAckMessage = BayerBinaryMessage( 0x12, self.session, ackMessage.encode() )
                 self.sendMessage( bayerAckMessage.encode() )
                 self.readResponse0x81()
+                # A timeout while waiting for the packets means a lost packet
+                self.phase = PROTOCOL_PHASE.PACKET
 
             elif responseSegment.messageType == COM_D_COMMAND.MULTIPACKET_SEGMENT_TRANSMISSION:
                 logger.debug("## getPumpHistory got MULTIPACKET_SEGMENT_TRANSMISSION")
                 logger.debug("## getPumpHistory responseSegment.packetNumber: {0}".format(responseSegment.packetNumber))
-                if responseSegment.packetNumber != (segmentParams.packetsToFetch - 1) and len(responseSegment.payload) != segmentParams.packetSize:                
-                    logger.warning("## WARNING - packet length invalid, skipping. Expected {0}, got {1}, for packet {2}/{3}".format(segmentParams.packetSize, len(responseSegment.payload), responseSegment.packetNumber, responseSegment.segmentParams))
-                    continue
-                if responseSegment.packetNumber == segmentParams.packetsToFetch - 1 and len(responseSegment.payload) != segmentParams.lastPacketSize:                
-                    logger.warning("## WARNING - last packet length invalid, skipping. Expected {0}, got {1}, for packet {2}/{3}".format(segmentParams.lastPacketSize, len(responseSegment.payload), responseSegment.packetNumber, responseSegment.segmentParams))
+                if packets is None:
+                    logger.warning("## WARNING - packet {0} without segment, skipping".format(responseSegment.packetNumber))
                     continue
                 if responseSegment.packetNumber < 0 or responseSegment.packetNumber >= segmentParams.packetsToFetch:
-                    logger.warning("## WARNING - received packed out of expected range. Packet {2}/{3}".format(responseSegment.packetNumber, responseSegment.segmentParams))
-                    continue                    
+                    logger.warning("## WARNING - received packet out of expected range. Packet {0}/{1}".format(responseSegment.packetNumber, segmentParams.packetsToFetch))
+                    continue
+                if responseSegment.packetNumber != (segmentParams.packetsToFetch - 1) and len(responseSegment.payload) != segmentParams.packetSize:
+                    logger.warning("## WARNING - packet length invalid, skipping. Expected {0}, got {1}, for packet {2}/{3}".format(segmentParams.packetSize, len(responseSegment.payload), responseSegment.packetNumber, segmentParams.packetsToFetch))
+                    continue
+                if responseSegment.packetNumber == segmentParams.packetsToFetch - 1 and len(responseSegment.payload) != segmentParams.lastPacketSize:
+                    logger.warning("## WARNING - last packet length invalid, skipping. Expected {0}, got {1}, for packet {2}/{3}".format(segmentParams.lastPacketSize, len(responseSegment.payload), responseSegment.packetNumber, segmentParams.packetsToFetch))
+                    continue
+                transfer.bytes += len(responseSegment.payload)
                 if packets[responseSegment.packetNumber] == None:
                     numPackets = numPackets + 1
-                    packets[responseSegment.packetNumber] = responseSegment.payload
+                    packets[responseSegment.packetNumber] = bytes(responseSegment.payload)
+                    # Only resend requests without any progress count as failed
+                    resendAttempts = 0
                 else:
                     logger.warning("## WARNING - packet duplicated")
 
                 if numPackets == segmentParams.packetsToFetch:
                     logger.debug("## All packets there")
-                    logger.debug("## Requesting next segment")
-                    allSegments.append(packets)
+                    transfer.checkpoint( packets, self.iterPumpSegment( packets, transfer.requestType ), resentPackets )
+                    transfer.resentPackets += resentPackets
+                    packets = None
+                    self.phase = PROTOCOL_PHASE.HISTORY
+
+                    # Pace the request of the next segment by the packet loss seen so far
+                    if transfer.ackDelayMs:
+                        time.sleep( transfer.ackDelayMs / 1000.0 * self.reader.timeScale )
 
                     #request next segment
+                    logger.debug("## Requesting next segment")
                     ackMessage = AckMultipacketRequestMessage(self.session, AckMultipacketRequestMessage.SEGMENT_COMMAND__SEND_NEXT_SEGMENT)
                     bayerAckMessage = BayerBinaryMessage( 0x12, self.session, ackMessage.encode() )
                     self.sendMessage( bayerAckMessage.encode() )
                     self.readResponse0x81()
+                elif responseSegment.packetNumber == ( segmentParams.packetsToFetch - 1 if resendEnd is None else resendEnd ):
+                    # The pump sends the packets in order, so after the last requested
+                    # packet everything still missing was lost
+                    resendEnd, packetCount = self.requestMissingPackets( packets )
+                    resentPackets += packetCount
             elif responseSegment.messageType == COM_D_COMMAND.END_HISTORY_TRANSMISSION:
                 logger.debug("## getPumpHistory got END_HISTORY_TRANSMISSION")
                 transmissionCompleted = True
@@ -1545,92 +2359,134 @@ class Medtronic600SeriesDriver( object ):
                 logger.warning("## getPumpHistory response.messageType: {0:x}".format(responseSegment.messageType))
 
         if transmissionCompleted:
-            return allSegments
+            transfer.completed = True
         else:
             logger.error("Transmission finished, but END_HISTORY_TRANSMISSION did not arrive")
             raise DataIncompleteError("Transmission finished, but END_HISTORY_TRANSMISSION did not arrive")
 
-    def decodePumpSegment(self, encodedFragmentedSegment, historyType = HISTORY_DATA_TYPE.PUMP_DATA):
-        decodedBlocks = []
-        segmentPayload = encodedFragmentedSegment[0]
+    def requestMissingPackets( self, packets ):
+        # Requests the first run of missing packets and returns its last packet number and size.
+        # Only one run is requested at a time, the resent packets would otherwise arrive while
+        # the CNL response to the next request is read.
+        packetNumber, packetCount = HistoryTransfer.missingRanges( packets )[0]
+        logger.warning("## getPumpHistory requesting resend of {0} packets from packet {1}".format(packetCount, packetNumber))
+        resendMessage = MultipacketResendPacketsMessage( self.session, packetNumber, packetCount )
+        bayerResendMessage = BayerBinaryMessage( 0x12, self.session, resendMessage.encode() )
+        self.sendMessage( bayerResendMessage.encode() )
+        self.readResponse0x81()
+        return packetNumber + packetCount - 1, packetCount
 
-        for idx in range(1, len(encodedFragmentedSegment)):
-            segmentPayload+= encodedFragmentedSegment[idx]
+    def decodePumpSegment(self, encodedFragmentedSegment, historyType = HISTORY_DATA_TYPE.PUMP_DATA):
+        # Returns all blocks of the segment, the checksums are verified in one go
+        blockPayload = self.decodeSegmentPayload(encodedFragmentedSegment, historyType)
+        brokenBlocks = cnl24codec.verifyHistoryBlocks(blockPayload)
+        if brokenBlocks:
+            raise ChecksumError('Unexpected checksum in blocks {0}'.format(brokenBlocks))
+        return list(cnl24codec.iterHistoryBlocks(blockPayload, verify = False))
+
+    def iterPumpSegment(self, encodedFragmentedSegment, historyType = HISTORY_DATA_TYPE.PUMP_DATA):
+        # Yields the blocks of the segment as views of one buffer, each after its checksum was verified
+        blockPayload = self.decodeSegmentPayload(encodedFragmentedSegment, historyType)
+        try:
+            for block in cnl24codec.iterHistoryBlocks(blockPayload):
+                yield block
+        except ValueError as e:
+            logger.error('Unexpected checksum in block {0}: expected 0x{2:04x}, calculated 0x{1:04x}'.format(*e.args))
+            raise ChecksumError('Unexpected checksum in block')
+
+    def decodeSegmentPayload(self, encodedFragmentedSegment, historyType):
+        segmentPayload = cnl24codec.joinPackets(encodedFragmentedSegment)
+        HEADER_SIZE = cnl24codec.HISTORY_SEGMENT_HEADER.size
+        if len(segmentPayload) < HEADER_SIZE:
+            raise InvalidMessageError('Unknown history response message type')
 
         # Decompress the message
-        if struct.unpack( '>H', segmentPayload[0:2])[0] == 0x030E:
-            HEADER_SIZE = 12
-            BLOCK_SIZE = 2048
-            # It's an UnmergedHistoryUpdateCompressed response. We need to decompress it
-            dataType = struct.unpack('>B', segmentPayload[2:3])[0] # Returns a HISTORY_DATA_TYPE
-            historySizeCompressed = struct.unpack( '>I', segmentPayload[3:7])[0] #segmentPayload.readUInt32BE(0x03)
-            logger.debug("Compressed: {0}".format(historySizeCompressed))
-            historySizeUncompressed = struct.unpack( '>I', segmentPayload[7:11])[0] #segmentPayload.readUInt32BE(0x07)
-            logger.debug("Uncompressed: {0}".format(historySizeUncompressed)) 
-            historyCompressed = struct.unpack('>B', segmentPayload[11:12])[0]
-            logger.debug("IsCompressed: {0}".format(historyCompressed))
-
-            if dataType != historyType: # Check HISTORY_DATA_TYPE (PUMP_DATA: 2, SENSOR_DATA: 3)
-                logger.error('History type in response: {0} {1}'.format(type(dataType), dataType))
-                raise InvalidMessageError('Unexpected history type in response')
-
-            # Check that we have the correct number of bytes in this message
-            if len(segmentPayload) - HEADER_SIZE != historySizeCompressed:
-                raise InvalidMessageError('Unexpected message size')
-
-
-            blockPayload = None
-            if historyCompressed > 0:
-                blockPayload = lzo.decompress(segmentPayload[HEADER_SIZE:], False, historySizeUncompressed)
-            else:
-                blockPayload = segmentPayload[HEADER_SIZE:]
-
+        messageType, dataType, historySizeCompressed, historySizeUncompressed, historyCompressed = \
+            cnl24codec.HISTORY_SEGMENT_HEADER.unpack_from(segmentPayload, 0)
+        if messageType != COM_D_COMMAND.UNMERGED_HISTORY_RESPONSE:
+            raise InvalidMessageError('Unknown history response message type')
 
-            if len(blockPayload) % BLOCK_SIZE != 0:
-                raise InvalidMessageError('Block payload size is not a multiple of 2048')
+        # It's an UnmergedHistoryUpdateCompressed response. We need to decompress it
+        logger.debug("Compressed: {0}".format(historySizeCompressed))
+        logger.debug("Uncompressed: {0}".format(historySizeUncompressed))
+        logger.debug("IsCompressed: {0}".format(historyCompressed))
 
+        if dataType != historyType: # Check HISTORY_DATA_TYPE (PUMP_DATA: 2, SENSOR_DATA: 3)
+            logger.error('History type in response: {0} {1}'.format(type(dataType), dataType))
+            raise InvalidMessageError('Unexpected history type in response')
 
-            for i in range (0, len(blockPayload) // BLOCK_SIZE):
-                blockSize = struct.unpack('>H', blockPayload[(i + 1) * BLOCK_SIZE - 4 : (i + 1) * BLOCK_SIZE - 2])[0] #blockPayload.readUInt16BE(((i + 1) * ReadHistoryCommand.BLOCK_SIZE) - 4)
-                blockChecksum = struct.unpack('>H', blockPayload[(i + 1) * BLOCK_SIZE - 2 : (i + 1) * BLOCK_SIZE])[0] #blockPayload.readUInt16BE(((i + 1) * ReadHistoryCommand.BLOCK_SIZE) - 2)
+        # Check that we have the correct number of bytes in this message
+        if len(segmentPayload) - HEADER_SIZE != historySizeCompressed:
+            raise InvalidMessageError('Unexpected message size')
 
-                blockStart = i * BLOCK_SIZE
-                blockData = blockPayload[blockStart : blockStart + blockSize]
-                calculatedChecksum = MedtronicMessage.calculateCcitt(blockData)
-                if blockChecksum != calculatedChecksum:
-                    raise ChecksumError('Unexpected checksum in block')
-                else:
-                    decodedBlocks.append(blockData) 
+        if historyCompressed > 0:
+            # python-lzo has no streaming interface, the segment is decompressed as a whole
+            blockPayload = lzo.decompress(bytes(segmentPayload[HEADER_SIZE:]), False, historySizeUncompressed)
         else:
-            raise InvalidMessageError('Unknown history response message type')
+            blockPayload = memoryview(segmentPayload)[HEADER_SIZE:]
+
+        if len(blockPayload) % cnl24codec.HISTORY_BLOCK_SIZE != 0:
+            raise InvalidMessageError('Block payload size is not a multiple of 2048')
 
-        return decodedBlocks
+        return blockPayload
 
-    # for next time.....
     def decodeEvents(self, decodedBlocks):
-        eventList = []
-        for page in decodedBlocks:
-            pos = 0;
+        # Events which were received twice by a resumed history transfer are dropped
+        return list(cnl24history.iterNestedEvents(cnl24history.iterEvents(decodedBlocks)))
 
-            while pos < len(page):
-                eventSize = struct.unpack('>B', page[pos + 2 : pos + 3])[0] # page[pos + 2];
-                eventData = page[pos : pos + eventSize] # page.slice(pos, pos + eventSize);
-                pos += eventSize
-                eventList.extend(NGPHistoryEvent(eventData).eventInstance().allNestedEvents())
-        return eventList
+    def iterPumpHistory( self, historySegments, historyType = HISTORY_DATA_TYPE.PUMP_DATA):
+        # Yields the history events one at a time, without keeping them in memory
+        blocks = ( block for segment in historySegments for block in self.iterPumpSegment(segment, historyType) )
+        return cnl24history.iterNestedEvents(cnl24history.iterEvents(blocks))
+
+    def decodeSensorHistory( self, historySegments, drift = None ):
+        # Decodes the readings of a SENSOR_DATA history into columns (NumPy arrays if available)
+        blocks = ( block for segment in historySegments for block in self.iterPumpSegment(segment, HISTORY_DATA_TYPE.SENSOR_DATA) )
+        return cnl24history.decodeSensorColumns(blocks, drift)
 
     def processPumpHistory( self, historySegments, historyType = HISTORY_DATA_TYPE.PUMP_DATA):
-        historyEvents = []
-        for segment in historySegments:
-            decodedBlocks = self.decodePumpSegment(segment, historyType)
-            historyEvents += self.decodeEvents(decodedBlocks) 
+        historyEvents = list(self.iterPumpHistory(historySegments, historyType))
         for event in historyEvents:
             event.postProcess(historyEvents)
         return historyEvents
 
 
+    def getSettingsResponse( self, mtMessage, responseType ):
+        # The settings requests are single request/response exchanges like the status request
+        self.phase = PROTOCOL_PHASE.REQUEST
+        bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
+        self.sendMessage( bayerMessage.encode() )
+        self.readResponse0x81()
+        return self.getMedtronicMessage([responseType])
+
+    def getBasalPattern( self, patternNumber ):
+        logger.info("# Get Basal Pattern {0}".format( patternNumber ))
+        return self.getSettingsResponse( PumpBasalPatternRequestMessage( self.session, patternNumber ),
+                                         COM_D_COMMAND.READ_BASAL_PATTERN_RESPONSE )
+
+    def getCarbRatios( self ):
+        logger.info("# Get Carb Ratios")
+        return self.getSettingsResponse( PumpCarbRatiosRequestMessage( self.session ),
+                                         COM_D_COMMAND.READ_BOLUS_WIZARD_CARB_RATIOS_RESPONSE )
+
+    def getSensitivityFactors( self ):
+        logger.info("# Get Sensitivity Factors")
+        return self.getSettingsResponse( PumpSensitivityFactorsRequestMessage( self.session ),
+                                         COM_D_COMMAND.READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_RESPONSE )
+
+    def getBgTargets( self ):
+        logger.info("# Get BG Targets")
+        return self.getSettingsResponse( PumpBgTargetsRequestMessage( self.session ),
+                                         COM_D_COMMAND.READ_BOLUS_WIZARD_BG_TARGETS_RESPONSE )
+
+    def getDeviceCharacteristics( self ):
+        logger.info("# Get Device Characteristics")
+        return self.getSettingsResponse( DeviceCharacteristicsRequestMessage( self.session ),
+                                         COM_D_COMMAND.DEVICE_CHARACTERISTICS_RESPONSE )
+
     def getTempBasalStatus( self ):
         logger.info("# Get Temp Basal Status")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = PumpTempBasalRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1641,6 +2497,7 @@ class Medtronic600SeriesDriver( object ):
 
     def getBolusesStatus( self ):
         logger.info("# Get Boluses Status")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = PumpBolusesRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1651,6 +2508,7 @@ class Medtronic600SeriesDriver( object ):
 
     def getBasicParameters( self ):
         logger.info("# Get Basic Parameters")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = BasicNgpParametersRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1661,6 +2519,7 @@ class Medtronic600SeriesDriver( object ):
 
     def do405Message( self, pumpDateTime ):
         logger.info("# Send Message Type 405")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = Type405RequestMessage( self.session, pumpDateTime )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1671,6 +2530,7 @@ class Medtronic600SeriesDriver( object ):
 
     def do124Message( self, pumpDateTime ):
         logger.info("# Send Message Type 124")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = Type124RequestMessage( self.session, pumpDateTime )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1681,6 +2541,7 @@ class Medtronic600SeriesDriver( object ):
 
     def doRemoteBolus( self, bolusID, amount, execute ):
         logger.info("# Execute Remote Bolus")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = PumpRemoteBolusRequestMessage( self.session, bolusID, amount, execute )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1691,6 +2552,7 @@ class Medtronic600SeriesDriver( object ):
 
     def doRemoteSuspend( self ):
         logger.info("# Execute Remote Suspend")
+        self.phase = PROTOCOL_PHASE.REQUEST
         mtMessage = SuspendResumeRequestMessage( self.session )
 
         bayerMessage = BayerBinaryMessage( 0x12, self.session, mtMessage.encode() )
@@ -1748,9 +2610,172 @@ def downloadPumpSession(downloadOperations):
     return pumpData
 
 
+class PersistentSession( object ):
+    # Handshake stages in the order they are established, together with the
+    # driver method which tears them down again (None if there is nothing to undo)
+    STAGES = [ ( 'openDevice',           'closeDevice' ),
+               ( 'getDeviceInfo',        None ),
+               ( 'enterControlMode',     'exitControlMode' ),
+               ( 'enterPassthroughMode', 'exitPassthroughMode' ),
+               ( 'openConnection',       'closeConnection' ),
+               ( 'readInfo',             None ),
+               ( 'readLinkKey',          None ),
+               ( 'negotiateChannel',     None ),
+               ( 'beginEHSM',            'finishEHSM' ) ]
+
+    # First stage which involves the radio link to the pump. Everything before
+    # is local to the CNL and survives the pump going out of range.
+    RADIO_STAGE = 7
+    # Stage which loads the MACs and link key
+    CREDENTIALS_STAGE = 5
+
+    def __init__( self, driverFactory = Medtronic600SeriesDriver ):
+        self.driverFactory = driverFactory
+        self.mt = None
+        self.stage = 0 # Number of established stages
+
+        # Statistics, kept across reconnects
+        self.requestRetries = 0
+        self.clearedMessages = 0
+        self.stageDurations = {} # Duration of the last run of each stage (s)
+        self.radioChannel = None
+        self.rssi = None
+
+        # Unfinished history transfers, resumed after a reconnect
+        self.historyTransfers = {}
+
+    @property
+    def isOpen( self ):
+        return self.stage == len( self.STAGES )
+
+    # Problems of the radio link or the pump messages, the CNL itself is fine
+    RADIO_EXCEPTIONS = ( ChecksumException, UnexpectedMessageException, NegotiationException,
+                         InvalidMessageError, ChecksumError, DataIncompleteError )
+
+    def recoveryStage( self, failedStage, exception ):
+        # Radio problems only need the pump connection to be renegotiated.
+        # Anything else, e.g. USB level problems, missing 0x81 responses or an
+        # unexpected error, leaves the CNL in an unknown state, so start over
+        # from scratch.
+        if isinstance( exception, CredentialsRejectedException ):
+            return self.CREDENTIALS_STAGE
+        if not isinstance( exception, self.RADIO_EXCEPTIONS ) or failedStage < self.RADIO_STAGE:
+            return 0
+        return self.RADIO_STAGE
+
+    def dropTo( self, stage ):
+        if self.mt is not None:
+            # The finish sequence must not be cut short by an expired deadline
+            # or a cancel(), otherwise the CNL is left in its modes
+            self.mt.deadline = None
+            self.mt.resetCancel()
+        while self.stage > stage:
+            self.stage -= 1
+            exitMethod = self.STAGES[self.stage][1]
+            if exitMethod:
+                try:
+                    getattr( self.mt, exitMethod )()
+                except Exception:
+                    logger.warning("PersistentSession: error in {0}, ignoring".format( exitMethod ), exc_info = True)
+        if self.stage == 0 and self.mt is not None:
+            self.requestRetries += self.mt.requestRetries
+            self.clearedMessages += self.mt.clearedMessages
+            self.mt = None
+
+    def open( self ):
+        if self.mt is None:
+            self.mt = self.driverFactory()
+
+        while not self.isOpen:
+            stageName = self.STAGES[self.stage][0]
+            logger.debug("PersistentSession: establishing stage {0}".format( stageName ))
+            start = time.time()
+            try:
+                with cnl24trace.span( stageName ):
+                    getattr( self.mt, stageName )()
+            except Exception as e:
+                logger.error("PersistentSession: stage {0} failed".format( stageName ))
+                self.dropTo( self.recoveryStage( self.stage, e ) )
+                raise
+            self.stage += 1
+            self.stageDurations[stageName] = time.time() - start
+            if stageName == 'getDeviceInfo':
+                logger.info("Device serial: {0}".format( self.mt.deviceSerial ))
+            elif stageName == 'negotiateChannel':
+                self.radioChannel = self.mt.session.radioChannel
+                self.rssi = self.mt.rssi
+
+        return self.mt
+
+    def close( self ):
+        self.dropTo( 0 )
+
+    def cancel( self ):
+        # Aborts a running download from another thread, e.g. a signal handler
+        if self.mt is not None:
+            self.mt.cancel()
+
+    def download( self, downloadOperations, deadline = None ):
+        if self.mt is None:
+            self.mt = self.driverFactory()
+        self.mt.deadline = deadline
+        try:
+            self.open()
+            # We need to read always the pump time to store the offset for later messeging
+            self.mt.retryRequest( self.mt.getPumpTime )
+            return downloadOperations( self.mt )
+        except Exception as e:
+            logger.error("PersistentSession: download failed")
+            self.dropTo( self.recoveryStage( len( self.STAGES ), e ) )
+            raise
+        finally:
+            if self.mt is not None:
+                self.mt.deadline = None
+                self.mt.session.saveSequenceNumbers()
+
+    def run( self, downloadOperations, timeout = None ):
+        # timeout limits the whole call including reconnects (in seconds)
+        deadline = None if timeout is None else time.time() + timeout
+        reused = self.isOpen
+        with cnl24trace.span( 'session', { 'reused': reused } if cnl24trace.tracer.enabled else None ):
+            try:
+                return self.download( downloadOperations, deadline )
+            except CancelledException:
+                raise
+            except Exception:
+                if not reused or self.stage == 0:
+                    raise
+                # The pump may have dropped the link while we were idle,
+                # so renegotiate once before giving up on this cycle
+                logger.warning("PersistentSession: link to pump lost since last cycle, renegotiating")
+                return self.download( downloadOperations, deadline )
+
+    def statistics( self ):
+        # Counters since the session was created and the state of the last handshake
+        mt = self.mt
+        return { 'requestRetries': self.requestRetries + ( mt.requestRetries if mt is not None else 0 ),
+                 'clearedMessages': self.clearedMessages + ( mt.clearedMessages if mt is not None else 0 ),
+                 'stageDurations': dict( self.stageDurations ),
+                 'radioChannel': self.radioChannel,
+                 'rssi': self.rssi,
+                 'phaseLatencies': Medtronic600SeriesDriver.timeouts.summary() }
+
+    def readLiveData( self, timeout = None ):
+        return self.run( statusDownload, timeout )
+
+    def readHistoryData( self, timeout = None ):
+        return self.run( lambda mt: historyDownload( mt, self.historyTransfers ), timeout )
+
+    def readHistorySince( self, syncState, historyType = HISTORY_DATA_TYPE.PUMP_DATA, timeout = None, until = None ):
+        return self.run( lambda mt: historySyncDownload( mt, syncState, historyType, until, self.historyTransfers ), timeout )
+
+    def readSettings( self, timeout = None ):
+        return self.run( settingsDownload, timeout )
+
+
 def statusDownload(mt):
     
-    status = mt.getPumpStatus()
+    status = mt.retryRequest( mt.getPumpStatus ).snapshot
 
     print ("\n### Serial ###")
     print ("CNL serial: {0}\n".format(mt.deviceSerial))
@@ -1815,93 +2840,122 @@ def statusDownload(mt):
     
     result = { # CNL serial
                "serial":mt.deviceSerial,
+               "pumpSerial":"{0}".format(mt.session.pumpSerial),
                
                # Pump time
                "pumpTime":mt.pumpTime,
-               "pumpTimeDrift":mt.pumpTimeDrift,
-               
-               # Pump status
-               "pumpStatus":{"suspended":status.isPumpStatusSuspended,
-                             "bolusingNormal":status.isPumpStatusBolusingNormal,
-                             "bolusingSquare":status.isPumpStatusBolusingSquare,
-                             "bolusingDual":status.isPumpStatusBolusingDual,
-                             "deliveringInsulin":status.isPumpStatusDeliveringInsulin,
-                             "tempBasalActive":status.isPumpStatusTempBasalActive,
-                             "cgmActive":status.isPumpStatusCgmActive},
-               
-               # Pump alert
-               "pumpAlert":{"alertOnHigh":status.isPlgmAlertOnHigh,
-                            "alertOnLow":status.isPlgmAlertOnLow,
-                            "alertBeforeHigh":status.isPlgmAlertBeforeHigh,
-                            "alertBeforeLow":status.isPlgmAlertBeforeLow,
-                            "alertSuspend":status.isPlgmAlertSuspend,
-                            "alertSuspendLow":status.islgmAlertSuspendLow},
-               "alert":status.alert,
-               "alertDate":status.alertDate,
-               "isAlertSilenceHigh":status.isAlertSilenceHigh,
-               "isAlertSilenceHighLow":status.isAlertSilenceHighLow,
-               "isAlertSilenceAll":status.isAlertSilenceAll,
-               "alertSilenceMinutesRemaining":status.alertSilenceMinutesRemaining,
-               
-               # Sensor status
-               "sensorStatus":{"calibrating":status.isSensorStatusCalibrating,
-                               "calibrationComplete":status.isSensorStatusCalibrationComplete,
-                               "exception":status.isSensorStatusException},
-               "sensorCalMinutesRemaining":status.sensorCalMinutesRemaining,
-               "sensorBatteryLevelPercentage":status.sensorBatteryLevelPercentage,
-               "sensorRateOfChange":status.sensorRateOfChange,
-               
-               # Bolus
-               "bolusingDelivered":status.bolusingDelivered,
-               "bolusingMinutesRemaining":status.bolusingMinutesRemaining,
-               "bolusingReference":status.bolusingReference,
-               "lastBolusAmount":status.lastBolusAmount,
-               "lastBolusTime":status.lastBolusTime,
-               "lastBolusReference":status.lastBolusReference,
-               "recentBolusWizard":status.recentBolusWizard,
-               "recentBGL":status.recentBGL,
-               
-               # Basal
-               "activeBasalPattern":status.activeBasalPattern,
-               "activeTempBasalPattern":status.activeTempBasalPattern,
-               "currentBasalRate":status.currentBasalRate,
-               "tempBasalRate":status.tempBasalRate,
-               "tempBasalPercentage":status.tempBasalPercentage,
-               "tempBasalMinutesRemaining":status.tempBasalMinutesRemaining,
-               "basalUnitsDeliveredToday":status.basalUnitsDeliveredToday,
-               
-               # Battery
-               "batteryLevelPercentage":status.batteryLevelPercentage,
-               
-               # Insulin
-               "insulinUnitsRemaining":status.insulinUnitsRemaining,
-               "minutesOfInsulinRemaining":status.minutesOfInsulinRemaining,
-               "activeInsulin":status.activeInsulin,
-               
-               # BGL
-               "sensorBGL":status.sensorBGL,
-               "sensorBGLTimestamp":status.sensorBGLTimestamp,
-               "trendArrow":status.trendArrow
+               "pumpTimeDrift":mt.pumpTimeDrift
              }
+    result.update( status.to_dict() )
 
     return result
 
 
-def historyDownload(mt):
+def historyDownload(mt, transfers = None):
+    # transfers keeps an interrupted transfer for the next call (see HistoryTransfer.resume())
     
     start_date = datetime.datetime.now() - datetime.timedelta(days=1)
-    historyInfo = mt.getPumpHistoryInfo(start_date, datetime.datetime.max, HISTORY_DATA_TYPE.PUMP_DATA)
+    historyInfo = mt.retryRequest(mt.getPumpHistoryInfo, start_date, datetime.datetime.max, HISTORY_DATA_TYPE.PUMP_DATA)
     # print (binascii.hexlify( historyInfo.responsePayload,  ))
     
     print ("pumpStart:                {0}".format(historyInfo.datetimeStart))
     print ("pumpEnd:                  {0}".format(historyInfo.datetimeEnd))
     print ("pumpSize:                 {0}\n".format(historyInfo.historySize))
     
-    # FIXME: History download is not working reliably yet
-    #print ("Getting Pump history")
-    #history_pages = mt.getPumpHistory(historyInfo.historySize, start_date, datetime.datetime.max, HISTORY_DATA_TYPE.PUMP_DATA)
-   
-    return 0
+    print ("Getting Pump history")
+    # A failed transfer is retried with the same transfer object, so it resumes after the completed segments
+    transfer = HistoryTransfer.resume({} if transfers is None else transfers, "{0}".format(mt.session.pumpSerial),
+                                      HISTORY_DATA_TYPE.PUMP_DATA, time.mktime(start_date.timetuple()))
+    history_pages = mt.retryRequest(mt.getPumpHistory, historyInfo.historySize, start_date, datetime.datetime.max, HISTORY_DATA_TYPE.PUMP_DATA, transfer)
+
+    print ("historySegments:          {0}".format(len(history_pages)))
+    print ("historyBytesPerSecond:    {0:.0f}".format(transfer.bytesPerSecond))
+    print ("historyResendRatio:       {0:.3f}\n".format(transfer.resendRatio))
+
+    return history_pages
+
+
+HISTORY_SYNC_MAX_DAYS = 1 # Oldest history which is read when the last sync is older or unknown
+
+def historySyncDownload(mt, syncState, historyType = HISTORY_DATA_TYPE.PUMP_DATA, until = None, transfers = None):
+    # Reads only the history events which are newer than the last sync of this pump
+    # (and older than until, seconds since the epoch, if given).
+    # The caller stores "syncedUntil" in syncState once the events were uploaded.
+    # transfers keeps an interrupted transfer for the next call (see HistoryTransfer.resume()).
+    # The readings of a SENSOR_DATA history are returned as columns (decodeSensorHistory()) in
+    # "sensorColumns", the events of other history types in "events".
+    pumpSerial = "{0}".format(mt.session.pumpSerial)
+    lastSync = syncState.lastSync(pumpSerial, historyType)
+    oldest = time.time() - HISTORY_SYNC_MAX_DAYS * 86400
+    if lastSync is None or lastSync < oldest:
+        since = oldest
+    else:
+        since = lastSync
+    # The pump expects its local wall clock time
+    start_date = datetime.datetime.fromtimestamp(since)
+
+    historyInfo = mt.retryRequest(mt.getPumpHistoryInfo, start_date, datetime.datetime.max, historyType)
+    print ("historySince:             {0}".format(start_date))
+    print ("historySize:              {0}".format(historyInfo.historySize))
+
+    events = []
+    sensorColumns = None
+    segments = []
+    if historyInfo.historySize > 0:
+        transfer = HistoryTransfer.resume({} if transfers is None else transfers, pumpSerial, historyType, since)
+        segments = mt.retryRequest(mt.getPumpHistory, historyInfo.historySize, start_date, datetime.datetime.max, historyType, transfer)
+    # The pump sends complete blocks, which also contain older events
+    if historyType == HISTORY_DATA_TYPE.SENSOR_DATA:
+        sensorColumns = cnl24history.selectSensorColumns(mt.decodeSensorHistory(segments), since, until)
+        times = sensorColumns["timestamp"]
+    else:
+        events = [ event for event in mt.iterPumpHistory(segments, historyType)
+                   if event.epochTime > since and (until is None or event.epochTime < until) ]
+        times = [ event.epochTime for event in events ]
+    print ("historyEvents:            {0}\n".format(len(times)))
+
+    return {
+               "serial":mt.deviceSerial,
+               "pumpSerial":pumpSerial,
+               "historyType":historyType,
+               "pumpTimeDrift":mt.pumpTimeDrift,
+               "events":events,
+               "sensorColumns":sensorColumns,
+               "syncedUntil":float(max(times)) if len(times) > 0 else since,
+           }
+
+
+BASAL_PATTERNS = range(1, 9) # Pattern 1-5, Work Day, Day Off, Sick Day
+
+def settingsDownload(mt):
+    # Reads the pump settings which are kept in the PumpSettingsCache.
+    # Only the content of the settings goes into the result, so that its
+    # hash only changes with the settings.
+    device = mt.retryRequest(mt.getDeviceCharacteristics)
+    basalPatterns = []
+    for number in BASAL_PATTERNS:
+        rates = mt.retryRequest(mt.getBasalPattern, number).rates
+        if len(rates) > 0:
+            basalPatterns.append({ "number":number, "rates":rates })
+    carbRatios = mt.retryRequest(mt.getCarbRatios).carbRatios
+    sensitivityFactors = mt.retryRequest(mt.getSensitivityFactors).sensitivityFactors
+    bgTargets = mt.retryRequest(mt.getBgTargets).bgTargets
+
+    print ("### Pump settings ###")
+    print ("deviceSerial:             {0}".format(device.serial))
+    print ("basalPatterns:            {0}".format([ pattern["number"] for pattern in basalPatterns ]))
+    print ("carbRatios:               {0}".format(len(carbRatios)))
+    print ("sensitivityFactors:       {0}".format(len(sensitivityFactors)))
+    print ("bgTargets:                {0}\n".format(len(bgTargets)))
+
+    return {
+               "pumpSerial":"{0}".format(mt.session.pumpSerial),
+               "deviceSerial":device.serial,
+               "basalPatterns":basalPatterns,
+               "carbRatios":carbRatios,
+               "sensitivityFactors":sensitivityFactors,
+               "bgTargets":bgTargets,
+           }
 
 
 def readLiveData():
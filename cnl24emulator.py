@@ -0,0 +1,606 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 emulator
+#
+#  Description:
+#
+#    This is an in-process emulator of the Contour Next Link 2.4 USB radio
+#    bridge together with a Medtronic Minimed 670G insulin pump. It offers
+#    the same interface as the hid.device object used by the CNL2.4 driver,
+#    so the driver can be run and measured without the real hardware:
+#
+#      emulator = Cnl24Emulator()
+#      mt = Medtronic600SeriesDriver( deviceFactory = emulator.device )
+#
+#    The emulator speaks the real protocol (ASTM device info, control and
+#    passthrough mode, Bayer envelopes, AES encrypted Medtronic messages,
+#    channel negotiation, EHSM, time and status requests and multipacket
+#    history transfers). USB and radio latencies are configurable.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#    17/10/2026: Optionally send pump responses more than once
+#    17/10/2026: Lose history packets, resend them on request
+#    17/10/2026: Answer the pump settings requests
+#
+###############################################################################
+
+import binascii
+import datetime
+import random
+import struct
+import threading
+import time
+import Crypto.Cipher.AES # pip install PyCrypto
+
+ascii= {
+    'STX' : 0x02,
+    'ETX' : 0x03,
+    'EOT' : 0x04,
+    'ENQ' : 0x05,
+    'ACK' : 0x06,
+    'LF'  : 0x0A,
+    'CR'  : 0x0D,
+    'NAK' : 0x15,
+    'ETB' : 0x17
+}
+
+# Base time of the pump RTC is midnight 1st Jan 2000 (UTC)
+PUMP_BASE_TIME = 946684800
+
+def ccitt( data ):
+    return binascii.crc_hqx( data, 0xffff )
+
+class EMU_COMMAND:
+    HIGH_SPEED_MODE_COMMAND = 0x0412
+    TIME_REQUEST = 0x0403
+    TIME_RESPONSE = 0x0407
+    READ_PUMP_STATUS_REQUEST = 0x0112
+    READ_PUMP_STATUS_RESPONSE = 0x013C
+    READ_BASAL_PATTERN_REQUEST = 0x0116
+    READ_BASAL_PATTERN_RESPONSE = 0x0123
+    READ_BOLUS_WIZARD_CARB_RATIOS_REQUEST = 0x012B
+    READ_BOLUS_WIZARD_CARB_RATIOS_RESPONSE = 0x012C
+    READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_REQUEST = 0x012E
+    READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_RESPONSE = 0x012F
+    READ_BOLUS_WIZARD_BG_TARGETS_REQUEST = 0x0131
+    READ_BOLUS_WIZARD_BG_TARGETS_RESPONSE = 0x0132
+    DEVICE_CHARACTERISTICS_REQUEST = 0x0200
+    DEVICE_CHARACTERISTICS_RESPONSE = 0x0201
+    READ_HISTORY_REQUEST = 0x0304
+    END_HISTORY_TRANSMISSION = 0x030A
+    READ_HISTORY_INFO_REQUEST = 0x030C
+    READ_HISTORY_INFO_RESPONSE = 0x030D
+    UNMERGED_HISTORY_RESPONSE = 0x030E
+    INITIATE_MULTIPACKET_TRANSFER = 0xFF00
+    MULTIPACKET_SEGMENT_TRANSMISSION = 0xFF01
+    MULTIPACKET_RESEND_PACKETS = 0xFF02
+    ACK_MULTIPACKET_COMMAND = 0x00FE
+
+class EmulatedPump( object ):
+    """Synthetic pump state which is served by the emulator"""
+
+    def __init__( self, serial = 'NG1234567K', mac = 0x0023F70000ABCDEF, channel = 0x11, rssi = 0x60 ):
+        self.serial = serial
+        self.mac = mac
+        self.channel = channel
+        self.rssi = rssi
+        self.inRange = True
+        self.clockDriftSeconds = 0
+        self.rtcOffset = -0x5F000000 # Pump RTC offsets are always negative
+
+        self.status = { "suspended":0, "bolusingNormal":0, "bolusingSquare":0, "bolusingDual":0,
+                        "deliveringInsulin":1, "tempBasalActive":0, "cgmActive":1,
+                        "bolusingDelivered":0.0, "bolusingMinutesRemaining":0, "bolusingReference":0,
+                        "lastBolusAmount":2.5, "lastBolusMinutesAgo":42, "lastBolusReference":17,
+                        "activeBasalPattern":1, "activeTempBasalPattern":0,
+                        "currentBasalRate":0.8, "tempBasalRate":0.0, "tempBasalPercentage":0,
+                        "tempBasalMinutesRemaining":0, "basalUnitsDeliveredToday":7.25,
+                        "batteryLevelPercentage":75, "insulinUnitsRemaining":123.5,
+                        "minutesOfInsulinRemaining":2880, "activeInsulin":1.275,
+                        "sensorBGL":123, "sensorBGLMinutesAgo":2,
+                        "alertFlags":0, "trendByte":0x60, "sensorStatusFlags":0,
+                        "sensorCalMinutesRemaining":300, "sensorBatteryRaw":0x0C,
+                        "sensorRateOfChange":0.5, "recentBolusWizard":0, "recentBGL":0,
+                        "alert":0, "alertMinutesAgo":600, "alertSilenceFlags":0, "alertSilenceMinutesRemaining":0 }
+
+        # Settings, start times in minutes after midnight (multiples of 30)
+        self.basalPatterns = { 1: [ ( 0, 0.8 ), ( 360, 1.1 ), ( 1320, 0.9 ) ], 2: [ ( 0, 0.7 ) ] }
+        self.carbRatios = [ ( 0, 12.0 ), ( 660, 10.0 ) ]                   # ( start, g/U )
+        self.sensitivityFactors = [ ( 0, 50 ) ]                            # ( start, mg/dL per U )
+        self.bgTargets = [ ( 0, 100, 120 ) ]                               # ( start, low, high mg/dL )
+
+        # Raw history events per history data type, see the event builders below
+        self.history = { 0x02: [], 0x03: [] }
+
+    def localEpoch( self ):
+        # The pump clock shows local wall clock time
+        now = time.time() + self.clockDriftSeconds
+        return now + ( datetime.datetime.fromtimestamp( now ) - datetime.datetime.utcfromtimestamp( now ) ).total_seconds()
+
+    def rtcAt( self, minutesAgo = 0 ):
+        return int( self.localEpoch() - minutesAgo * 60 - PUMP_BASE_TIME - self.rtcOffset ) & 0xffffffff
+
+    def encodedDateTime( self, minutesAgo = 0 ):
+        return ( self.rtcAt( minutesAgo ) << 32 ) | ( self.rtcOffset & 0xffffffff )
+
+    def eventHeader( self, eventType, size, minutesAgo ):
+        return struct.pack( '>BBBIi', eventType, 0x01, size, self.rtcAt( minutesAgo ), self.rtcOffset )
+
+    # History event builders. They return the raw event bytes as stored by the pump.
+
+    def bgReadingEvent( self, minutesAgo, bgValue, source = 0x01 ):
+        body = struct.pack( '>BHB', 0x00, bgValue, source ) + b'\x00' * 10
+        return self.eventHeader( 0x32, 11 + len( body ), minutesAgo ) + body
+
+    def normalBolusDeliveredEvent( self, minutesAgo, amount, bolusNumber, activeInsulin = 0.0 ):
+        body = struct.pack( '>BBBIII', 0x01, bolusNumber, 0x00, int( amount * 10000 ), int( amount * 10000 ), int( activeInsulin * 10000 ) )
+        return self.eventHeader( 0xDC, 11 + len( body ), minutesAgo ) + body
+
+    def tempBasalProgrammedEvent( self, minutesAgo, rate, percentage, duration, preset = 0 ):
+        basalType = 1 if percentage else 0
+        body = struct.pack( '>BBIBH', preset, basalType, int( rate * 10000 ), percentage, duration )
+        return self.eventHeader( 0x1B, 11 + len( body ), minutesAgo ) + body
+
+    def insulinDeliveryStoppedEvent( self, minutesAgo, reason = 0x01 ):
+        return self.eventHeader( 0x1E, 12, minutesAgo ) + struct.pack( '>B', reason )
+
+    def insulinDeliveryRestartedEvent( self, minutesAgo, reason = 0x01 ):
+        return self.eventHeader( 0x1F, 12, minutesAgo ) + struct.pack( '>B', reason )
+
+    def bolusWizardEstimateEvent( self, minutesAgo, bgInput, carbInput, isf, carbRatio, lowTarget, highTarget,
+                                  correction, food, iob, estimate, final ):
+        body = struct.pack( '>BHHHIHHiIIIIBBI', 0x00, bgInput, carbInput, isf, int( carbRatio * 10 ), lowTarget, highTarget,
+                            int( correction * 10000 ), int( food * 10000 ), int( iob * 10000 ), 0,
+                            int( estimate * 10000 ), 0x02, 0x00, int( final * 10000 ) )
+        return self.eventHeader( 0x3D, 11 + len( body ), minutesAgo ) + body
+
+    def sensorReadingsEvent( self, minutesAgo, readings, interval = 5 ):
+        # readings: list of ( sgv, isig, rateOfChange ), newest first
+        body = struct.pack( '>BBH', interval, len( readings ), readings[0][0] if readings else 0 )
+        for sgv, isig, rateOfChange in readings:
+            body += struct.pack( '>BBHBhBB', ( sgv >> 8 ) & 0x03, sgv & 0xFF, int( isig * 100 ), 0,
+                                 int( rateOfChange * 100 ), 0x00, 0x00 )
+        return self.eventHeader( 0xD6, 11 + len( body ), minutesAgo ) + body
+
+    # Settings responses, mmol/L values are derived from mg/dL
+
+    def basalPatternPayload( self, patternNumber ):
+        rates = self.basalPatterns.get( patternNumber, [] )
+        return struct.pack( '>BB', patternNumber, len( rates ) ) + b''.join(
+            struct.pack( '>IB', int( round( rate * 10000 ) ), start // 30 ) for start, rate in rates )
+
+    def carbRatiosPayload( self ):
+        return struct.pack( '>B', len( self.carbRatios ) ) + b''.join(
+            struct.pack( '>IIB', int( round( grams * 10 ) ), int( round( 15000 / grams ) ), start // 30 ) for start, grams in self.carbRatios )
+
+    def sensitivityFactorsPayload( self ):
+        return struct.pack( '>B', len( self.sensitivityFactors ) ) + b''.join(
+            struct.pack( '>HHB', mgdl, int( round( mgdl / 1.8 ) ), start // 30 ) for start, mgdl in self.sensitivityFactors )
+
+    def bgTargetsPayload( self ):
+        return struct.pack( '>B', len( self.bgTargets ) ) + b''.join(
+            struct.pack( '>HHHHB', high, int( round( high / 1.8 ) ), low, int( round( low / 1.8 ) ), start // 30 )
+            for start, low, high in self.bgTargets )
+
+    def deviceCharacteristicsPayload( self ):
+        return struct.pack( '>10sQ', self.serial.encode( 'ascii' ), self.mac ) + b'\x00' * 16
+
+    def statusPayload( self ):
+        s = self.status
+        statusByte = ( s["suspended"] | s["bolusingNormal"] << 1 | s["bolusingSquare"] << 2 | s["bolusingDual"] << 3 |
+                       s["deliveringInsulin"] << 4 | s["tempBasalActive"] << 5 | s["cgmActive"] << 6 )
+        return struct.pack( '>BI4xHBxIIBxBIIBHIBIBBIHQBBBxHBhBHHQBH',
+            statusByte,
+            int( s["bolusingDelivered"] * 10000 ),
+            s["bolusingMinutesRemaining"],
+            s["bolusingReference"],
+            int( s["lastBolusAmount"] * 10000 ),
+            # The last bolus time is sent with the RTC offset already applied
+            ( self.rtcAt( s["lastBolusMinutesAgo"] ) + self.rtcOffset ) & 0xffffffff,
+            s["lastBolusReference"],
+            ( s["activeTempBasalPattern"] << 4 ) | s["activeBasalPattern"],
+            int( s["currentBasalRate"] * 10000 ),
+            int( s["tempBasalRate"] * 10000 ),
+            s["tempBasalPercentage"],
+            s["tempBasalMinutesRemaining"],
+            int( s["basalUnitsDeliveredToday"] * 10000 ),
+            s["batteryLevelPercentage"],
+            int( s["insulinUnitsRemaining"] * 10000 ),
+            s["minutesOfInsulinRemaining"] // 60,
+            s["minutesOfInsulinRemaining"] % 60,
+            int( s["activeInsulin"] * 10000 ),
+            s["sensorBGL"],
+            self.encodedDateTime( s["sensorBGLMinutesAgo"] ),
+            s["alertFlags"],
+            s["trendByte"],
+            s["sensorStatusFlags"],
+            s["sensorCalMinutesRemaining"],
+            s["sensorBatteryRaw"],
+            int( s["sensorRateOfChange"] * 100 ),
+            s["recentBolusWizard"],
+            s["recentBGL"],
+            s["alert"],
+            self.encodedDateTime( s["alertMinutesAgo"] ),
+            s["alertSilenceFlags"],
+            s["alertSilenceMinutesRemaining"] )
+
+class Cnl24Emulator( object ):
+    USB_BLOCKSIZE = 64
+    MAGIC_HEADER = b'ABC'
+    BLOCK_SIZE = 2048
+
+    def __init__( self, stickSerial = '6213-1234567', linkMAC = 0x0023F745EE9E3E4B, linkKey = None, pump = None,
+                  usbLatencyMs = 1, radioLatencyMs = 20, packetIntervalMs = 2, timeScale = 1.0,
+                  packetSize = 0x80, blocksPerSegment = 2, duplicateResponses = 0, packetLoss = 0.0, lossSeed = 0 ):
+        self.stickSerial = stickSerial
+        self.linkMAC = linkMAC
+        self.linkKey = linkKey or bytes( bytearray( range( 0x10, 0x20 ) ) )
+        self.pump = pump or EmulatedPump()
+
+        self.usbLatencyMs = usbLatencyMs
+        self.radioLatencyMs = radioLatencyMs
+        self.packetIntervalMs = packetIntervalMs
+        self.timeScale = timeScale # Applied to all emulated waits, including read timeouts
+        self.packetSize = packetSize
+        self.blocksPerSegment = blocksPerSegment
+        self.duplicateResponses = duplicateResponses # Extra copies of every pump response, as seen on busy channels
+        self.packetLoss = packetLoss # Probability that a history packet is lost on the radio link
+        self.lossRandom = random.Random( lossSeed )
+
+        self.lock = threading.Condition()
+        self.isOpen = False
+        self.reset()
+
+    def reset( self ):
+        self.reports = []          # ( ready time, report bytes )
+        self.readyAt = 0
+        self.incoming = bytearray()
+        self.bayerSequenceNumber = 1
+        self.controlMode = False
+        self.passthroughMode = False
+        self.connected = False
+        self.networkChannel = None
+        self.highSpeedMode = False
+        self.pendingSegments = []
+        self.stats = { 'writes': 0, 'reads': 0, 'messages': 0, 'timeouts': 0, 'lostPackets': 0, 'resentPackets': 0, 'settingsRequests': 0 }
+
+    def device( self ):
+        # Used as deviceFactory for the driver, every open starts with a fresh USB state
+        return self
+
+    # hid.device interface
+
+    def open( self, vendorId = None, productId = None, serial_number = None ):
+        with self.lock:
+            self.reset()
+            self.isOpen = True
+
+    def open_path( self, path ):
+        self.open()
+
+    def close( self ):
+        with self.lock:
+            self.isOpen = False
+            self.lock.notify_all()
+
+    def get_manufacturer_string( self ):
+        return u'Bayer HealthCare LLC'
+
+    def get_product_string( self ):
+        return u'Contour Next Link 2.4'
+
+    def get_serial_number_string( self ):
+        return u''
+
+    def write( self, data ):
+        data = bytearray( data )
+        if not self.isOpen:
+            raise IOError( 'device not open' )
+        if bytes( data[0:3] ) != self.MAGIC_HEADER:
+            raise IOError( 'invalid USB packet' )
+        with self.lock:
+            self.stats['writes'] += 1
+            self.incoming.extend( data[4:4 + data[3]] )
+            self.processIncoming()
+        return len( data )
+
+    def read( self, max_length, timeout_ms = 0 ):
+        deadline = time.time() + timeout_ms / 1000.0 * self.timeScale
+        with self.lock:
+            while True:
+                if not self.isOpen:
+                    raise IOError( 'device not open' )
+                now = time.time()
+                if self.reports and self.reports[0][0] <= now:
+                    self.stats['reads'] += 1
+                    return list( self.reports.pop( 0 )[1][:max_length] )
+                waitUntil = deadline
+                if self.reports:
+                    waitUntil = min( waitUntil, self.reports[0][0] )
+                if now >= deadline and timeout_ms > 0 or timeout_ms == 0:
+                    self.stats['timeouts'] += 1
+                    return []
+                self.lock.wait( max( waitUntil - now, 0.0005 ) )
+
+    # Outgoing data
+
+    def queueMessage( self, payload, latencyMs ):
+        # Messages are delivered in order, each one not before its own latency has passed
+        self.readyAt = max( self.readyAt, time.time() + latencyMs / 1000.0 * self.timeScale )
+        for i in range( 0, max( len( payload ), 1 ), 60 ):
+            chunk = payload[i:i + 60]
+            report = bytearray( self.MAGIC_HEADER ) + bytearray( [ len( chunk ) ] ) + chunk
+            report.extend( b'\x00' * ( self.USB_BLOCKSIZE - len( report ) ) )
+            self.reports.append( ( self.readyAt, bytes( report ) ) )
+        self.stats['messages'] += 1
+        self.lock.notify_all()
+
+    def bayerMessage( self, operation, payload = b'' ):
+        envelope = struct.pack( '<BB6s10sBI5sI', 0x51, 3, b'000000', b'\x00' * 10,
+                                operation, self.bayerSequenceNumber, b'\x00' * 5, len( payload ) )
+        self.bayerSequenceNumber += 1
+        checksum = ( sum( bytearray( envelope ) ) + sum( bytearray( payload ) ) ) & 0xff
+        return bytearray( envelope ) + bytearray( [ checksum ] ) + bytearray( payload )
+
+    def queueBayer( self, operation, payload, latencyMs ):
+        self.queueMessage( self.bayerMessage( operation, payload ), latencyMs )
+
+    def queue0x81( self, sequence ):
+        payload = b'\x55\x0d\x00\x04\x00\x00\x00\x00\x03\x00\x01' + struct.pack( '<BB', sequence & 0xff, 0x02 )
+        self.queueBayer( 0x81, payload + struct.pack( '<H', ccitt( payload ) ), self.usbLatencyMs )
+
+    def queue0x80( self, payload ):
+        self.queueBayer( 0x80, payload, self.radioLatencyMs )
+
+    def queueNoPumpResponse( self ):
+        payload = b'\x55\x0b\x00\x00\x00\x02\x00\x00\x03\x00\x00'
+        self.queue0x80( payload + struct.pack( '<H', ccitt( payload ) ) )
+
+    # Incoming data
+
+    def processIncoming( self ):
+        while self.incoming:
+            if len( self.incoming ) >= 2 and self.incoming[0] == 0x51 and self.incoming[1] == 0x03:
+                if len( self.incoming ) < 33:
+                    return
+                size = 33 + struct.unpack_from( '<I', bytes( self.incoming ), 28 )[0]
+                if len( self.incoming ) < size:
+                    return
+                message = bytes( self.incoming[0:size] )
+                del self.incoming[0:size]
+                self.handleBayer( message )
+            else:
+                message = bytes( self.incoming )
+                del self.incoming[:]
+                self.handleControl( message )
+
+    def handleControl( self, message ):
+        if message == b'\x58':
+            self.queueMessage( self.astmHeader(), self.usbLatencyMs )
+            self.queueMessage( bytearray( [ ascii['ENQ'] ] ), self.usbLatencyMs )
+        elif message == bytes( bytearray( [ ascii['NAK'] ] ) ):
+            self.queueMessage( bytearray( [ ascii['EOT'] ] ), self.usbLatencyMs )
+        elif message == bytes( bytearray( [ ascii['ENQ'] ] ) ):
+            self.controlMode = True
+            self.queueMessage( bytearray( [ ascii['ACK'] ] ), self.usbLatencyMs )
+        elif message == bytes( bytearray( [ ascii['EOT'] ] ) ):
+            if self.controlMode:
+                self.controlMode = False
+                self.queueMessage( bytearray( [ ascii['ENQ'] ] ), self.usbLatencyMs )
+        elif message in ( b'W|', b'Q|', b'1|', b'0|' ):
+            if message == b'1|':
+                self.passthroughMode = True
+            elif message == b'0|':
+                self.passthroughMode = False
+            self.queueMessage( bytearray( [ ascii['ACK'] ] ), self.usbLatencyMs )
+
+    def astmHeader( self ):
+        record = ( b'1H|\\^&||kVYm4W|Bayer7350^01.10\\01.04\\02.05\\02.05^' + self.stickSerial.encode( 'ascii' ) +
+                   b'^0000-^0000-|A^C^G^I^M^R^S^V^X^a^b|||P|1|' +
+                   datetime.datetime.now().strftime( '%Y%m%d%H%M%S' ).encode( 'ascii' ) )
+        frame = record + bytearray( [ ascii['ETB'] ] )
+        checksum = ( '%02X' % ( sum( bytearray( frame ) ) & 0xFF ) ).encode( 'ascii' )
+        return bytearray( [ ascii['STX'] ] ) + frame + checksum + b'\r\n'
+
+    def handleBayer( self, message ):
+        operation = bytearray( message )[18]
+        payload = message[33:]
+        if operation == 0x10:
+            self.connected = True
+            self.queueBayer( 0x10, b'', self.usbLatencyMs )
+        elif operation == 0x11:
+            self.connected = False
+            self.networkChannel = None
+            self.queueBayer( 0x11, b'', self.usbLatencyMs )
+        elif operation == 0x14:
+            self.queueBayer( 0x14, struct.pack( '>QQ', self.linkMAC, self.pump.mac ), self.usbLatencyMs )
+        elif operation == 0x16:
+            self.queueBayer( 0x16, self.packedLinkKey(), self.usbLatencyMs )
+        elif operation == 0x12:
+            self.handleMedtronic( payload )
+
+    def packedLinkKey( self ):
+        # Inverse of ReadLinkKeyResponseMessage.linkKey(): every key byte is followed
+        # by a flag byte, bit 0 inverts the key byte, bit 1 selects a step of 2 instead of 3
+        packed = bytearray( ( i * 37 + 11 ) & 0xFF for i in range( 55 ) )
+        pos = ord( self.stickSerial[-1:] ) & 7
+        for i, keyByte in enumerate( bytearray( self.linkKey ) ):
+            invert = i % 2
+            shortStep = 1 if i % 3 == 0 else 0
+            packed[pos] = ( ~keyByte & 0xFF ) if invert else keyByte
+            packed[pos + 1] = invert | ( shortStep << 1 )
+            pos += 2 if shortStep else 3
+        return bytes( packed )
+
+    # Medtronic messages
+
+    def cipher( self ):
+        iv = bytearray( [ self.networkChannel ] ) + bytearray( self.linkKey[1:] )
+        return Crypto.Cipher.AES.new( key = self.linkKey, mode = Crypto.Cipher.AES.MODE_CFB, IV = bytes( iv ), segment_size = 128 )
+
+    def handleMedtronic( self, message ):
+        commandAction = bytearray( message )[0]
+        body = message[2:-2]
+        if struct.unpack( '<H', message[-2:] )[0] != ccitt( message[:-2] ):
+            return
+
+        if commandAction == 0x03:
+            self.queue0x81( 0 )
+            channel = bytearray( body )[1]
+            if self.pump.inRange and channel == self.pump.channel:
+                self.networkChannel = channel
+                self.queue0x80( self.networkConnectPayload( channel ) )
+            else:
+                payload = b'\x55\x0b\x00\x00\x20\x00\x00\x00\x03\x00\x00'
+                self.queue0x80( payload + struct.pack( '<H', ccitt( payload ) ) )
+
+        elif commandAction == 0x05:
+            pumpMAC, mmSequence, modeFlags, length = struct.unpack( '<QBBB', body[0:11] )
+            clear = self.cipher().decrypt( body[11:11 + length] )
+            if struct.unpack( '>H', clear[-2:] )[0] != ccitt( clear[:-2] ):
+                return
+            sequence, messageType = struct.unpack( '>BH', clear[0:3] )
+            self.queue0x81( mmSequence )
+            if not self.pump.inRange or self.networkChannel is None:
+                self.queueNoPumpResponse()
+                return
+            self.handlePumpRequest( sequence, messageType, clear[3:-2] )
+
+    def networkConnectPayload( self, channel ):
+        payload = ( b'\x55\x2c\x00\x04' + struct.pack( '>I', self.pump.mac & 0xffffffff )[0:4] + b'\x00' + b'\x02' +
+                    struct.pack( '<Q', self.pump.mac ) + b'\x82' + b'\x00' * 5 + b'\x07\x00' +
+                    struct.pack( '<B', self.pump.rssi ) + struct.pack( '<Q', self.linkMAC ) + b'\x42' + b'\x00' * 7 +
+                    struct.pack( '<B', channel ) )
+        return payload + struct.pack( '<H', ccitt( payload ) )
+
+    def pumpResponse( self, sequence, messageType, body ):
+        responsePayload = struct.pack( '>BH', sequence, messageType ) + body
+        clear = responsePayload + struct.pack( '>H', ccitt( responsePayload ) )
+        # Fields of the response envelope are not evaluated by the driver
+        responseEnvelope = struct.pack( '>BQ', 0x00, self.pump.mac ) + b'\x00' * 13
+        medPayload = responseEnvelope + self.cipher().encrypt( clear )
+        message = struct.pack( '<BB', 0x55, len( medPayload ) + 2 ) + medPayload
+        return message + struct.pack( '<H', ccitt( message ) )
+
+    def queuePumpResponse( self, sequence, messageType, body, latencyMs = None ):
+        payload = self.pumpResponse( sequence, messageType, body )
+        for _ in range( 1 + self.duplicateResponses ):
+            self.queueBayer( 0x80, payload, self.radioLatencyMs if latencyMs is None else latencyMs )
+
+    def handlePumpRequest( self, sequence, messageType, body ):
+        if messageType == EMU_COMMAND.HIGH_SPEED_MODE_COMMAND:
+            self.highSpeedMode = bytearray( body )[0] == 0x00
+
+        elif messageType == EMU_COMMAND.TIME_REQUEST:
+            self.queuePumpResponse( sequence, EMU_COMMAND.TIME_RESPONSE,
+                                    struct.pack( '>BQ', 0x01, self.pump.encodedDateTime() ) )
+
+        elif messageType == EMU_COMMAND.READ_PUMP_STATUS_REQUEST:
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_PUMP_STATUS_RESPONSE, self.pump.statusPayload() )
+
+        elif messageType == EMU_COMMAND.READ_BASAL_PATTERN_REQUEST:
+            self.stats['settingsRequests'] += 1
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_BASAL_PATTERN_RESPONSE,
+                                    self.pump.basalPatternPayload( bytearray( body )[0] ) )
+
+        elif messageType == EMU_COMMAND.READ_BOLUS_WIZARD_CARB_RATIOS_REQUEST:
+            self.stats['settingsRequests'] += 1
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_BOLUS_WIZARD_CARB_RATIOS_RESPONSE, self.pump.carbRatiosPayload() )
+
+        elif messageType == EMU_COMMAND.READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_REQUEST:
+            self.stats['settingsRequests'] += 1
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_BOLUS_WIZARD_SENSITIVITY_FACTORS_RESPONSE,
+                                    self.pump.sensitivityFactorsPayload() )
+
+        elif messageType == EMU_COMMAND.READ_BOLUS_WIZARD_BG_TARGETS_REQUEST:
+            self.stats['settingsRequests'] += 1
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_BOLUS_WIZARD_BG_TARGETS_RESPONSE, self.pump.bgTargetsPayload() )
+
+        elif messageType == EMU_COMMAND.DEVICE_CHARACTERISTICS_REQUEST:
+            self.stats['settingsRequests'] += 1
+            self.queuePumpResponse( sequence, EMU_COMMAND.DEVICE_CHARACTERISTICS_RESPONSE,
+                                    self.pump.deviceCharacteristicsPayload() )
+
+        elif messageType == EMU_COMMAND.READ_HISTORY_INFO_REQUEST:
+            dataType, _, fromRtc, toRtc, _ = struct.unpack( '>BBIIH', body[0:12] )
+            events = self.historyEvents( dataType, fromRtc, toRtc )
+            size = len( self.historyBlocks( events ) )
+            startRtc = min( [ struct.unpack_from( '>I', e, 3 )[0] for e in events ] or [ fromRtc ] )
+            endRtc = max( [ struct.unpack_from( '>I', e, 3 )[0] for e in events ] or [ toRtc ] )
+            offset = self.pump.rtcOffset & 0xffffffff
+            self.queuePumpResponse( sequence, EMU_COMMAND.READ_HISTORY_INFO_RESPONSE,
+                                    struct.pack( '>BIQQ', 0x00, size, startRtc << 32 | offset, endRtc << 32 | offset ) )
+
+        elif messageType == EMU_COMMAND.READ_HISTORY_REQUEST:
+            dataType, _, fromRtc, toRtc, _ = struct.unpack( '>BBIIH', body[0:12] )
+            self.pendingSegments = self.historySegments( dataType, self.historyEvents( dataType, fromRtc, toRtc ) )
+            self.queuePumpResponse( sequence, EMU_COMMAND.HIGH_SPEED_MODE_COMMAND, b'\x00' )
+            self.queueNextSegment( sequence )
+
+        elif messageType == EMU_COMMAND.ACK_MULTIPACKET_COMMAND:
+            segmentCommand = struct.unpack( '>H', body[0:2] )[0]
+            if segmentCommand == EMU_COMMAND.INITIATE_MULTIPACKET_TRANSFER:
+                self.queueSegmentPackets( sequence )
+            elif segmentCommand == EMU_COMMAND.MULTIPACKET_SEGMENT_TRANSMISSION:
+                self.pendingSegments.pop( 0 )
+                self.queueNextSegment( sequence )
+
+        elif messageType == EMU_COMMAND.MULTIPACKET_RESEND_PACKETS:
+            packetNumber, packetCount = struct.unpack( '>HH', body[0:4] )
+            if self.pendingSegments:
+                self.stats['resentPackets'] += packetCount
+                self.queueSegmentPackets( sequence, range( packetNumber, packetNumber + packetCount ) )
+
+    # History
+
+    def historyEvents( self, dataType, fromRtc, toRtc ):
+        return [ e for e in self.pump.history.get( dataType, [] )
+                 if fromRtc <= struct.unpack_from( '>I', e, 3 )[0] <= toRtc ]
+
+    def historyBlocks( self, events ):
+        # Events are packed into 2048 byte blocks, each ending with the used size and a CCITT checksum
+        blocks = bytearray()
+        block = bytearray()
+        for event in events:
+            if len( block ) + len( event ) > self.BLOCK_SIZE - 4:
+                blocks += self.finishBlock( block )
+                block = bytearray()
+            block += event
+        if block:
+            blocks += self.finishBlock( block )
+        return blocks
+
+    def finishBlock( self, block ):
+        return block + b'\x00' * ( self.BLOCK_SIZE - 4 - len( block ) ) + struct.pack( '>HH', len( block ), ccitt( bytes( block ) ) )
+
+    def historySegments( self, dataType, events ):
+        blocks = self.historyBlocks( events )
+        segments = []
+        segmentBytes = self.blocksPerSegment * self.BLOCK_SIZE
+        for start in range( 0, len( blocks ), segmentBytes ):
+            data = bytes( blocks[start:start + segmentBytes] )
+            header = struct.pack( '>HBIIB', EMU_COMMAND.UNMERGED_HISTORY_RESPONSE, dataType, len( data ), len( data ), 0 )
+            segments.append( header + data )
+        return segments
+
+    def queueNextSegment( self, sequence ):
+        if not self.pendingSegments:
+            self.queuePumpResponse( sequence, EMU_COMMAND.END_HISTORY_TRANSMISSION, b'' )
+            return
+        segment = self.pendingSegments[0]
+        packets = ( len( segment ) + self.packetSize - 1 ) // self.packetSize
+        lastPacketSize = len( segment ) - ( packets - 1 ) * self.packetSize
+        self.queuePumpResponse( sequence, EMU_COMMAND.INITIATE_MULTIPACKET_TRANSFER,
+                                struct.pack( '>IHHH', len( segment ), self.packetSize, lastPacketSize, packets ) )
+
+    def queueSegmentPackets( self, sequence, packetNumbers = None ):
+        segment = self.pendingSegments[0]
+        packets = ( len( segment ) + self.packetSize - 1 ) // self.packetSize
+        for number in ( packetNumbers if packetNumbers is not None else range( packets ) ):
+            if self.packetLoss and self.lossRandom.random() < self.packetLoss:
+                self.stats['lostPackets'] += 1
+                continue
+            data = segment[number * self.packetSize:( number + 1 ) * self.packetSize]
+            self.queuePumpResponse( sequence, EMU_COMMAND.MULTIPACKET_SEGMENT_TRANSMISSION,
+                                    struct.pack( '>H', number ) + data, self.packetIntervalMs )
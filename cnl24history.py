@@ -0,0 +1,312 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 pump history decoder
+#
+#  Description:
+#
+#    Decodes the NGP history events of the Medtronic 600 series pump from
+#    the 2048 byte blocks of a history segment. Events are produced by
+#    generators one at a time, so that the memory use does not depend on
+#    the length of the history. Each event type has a precompiled layout,
+#    the event body is only unpacked when one of its fields is used.
+#    Sensor readings can also be decoded into columns with NumPy.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#    17/10/2026: Trend arrow of sensor readings
+#    17/10/2026: Vectorized decoding of sensor readings into NumPy columns
+#    17/10/2026: Keep event times as seconds since the epoch, convert them with cnl24time
+#    17/10/2026: Select and iterate sensor reading columns for the history sync
+#
+###############################################################################
+
+import collections
+import struct
+try:
+    import numpy  # pip install numpy - optional, for decodeSensorColumns()
+except ImportError:
+    numpy = None
+from helpers import DateTimeHelper
+import cnl24time
+
+class NGP_HISTORY_EVENT_TYPE:
+    TEMP_BASAL_PROGRAMMED = 0x1B
+    INSULIN_DELIVERY_STOPPED = 0x1E
+    INSULIN_DELIVERY_RESTARTED = 0x1F
+    TEMP_BASAL_COMPLETE = 0x22
+    BLOOD_GLUCOSE_READING = 0x32
+    BOLUS_WIZARD_ESTIMATE = 0x3D
+    SENSOR_GLUCOSE_READINGS_EXTENDED = 0xD6
+    NORMAL_BOLUS_DELIVERED = 0xDC
+
+# Event header: type, source, size, RTC, RTC offset
+EVENT_HEADER = struct.Struct( '>BBBIi' )
+
+# Number of recent events which are checked for duplicates
+DUPLICATE_WINDOW = 256
+
+class NGPHistoryEvent( object ):
+    # Generic history event, only the header is decoded. Subclasses describe
+    # their body with BODY (layout from offset 0x0B), FIELDS (names of the
+    # unpacked values) and SCALE (divisors of fixed point values).
+    BODY = None
+    FIELDS = ()
+    SCALE = {}
+
+    __slots__ = ( 'eventData', 'eventType', 'source', 'size', 'rtc', 'offset', 'values' )
+
+    def __init__( self, eventData ):
+        self.eventData = eventData
+        self.eventType, self.source, self.size, self.rtc, self.offset = EVENT_HEADER.unpack_from( eventData, 0 )
+        self.values = None
+
+    def __getattr__( self, name ):
+        # Only called for names which are not slots, i.e. the body fields
+        fields = type( self ).FIELDS
+        if name not in fields:
+            raise AttributeError( name )
+        if self.values is None:
+            self.values = self.BODY.unpack_from( self.eventData, EVENT_HEADER.size )
+        value = self.values[fields.index( name )]
+        scale = self.SCALE.get( name )
+        return value / scale if scale else value
+
+    def __repr__( self ):
+        return '{0}({1})'.format( type( self ).__name__, self.timestamp )
+
+    @property
+    def epochTime( self ):
+        return cnl24time.epochTime( self.rtc, self.offset )
+
+    @property
+    def timestamp( self ):
+        return cnl24time.toDateTime( self.epochTime )
+
+    def eventInstance( self ):
+        # Returns the event as instance of the class for its event type
+        eventClass = EVENT_CLASSES.get( self.eventType )
+        if eventClass is None or isinstance( self, eventClass ):
+            return self
+        return eventClass( self.eventData )
+
+    def allNestedEvents( self ):
+        yield self
+
+    def postProcess( self, historyEvents ):
+        pass
+
+class TempBasalProgrammedEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BBIBH' )
+    FIELDS = ( 'preset', 'type', 'rate', 'percentageOfRate', 'duration' )
+    SCALE = { 'rate': 10000.0 }
+    __slots__ = ()
+
+class TempBasalCompleteEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BBIBHB' )
+    FIELDS = ( 'preset', 'type', 'rate', 'percentageOfRate', 'duration', 'canceled' )
+    SCALE = { 'rate': 10000.0 }
+    __slots__ = ()
+
+class InsulinDeliveryStoppedEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>B' )
+    FIELDS = ( 'suspendReason', )
+    __slots__ = ()
+
+class InsulinDeliveryRestartedEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>B' )
+    FIELDS = ( 'resumeReason', )
+    __slots__ = ()
+
+class BloodGlucoseReadingEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BHB' )
+    FIELDS = ( 'bgUnits', 'bgValue', 'bgSource' )
+    __slots__ = ()
+
+class BolusWizardEstimateEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BHHHIHHiIIIIBBI' )
+    FIELDS = ( 'bgUnits', 'bgInput', 'carbInput', 'isf', 'carbRatio', 'lowBgTarget', 'highBgTarget',
+               'correctionEstimate', 'foodEstimate', 'iob', 'iobAdjustment', 'bolusWizardEstimate',
+               'bolusStepSize', 'estimateModifiedByUser', 'finalEstimate' )
+    SCALE = { 'carbRatio': 10.0, 'correctionEstimate': 10000.0, 'foodEstimate': 10000.0, 'iob': 10000.0,
+              'iobAdjustment': 10000.0, 'bolusWizardEstimate': 10000.0, 'finalEstimate': 10000.0 }
+    __slots__ = ()
+
+class NormalBolusDeliveredEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BBBIII' )
+    FIELDS = ( 'bolusSource', 'bolusNumber', 'presetBolusNumber', 'programmedAmount', 'deliveredAmount', 'activeInsulin' )
+    SCALE = { 'programmedAmount': 10000.0, 'deliveredAmount': 10000.0, 'activeInsulin': 10000.0 }
+    __slots__ = ()
+
+class SensorGlucoseReading( object ):
+    # One reading of a SensorGlucoseReadingsEvent
+    READING = struct.Struct( '>BBHBhBB' )
+
+    __slots__ = ( 'epochTime', 'sg', 'isig', 'vctr', 'rateOfChange', 'sensorStatus', 'readingStatus' )
+
+    def __init__( self, epochTime, eventData, pos ):
+        sgHigh, sgLow, isig, self.vctr, rateOfChange, self.sensorStatus, self.readingStatus = self.READING.unpack_from( eventData, pos )
+        self.epochTime = epochTime
+        self.sg = ( sgHigh & 0x03 ) << 8 | sgLow
+        self.isig = isig / 100.0
+        self.rateOfChange = rateOfChange / 100.0
+
+    def __repr__( self ):
+        return 'SensorGlucoseReading({0}, {1})'.format( self.timestamp, self.sg )
+
+    @property
+    def timestamp( self ):
+        return cnl24time.toDateTime( self.epochTime )
+
+    @property
+    def trendArrow( self ):
+        # Arrows as shown by the pump (-3..3), one per mg/dl per minute of change
+        arrows = min( int( abs( self.rateOfChange ) ), 3 )
+        return arrows if self.rateOfChange >= 0 else -arrows
+
+    def postProcess( self, historyEvents ):
+        pass
+
+class SensorGlucoseReadingsEvent( NGPHistoryEvent ):
+    BODY = struct.Struct( '>BBH' )
+    FIELDS = ( 'minutesBetweenReadings', 'numberOfReadings', 'predictedSg' )
+    __slots__ = ()
+
+    def allNestedEvents( self ):
+        # The readings are stored newest first
+        epochTime = self.epochTime
+        interval = self.minutesBetweenReadings * 60
+        pos = EVENT_HEADER.size + self.BODY.size
+        for i in range( self.numberOfReadings ):
+            yield SensorGlucoseReading( epochTime - i * interval, self.eventData, pos )
+            pos += SensorGlucoseReading.READING.size
+
+EVENT_CLASSES = {
+    NGP_HISTORY_EVENT_TYPE.TEMP_BASAL_PROGRAMMED:            TempBasalProgrammedEvent,
+    NGP_HISTORY_EVENT_TYPE.INSULIN_DELIVERY_STOPPED:         InsulinDeliveryStoppedEvent,
+    NGP_HISTORY_EVENT_TYPE.INSULIN_DELIVERY_RESTARTED:       InsulinDeliveryRestartedEvent,
+    NGP_HISTORY_EVENT_TYPE.TEMP_BASAL_COMPLETE:              TempBasalCompleteEvent,
+    NGP_HISTORY_EVENT_TYPE.BLOOD_GLUCOSE_READING:            BloodGlucoseReadingEvent,
+    NGP_HISTORY_EVENT_TYPE.BOLUS_WIZARD_ESTIMATE:            BolusWizardEstimateEvent,
+    NGP_HISTORY_EVENT_TYPE.SENSOR_GLUCOSE_READINGS_EXTENDED: SensorGlucoseReadingsEvent,
+    NGP_HISTORY_EVENT_TYPE.NORMAL_BOLUS_DELIVERED:           NormalBolusDeliveredEvent,
+}
+
+def iterEventData( blocks ):
+    # Yields the raw data of the events in the decoded blocks in the order
+    # they are stored. Events which were received twice (by a resumed history
+    # transfer) are dropped, they are always close to each other in the stream.
+    recentEvents = collections.deque()
+    recentSet = set()
+    for block in blocks:
+        pos = 0
+        end = len( block )
+        while pos + EVENT_HEADER.size <= end:
+            size = block[pos + 2]
+            if size < EVENT_HEADER.size:
+                break # Corrupted event, the rest of the block can not be split
+            eventData = bytes( block[pos:pos + size] )
+            pos += size
+            if eventData in recentSet:
+                continue
+            recentSet.add( eventData )
+            recentEvents.append( eventData )
+            if len( recentEvents ) > DUPLICATE_WINDOW:
+                recentSet.discard( recentEvents.popleft() )
+            yield eventData
+
+def iterEvents( blocks ):
+    # Yields the events of the decoded blocks as instances of their event class
+    for eventData in iterEventData( blocks ):
+        eventClass = EVENT_CLASSES.get( eventData[0], NGPHistoryEvent )
+        yield eventClass( eventData )
+
+def iterNestedEvents( events ):
+    # Flattens the events into their nested events, e.g. sensor readings
+    for event in events:
+        for nestedEvent in event.allNestedEvents():
+            yield nestedEvent
+
+# Columns returned by decodeSensorColumns()
+SENSOR_COLUMNS = ( 'timestamp', 'sg', 'isig', 'vctr', 'rateOfChange', 'trendArrow', 'sensorStatus', 'readingStatus' )
+
+if numpy is not None:
+    READING_DTYPE = numpy.dtype( [ ( 'sgHigh', 'u1' ), ( 'sgLow', 'u1' ), ( 'isig', '>u2' ), ( 'vctr', 'u1' ),
+                                   ( 'rateOfChange', '>i2' ), ( 'sensorStatus', 'u1' ), ( 'readingStatus', 'u1' ) ] )
+
+def decodeSensorColumns( blocks, drift = None ):
+    # Decodes all sensor readings of the decoded SENSOR_DATA blocks into
+    # columns (see SENSOR_COLUMNS), newest reading of each event first.
+    # The timestamp column holds seconds since the epoch, drift (timedelta)
+    # is added to it. With NumPy the columns are arrays, the readings are
+    # unpacked with a few operations on all of them at once. Without NumPy
+    # the columns are lists built from the SensorGlucoseReading objects.
+    driftSeconds = drift.total_seconds() if drift is not None else 0.0
+    if numpy is None:
+        columns = dict( ( name, [] ) for name in SENSOR_COLUMNS )
+        for reading in iterNestedEvents( iterEvents( blocks ) ):
+            if not isinstance( reading, SensorGlucoseReading ):
+                continue
+            for name in SENSOR_COLUMNS[1:]:
+                columns[name].append( getattr( reading, name ) )
+            columns['timestamp'].append( reading.epochTime + driftSeconds )
+        return columns
+
+    # Only the event headers are walked in Python, one entry per event
+    eventData = []
+    headers = []
+    start = 0
+    bodyOffset = EVENT_HEADER.size + SensorGlucoseReadingsEvent.BODY.size
+    for data in iterEventData( blocks ):
+        if data[0] != NGP_HISTORY_EVENT_TYPE.SENSOR_GLUCOSE_READINGS_EXTENDED:
+            continue
+        rtc, offset = EVENT_HEADER.unpack_from( data, 0 )[3:]
+        interval, count = SensorGlucoseReadingsEvent.BODY.unpack_from( data, EVENT_HEADER.size )[:2]
+        # Ignore readings which do not fit into the event
+        count = min( count, max( len( data ) - bodyOffset, 0 ) // READING_DTYPE.itemsize )
+        headers.append( ( start, rtc, offset, interval, count ) )
+        eventData.append( data )
+        start += len( data )
+
+    header = numpy.array( headers, dtype = numpy.int64 ).reshape( -1, 5 )
+    counts = header[:,4]
+    total = int( counts.sum() )
+    # Index of each reading within its event
+    first = numpy.repeat( numpy.cumsum( counts ) - counts, counts )
+    index = numpy.arange( total, dtype = numpy.int64 ) - first
+
+    # Gather the 9 byte readings into one structured array
+    buffer = numpy.frombuffer( b''.join( eventData ), dtype = numpy.uint8 )
+    positions = numpy.repeat( header[:,0], counts ) + bodyOffset + index * READING_DTYPE.itemsize
+    raw = buffer[positions[:,None] + numpy.arange( READING_DTYPE.itemsize )]
+    readings = numpy.ascontiguousarray( raw ).view( READING_DTYPE ).reshape( total )
+
+    epochTimes = DateTimeHelper.pumpEpochTime( numpy.repeat( header[:,1], counts ), numpy.repeat( header[:,2], counts ) )
+    timestamp = epochTimes - index * numpy.repeat( header[:,3], counts ) * 60 + driftSeconds
+    rateOfChange = readings['rateOfChange'] / 100.0
+    return {
+        'timestamp':     timestamp.astype( numpy.float64 ),
+        'sg':            ( readings['sgHigh'].astype( numpy.int32 ) & 0x03 ) << 8 | readings['sgLow'],
+        'isig':          readings['isig'] / 100.0,
+        'vctr':          readings['vctr'],
+        'rateOfChange':  rateOfChange,
+        'trendArrow':    ( numpy.sign( rateOfChange ) * numpy.minimum( numpy.floor( numpy.abs( rateOfChange ) ), 3 ) ).astype( numpy.int8 ),
+        'sensorStatus':  readings['sensorStatus'],
+        'readingStatus': readings['readingStatus'],
+    }
+
+def selectSensorColumns( columns, since, until = None ):
+    # Keeps the readings of the columns with since < timestamp < until
+    # (None: no upper limit), on NumPy columns with one mask for all of them
+    timestamp = columns['timestamp']
+    if not hasattr( timestamp, 'shape' ):
+        keep = [ t > since and ( until is None or t < until ) for t in timestamp ]
+        return dict( ( name, [ value for value, k in zip( values, keep ) if k ] ) for name, values in columns.items() )
+    keep = timestamp > since
+    if until is not None:
+        keep &= timestamp < until
+    return dict( ( name, values[keep] ) for name, values in columns.items() )
+
+def iterSensorReadings( columns, names = SENSOR_COLUMNS ):
+    # Yields one tuple of plain Python values per reading, with the values of
+    # the named columns, e.g. to store or upload them
+    return zip( *[ columns[name].tolist() if hasattr( columns[name], 'tolist' ) else columns[name] for name in names ] )
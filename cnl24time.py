@@ -0,0 +1,138 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 pump time conversion
+#
+#  Description:
+#
+#    Converts the pump time (RTC and RTC offset) into seconds or milliseconds
+#    since the epoch. The pump clock shows the local wall clock time and has
+#    no notion of time zones, so the UTC offset of the local time zone is
+#    applied. The UTC offsets and their DST transitions are looked up once
+#    and kept in a table, single values and whole columns are converted with
+#    plain arithmetic, without creating datetime objects.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#
+###############################################################################
+
+import bisect
+import datetime
+import threading
+import time
+from dateutil import tz
+try:
+    import numpy  # pip install numpy - optional, for epochTimes()
+except ImportError:
+    numpy = None
+
+# Base time of the pump RTC is midnight 1st Jan 2000
+PUMP_BASE_TIME = 946684800
+
+# Local time zone for the datetime objects returned to the callers
+LOCAL_TZ = tz.tzlocal()
+
+class LocalTimeTable( object ):
+    # UTC offsets of the local time zone within a time window. Transitions
+    # are located by probing the offset once a day and bisecting to the
+    # second where it changed.
+    WINDOW_PAST = 400 * 86400
+    WINDOW_FUTURE = 60 * 86400
+    PROBE_STEP = 86400
+    # The table is built again after this time, e.g. if the time zone was changed
+    MAX_AGE = 3600
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.table = None
+
+    @staticmethod
+    def utcOffset( epochTime ):
+        return time.localtime( epochTime ).tm_gmtoff
+
+    def build( self, center ):
+        start = int( center - self.WINDOW_PAST )
+        end = int( center + self.WINDOW_FUTURE )
+        offsets = [ self.utcOffset( start ) ]
+        # Local wall clock time at which the next offset starts
+        wallBoundaries = []
+        t = start
+        while t < end:
+            nextT = min( t + self.PROBE_STEP, end )
+            if self.utcOffset( nextT ) != offsets[-1]:
+                low, high = t, nextT
+                while high - low > 1:
+                    middle = ( low + high ) // 2
+                    if self.utcOffset( middle ) == offsets[-1]:
+                        low = middle
+                    else:
+                        high = middle
+                wallBoundaries.append( high + offsets[-1] )
+                offsets.append( self.utcOffset( high ) )
+            t = nextT
+        # Wall clock times covered by the table
+        return ( start + offsets[0], end + offsets[-1], wallBoundaries, offsets, time.time() )
+
+    def lookup( self, wallTime ):
+        # Returns the table which covers the wall clock time
+        table = self.table
+        if table is None or not table[0] <= wallTime < table[1] or time.time() - table[4] > self.MAX_AGE:
+            with self.lock:
+                table = self.build( wallTime )
+                self.table = table
+        return table
+
+    def offsetAt( self, wallTime ):
+        # UTC offset valid at the local wall clock time. In the hour which is
+        # repeated when DST ends the first occurrence is used.
+        table = self.lookup( wallTime )
+        return table[3][bisect.bisect_right( table[2], wallTime )]
+
+    def offsetsAt( self, wallTimes ):
+        # UTC offsets of a NumPy column of wall clock times
+        table = self.lookup( float( wallTimes.min() ) )
+        if not table[0] <= wallTimes.max() < table[1]:
+            return numpy.array( [ self.offsetAt( w ) for w in wallTimes.tolist() ], dtype = numpy.int64 )
+        return numpy.asarray( table[3], dtype = numpy.int64 )[numpy.searchsorted( table[2], wallTimes, side = 'right' )]
+
+localTimeTable = LocalTimeTable()
+
+def pumpWallTime( rtc, offset ):
+    # Pump time as seconds since the epoch of the local wall clock
+    return PUMP_BASE_TIME + rtc + offset
+
+def epochTime( rtc, offset ):
+    # Seconds since the epoch of a pump RTC and RTC offset
+    wallTime = pumpWallTime( rtc, offset )
+    return wallTime - localTimeTable.offsetAt( wallTime )
+
+def epochTimes( rtcs, offsets ):
+    # Seconds since the epoch of whole NumPy columns of RTCs and RTC offsets
+    wallTimes = pumpWallTime( numpy.asarray( rtcs, dtype = numpy.int64 ), numpy.asarray( offsets, dtype = numpy.int64 ) )
+    if len( wallTimes ) == 0:
+        return wallTimes
+    return wallTimes - localTimeTable.offsetsAt( wallTimes )
+
+def epochMs( rtc, offset, drift = 0 ):
+    # Nightscout time (milliseconds since the epoch, whole seconds) of a
+    # pump time, drift in seconds
+    return int( epochTime( rtc, offset ) + drift ) * 1000
+
+def epochMsBatch( pumpTimes, drift = 0 ):
+    # Nightscout times of a sequence of ( rtc, offset ) pairs
+    result = []
+    table = None
+    for rtc, offset in pumpTimes:
+        wallTime = PUMP_BASE_TIME + rtc + offset
+        if table is None or not table[0] <= wallTime < table[1]:
+            table = localTimeTable.lookup( wallTime )
+        result.append( int( wallTime - table[3][bisect.bisect_right( table[2], wallTime )] + drift ) * 1000 )
+    return result
+
+def toDateTime( epochTime ):
+    # Aware datetime in the local time zone
+    return datetime.datetime.fromtimestamp( max( epochTime, 0 ), LOCAL_TZ )
+
+def dateMs( date ):
+    # Nightscout time of a datetime (aware, or naive in local time)
+    return int( date.timestamp() ) * 1000
@@ -0,0 +1,133 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 protocol tracing
+#
+#  Description:
+#
+#    Lightweight spans for the driver phases, the USB reads and writes and
+#    the uploader requests. All spans of one upload cycle share a trace ID.
+#    The spans are kept in a ring in memory and written to a JSON lines or
+#    Chrome trace file on demand (chrome://tracing, ui.perfetto.dev).
+#    When tracing is disabled span() returns a shared no-op object.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#
+###############################################################################
+
+import collections
+import json
+import os
+import threading
+import time
+import uuid
+
+class NullSpan( object ):
+    # Used while tracing is disabled
+    __slots__ = ()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, excType, excValue, traceback ):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span( object ):
+    __slots__ = ( 'tracer', 'name', 'args', 'start' )
+
+    def __init__( self, tracer, name, args ):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__( self ):
+        self.start = time.time()
+        return self
+
+    def __exit__( self, excType, excValue, traceback ):
+        self.tracer.record( self.name, self.start, time.time() - self.start, self.args,
+                            excType.__name__ if excType is not None else None )
+        return False
+
+class Tracer( object ):
+    DEFAULT_CAPACITY = 10000
+
+    def __init__( self, capacity = DEFAULT_CAPACITY ):
+        self.enabled = False
+        # ( trace ID, name, start, duration, pid, thread ID, thread name, args, exception name )
+        self.spans = collections.deque( maxlen = capacity )
+        self.local = threading.local()
+
+    @property
+    def traceId( self ):
+        return getattr( self.local, 'traceId', None )
+
+    def beginTrace( self, traceId = None ):
+        # Starts a new trace (e.g. an upload cycle) in the calling thread
+        self.local.traceId = traceId or uuid.uuid4().hex[:16]
+        return self.local.traceId
+
+    def context( self ):
+        # State which is passed on to a worker process with each request
+        return ( self.enabled, self.traceId )
+
+    def setContext( self, context ):
+        self.enabled, self.local.traceId = context
+
+    def span( self, name, args = None ):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span( self, name, args )
+
+    def record( self, name, start, duration, args = None, error = None ):
+        thread = threading.current_thread()
+        self.spans.append( ( self.traceId, name, start, duration, os.getpid(), thread.ident, thread.name, args, error ) )
+
+    def drain( self ):
+        # Removes and returns all spans, e.g. to pass them from a worker process to the parent
+        spans = []
+        while True:
+            try:
+                spans.append( self.spans.popleft() )
+            except IndexError:
+                return spans
+
+    def extend( self, spans ):
+        self.spans.extend( spans )
+
+    def writeJsonLines( self, fileName ):
+        with open( fileName, 'w' ) as f:
+            for traceId, name, start, duration, pid, tid, threadName, args, error in list( self.spans ):
+                f.write( json.dumps( { 'trace': traceId, 'name': name, 'start': round( start, 6 ), 'duration': round( duration, 6 ),
+                                       'pid': pid, 'thread': threadName, 'args': args, 'error': error } ) + '\n' )
+
+    def writeChromeTrace( self, fileName ):
+        events = []
+        threadNames = {}
+        for traceId, name, start, duration, pid, tid, threadName, args, error in list( self.spans ):
+            eventArgs = dict( args or {}, trace = traceId )
+            if error is not None:
+                eventArgs['error'] = error
+            events.append( { 'name': name, 'ph': 'X', 'ts': int( start * 1000000 ), 'dur': int( duration * 1000000 ),
+                             'pid': pid, 'tid': tid, 'args': eventArgs } )
+            threadNames[( pid, tid )] = threadName
+        for ( pid, tid ), threadName in threadNames.items():
+            events.append( { 'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': { 'name': threadName } } )
+        with open( fileName, 'w' ) as f:
+            json.dump( { 'traceEvents': events, 'displayTimeUnit': 'ms' }, f )
+
+    def write( self, fileName ):
+        # The format is selected by the file extension
+        if fileName.endswith( '.jsonl' ):
+            self.writeJsonLines( fileName )
+        else:
+            self.writeChromeTrace( fileName )
+
+tracer = Tracer()
+
+def span( name, args = None ):
+    if not tracer.enabled:
+        return NULL_SPAN
+    return Span( tracer, name, args )
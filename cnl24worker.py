@@ -0,0 +1,363 @@
+###############################################################################
+#
+#  Contour Next Link 2.4 driver worker process
+#
+#  Description:
+#
+#    Runs a PersistentSession in a supervised child process. The USB and
+#    radio communication and the message decoding happen in the worker,
+#    which publishes each decoded pump status as a fixed layout record in
+#    a shared memory slot. The parent waits for each request only until a
+#    deadline and kills and respawns a worker which hangs, e.g. in a USB
+#    transfer which never returns.
+#
+#  Changes:
+#    17/10/2026: Initial version
+#    17/10/2026: Pass the trace context to the worker and its spans back
+#    17/10/2026: Pass the session statistics back with each response
+#    17/10/2026: Read the pump settings
+#    17/10/2026: Start the workers from a fork server
+#
+###############################################################################
+
+import datetime
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+import cnl24driverlib
+import cnl24time
+import cnl24trace
+
+logger = logging.getLogger(__name__)
+
+# Layout of the status record, one field per value of the statusDownload()
+# result. Kinds: 'str' (ASCII, zero padded), 'date' (seconds since the epoch),
+# 'delta' (seconds), 'trend' (TREND_UNKNOWN for None), 'flags' (bit n is the
+# n-th key of the nested dict), None (plain value)
+STATUS_FIELDS = [ ( 'serial',                       '24s', 'str' ),
+                  ( 'pumpSerial',                   '24s', 'str' ),
+                  ( 'pumpTime',                     'd',   'date' ),
+                  ( 'pumpTimeDrift',                'd',   'delta' ),
+                  ( 'pumpStatus',                   'B',   ( 'suspended', 'bolusingNormal', 'bolusingSquare', 'bolusingDual',
+                                                             'deliveringInsulin', 'tempBasalActive', 'cgmActive' ) ),
+                  ( 'pumpAlert',                    'B',   ( 'alertOnHigh', 'alertOnLow', 'alertBeforeHigh', 'alertBeforeLow',
+                                                             'alertSuspend', 'alertSuspendLow' ) ),
+                  ( 'alert',                        'i',   None ),
+                  ( 'alertDate',                    'd',   'date' ),
+                  ( 'isAlertSilenceHigh',           'B',   None ),
+                  ( 'isAlertSilenceHighLow',        'B',   None ),
+                  ( 'isAlertSilenceAll',            'B',   None ),
+                  ( 'alertSilenceMinutesRemaining', 'i',   None ),
+                  ( 'sensorStatus',                 'B',   ( 'calibrating', 'calibrationComplete', 'exception' ) ),
+                  ( 'sensorCalMinutesRemaining',    'i',   None ),
+                  ( 'sensorBatteryLevelPercentage', 'i',   None ),
+                  ( 'sensorRateOfChange',           'd',   None ),
+                  ( 'bolusingDelivered',            'd',   None ),
+                  ( 'bolusingMinutesRemaining',     'i',   None ),
+                  ( 'bolusingReference',            'i',   None ),
+                  ( 'lastBolusAmount',              'd',   None ),
+                  ( 'lastBolusTime',                'd',   'date' ),
+                  ( 'lastBolusReference',           'i',   None ),
+                  ( 'recentBolusWizard',            'B',   None ),
+                  ( 'recentBGL',                    'i',   None ),
+                  ( 'activeBasalPattern',           'B',   None ),
+                  ( 'activeTempBasalPattern',       'B',   None ),
+                  ( 'currentBasalRate',             'd',   None ),
+                  ( 'tempBasalRate',                'd',   None ),
+                  ( 'tempBasalPercentage',          'i',   None ),
+                  ( 'tempBasalMinutesRemaining',    'i',   None ),
+                  ( 'basalUnitsDeliveredToday',     'd',   None ),
+                  ( 'batteryLevelPercentage',       'i',   None ),
+                  ( 'insulinUnitsRemaining',        'd',   None ),
+                  ( 'minutesOfInsulinRemaining',    'i',   None ),
+                  ( 'activeInsulin',                'd',   None ),
+                  ( 'sensorBGL',                    'i',   None ),
+                  ( 'sensorBGLTimestamp',           'd',   'date' ),
+                  ( 'trendArrow',                   'b',   'trend' ) ]
+
+TREND_UNKNOWN = -128
+
+# Sequence number (odd while the record is written) and publish time, followed by the record
+SLOT_HEADER = struct.Struct( '<Qd' )
+STATUS_RECORD = struct.Struct( '<' + ''.join( fieldFormat for _, fieldFormat, _ in STATUS_FIELDS ) )
+SLOT_SIZE = SLOT_HEADER.size + STATUS_RECORD.size
+
+def packStatus( data ):
+    values = []
+    for key, _, kind in STATUS_FIELDS:
+        value = data[key]
+        if kind == 'str':
+            value = value.encode( 'ascii' )
+        elif kind == 'date':
+            value = value.timestamp()
+        elif kind == 'delta':
+            value = value.total_seconds()
+        elif kind == 'trend':
+            value = TREND_UNKNOWN if value is None else value
+        elif kind is not None:
+            value = sum( 1 << bit for bit, flag in enumerate( kind ) if value[flag] )
+        values.append( value )
+    return values
+
+def unpackStatus( values ):
+    data = {}
+    for ( key, _, kind ), value in zip( STATUS_FIELDS, values ):
+        if kind == 'str':
+            value = value.rstrip( b'\0' ).decode( 'ascii' )
+        elif kind == 'date':
+            value = cnl24time.toDateTime( value )
+        elif kind == 'delta':
+            value = datetime.timedelta( seconds = value )
+        elif kind == 'trend':
+            value = None if value == TREND_UNKNOWN else value
+        elif kind is not None:
+            value = dict( ( flag, value >> bit & 0x01 ) for bit, flag in enumerate( kind ) )
+        data[key] = value
+    return data
+
+class StatusSlot( object ):
+    # Shared memory slot with the latest status record. It is written by one
+    # worker at a time and read without a lock, with a sequence number like a
+    # seqlock: a reader retries when the sequence was odd (write in progress)
+    # or changed while it read the record. A lock could stay held forever
+    # when a worker is killed while writing.
+    READ_ATTEMPTS = 100
+
+    def __init__( self, context ):
+        # Allocated before the workers are started, so all of them share it
+        self.buffer = context.RawArray( 'B', SLOT_SIZE )
+        self.view = memoryview( self.buffer ).cast( 'B' )
+
+    def __getstate__( self ):
+        # Passed to a worker which is not forked, the view is created again
+        return self.buffer
+
+    def __setstate__( self, buffer ):
+        self.buffer = buffer
+        self.view = memoryview( self.buffer ).cast( 'B' )
+
+    @property
+    def sequence( self ):
+        return SLOT_HEADER.unpack_from( self.view )[0]
+
+    def publish( self, data ):
+        # A killed writer may have left an odd sequence number
+        sequence = self.sequence | 1
+        SLOT_HEADER.pack_into( self.view, 0, sequence, 0 )
+        STATUS_RECORD.pack_into( self.view, SLOT_HEADER.size, *packStatus( data ) )
+        SLOT_HEADER.pack_into( self.view, 0, sequence + 1, time.time() )
+        return sequence + 1
+
+    def read( self ):
+        # Returns ( sequence, publish time, record values ), None if nothing was published yet
+        for _ in range( self.READ_ATTEMPTS ):
+            sequence, publishedAt = SLOT_HEADER.unpack_from( self.view )
+            if sequence & 1:
+                time.sleep( 0 )
+                continue
+            if sequence == 0:
+                return None
+            values = STATUS_RECORD.unpack_from( self.view, SLOT_HEADER.size )
+            if SLOT_HEADER.unpack_from( self.view )[0] == sequence:
+                return ( sequence, publishedAt, values )
+        raise cnl24driverlib.TimeoutException( 'Status slot is being written' )
+
+def workerMain( connection, parentConnection, slot, driverFactory ):
+    # Runs in the child process until the parent closes the session or goes away.
+    # A forked child inherits the parent's end of the pipe (parentConnection).
+    if parentConnection is not None:
+        parentConnection.close()
+    session = cnl24driverlib.PersistentSession( driverFactory )
+    syncStates = {}
+
+    # The parent stops the worker, Ctrl-C in the terminal must not hit it.
+    # SIGUSR1 aborts the running request like PersistentSession.cancel().
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+    signal.signal( signal.SIGTERM, signal.SIG_DFL )
+    signal.signal( signal.SIGUSR1, lambda signum, frame: session.cancel() )
+
+    try:
+        while True:
+            try:
+                request, traceContext = connection.recv()
+            except EOFError:
+                break
+            if request[0] == 'close':
+                break
+            cnl24trace.tracer.setContext( traceContext )
+            try:
+                if request[0] == 'live':
+                    result = slot.publish( session.readLiveData( request[1] ) )
+                elif request[0] == 'history':
+                    result = session.readHistoryData( request[1] )
+                elif request[0] == 'historySince':
+                    database, historyType, timeout, until = request[1:]
+                    if database not in syncStates:
+                        syncStates[database] = cnl24driverlib.HistorySyncState( database )
+                    result = session.readHistorySince( syncStates[database], historyType, timeout, until )
+                elif request[0] == 'settings':
+                    result = session.readSettings( request[1] )
+                else:
+                    raise ValueError( 'Unknown worker request {0}'.format( request[0] ) )
+                response = ( 'ok', result )
+            except Exception as e:
+                response = ( 'error', e )
+            # The spans of this request go to the parent's tracer
+            spans = cnl24trace.tracer.drain()
+            statistics = session.statistics()
+            try:
+                connection.send( response + ( spans, statistics ) )
+            except Exception:
+                # e.g. an exception which cannot be pickled
+                connection.send( ( 'error', RuntimeError( '{0}: {1}'.format( type( response[1] ).__name__, response[1] ) ),
+                                   spans, statistics ) )
+    finally:
+        session.close()
+        connection.close()
+
+class WorkerSession( object ):
+    # Same interface as PersistentSession, the session runs in a worker
+    # process which is started on the first request and after it was killed.
+    #
+    # The workers are started by a fork server, which is a fresh process
+    # without the threads of the caller: forking a process with several
+    # threads can leave locks held by other threads locked in the child.
+    # So driverFactory must be picklable, e.g. a functools.partial() of
+    # Medtronic600SeriesDriver, and the main module of the program must not
+    # run its main code when imported. startMethod 'fork' allows any
+    # driverFactory, if the caller does not run other threads.
+    #
+    # Results of history reads are passed back through a pipe, the live data
+    # is read from the shared status slot.
+
+    # Time the worker gets on top of the timeout of a request, before it is
+    # considered to hang. The driver enforces the timeout itself, unless it
+    # is stuck in a call which cannot be interrupted.
+    WATCHDOG_GRACE = 15
+    CLOSE_TIMEOUT = 10
+
+    def __init__( self, driverFactory = cnl24driverlib.Medtronic600SeriesDriver, startMethod = 'forkserver' ):
+        self.driverFactory = driverFactory
+        self.context = multiprocessing.get_context( startMethod )
+        self.slot = StatusSlot( self.context )
+        self.process = None
+        self.connection = None
+        self.lock = threading.Lock() # One request at a time
+        self.sendLock = threading.Lock()
+        self.restarts = 0 # Number of workers killed by the watchdog
+        self.lastStatistics = None # Session statistics of the worker after the last request
+
+    @property
+    def isRunning( self ):
+        return self.process is not None and self.process.is_alive()
+
+    def start( self ):
+        connection, childConnection = self.context.Pipe()
+        # Only a forked worker inherits the parent's end of the pipe
+        parentConnection = connection if self.context.get_start_method() == 'fork' else None
+        self.process = self.context.Process( target = workerMain, name = 'cnl24-worker',
+                                             args = ( childConnection, parentConnection, self.slot, self.driverFactory ) )
+        self.process.daemon = True
+        self.process.start()
+        childConnection.close()
+        self.connection = connection
+        logger.info("WorkerSession: started driver worker {0}".format( self.process.pid ))
+
+    def kill( self ):
+        if self.process is not None:
+            if self.process.is_alive():
+                logger.error("WorkerSession: killing driver worker {0}".format( self.process.pid ))
+                self.process.kill()
+            self.process.join()
+            self.process = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request( self, request, timeout ):
+        with self.lock, cnl24trace.span( 'worker.' + request[0] ):
+            if not self.isRunning:
+                self.kill()
+                self.start()
+            process, connection = self.process, self.connection
+            with self.sendLock:
+                connection.send( ( request, cnl24trace.tracer.context() ) )
+
+            deadline = None if timeout is None else time.time() + timeout + self.WATCHDOG_GRACE
+            while True:
+                wait = 1.0 if deadline is None else min( 1.0, deadline - time.time() )
+                if wait > 0 and connection.poll( wait ):
+                    try:
+                        status, result, spans, self.lastStatistics = connection.recv()
+                    except EOFError:
+                        self.kill()
+                        raise IOError( 'Driver worker exited' )
+                    cnl24trace.tracer.extend( spans )
+                    break
+                if not process.is_alive():
+                    self.kill()
+                    raise IOError( 'Driver worker exited with code {0}'.format( process.exitcode ) )
+                if deadline is not None and time.time() >= deadline:
+                    # The worker hangs, the next request starts a new one which opens the CNL again
+                    self.restarts += 1
+                    self.kill()
+                    raise cnl24driverlib.TimeoutException( 'Driver worker did not respond within {0} seconds'.format( timeout + self.WATCHDOG_GRACE ) )
+
+        if status == 'error':
+            raise result
+        return result
+
+    def latestStatus( self ):
+        # The latest published live data (statusDownload() result), None if
+        # there is none yet. Does not wait for a running request.
+        record = self.slot.read()
+        if record is None:
+            return None
+        return unpackStatus( record[2] )
+
+    @property
+    def latestStatusTime( self ):
+        # Time when the latest live data was published, None if there is none yet
+        record = self.slot.read()
+        return None if record is None else record[1]
+
+    def statistics( self ):
+        # PersistentSession.statistics() as of the last request, does not wait for the worker.
+        # The counters start again from 0 in a new worker.
+        return dict( self.lastStatistics or {}, workerRestarts = self.restarts )
+
+    def readLiveData( self, timeout = None ):
+        self.request( ( 'live', timeout ), timeout )
+        return self.latestStatus()
+
+    def readHistoryData( self, timeout = None ):
+        return self.request( ( 'history', timeout ), timeout )
+
+    def readHistorySince( self, syncState, historyType = cnl24driverlib.HISTORY_DATA_TYPE.PUMP_DATA, timeout = None, until = None ):
+        # The worker opens the sync state database itself
+        return self.request( ( 'historySince', syncState.database, historyType, timeout, until ), timeout )
+
+    def readSettings( self, timeout = None ):
+        return self.request( ( 'settings', timeout ), timeout )
+
+    def cancel( self ):
+        # Aborts a running request from another thread, e.g. a signal handler
+        process = self.process
+        if process is not None and process.is_alive():
+            os.kill( process.pid, signal.SIGUSR1 )
+
+    def close( self ):
+        # Lets the worker run the finish sequence, kills it if that takes too long
+        process = self.process
+        if process is not None and process.is_alive():
+            try:
+                with self.sendLock:
+                    self.connection.send( ( ( 'close', ), None ) )
+            except Exception:
+                pass
+            process.join( self.CLOSE_TIMEOUT )
+        self.kill()
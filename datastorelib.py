@@ -0,0 +1,290 @@
+###############################################################################
+#
+#  Diabetes Data Guard (DD-Guard): Local data store library
+#
+#  Description:
+#
+#    This library keeps the sensor readings, pump status, boluses, basal
+#    changes and alerts received from the pump in a local SQLite database,
+#    so that they can be queried without the cloud services
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    17/10/2026 - Initial version
+#    17/10/2026 - Take the time of history events from their epoch time
+#    17/10/2026 - Keep each version of the pump settings
+#    17/10/2026 - Store the sensor history from its reading columns
+#
+#  Copyright 2019-2020, Ondrej Wisniewski
+#
+#  This file is part of the DD-Guard project.
+#
+#  DD-Guard is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with crelay.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+import json
+import sqlite3
+import threading
+from sensor_codes import SENSOR_EXCEPTIONS
+from cnl24history import NGP_HISTORY_EVENT_TYPE, iterSensorReadings
+
+
+# Table definitions, all tables have the columns pump_serial and ts
+# (seconds since the epoch, corrected by the pump time drift)
+TABLES = {
+   "sensor_readings": [("sgv",                   "INTEGER"), # NULL for sensor exceptions
+                       ("trend",                 "INTEGER"),
+                       ("exception",             "INTEGER"), # Sensor exception code
+                       ("isig",                  "REAL"),
+                       ("rate_of_change",        "REAL")],
+   "pump_status":     [("reservoir",             "REAL"),
+                       ("battery",               "INTEGER"),
+                       ("active_insulin",        "REAL"),
+                       ("basal_rate",            "REAL"),
+                       ("temp_basal_rate",       "REAL"),
+                       ("temp_basal_percentage", "INTEGER"),
+                       ("suspended",             "INTEGER"),
+                       ("sensor_battery",        "INTEGER"),
+                       ("sensor_cal_minutes",    "INTEGER")],
+   "boluses":         [("amount",                "REAL"),
+                       ("reference",             "INTEGER")],
+   "basal_changes":   [("rate",                  "REAL"),
+                       ("percentage",            "INTEGER"),
+                       ("duration",              "INTEGER"),
+                       ("temp",                  "INTEGER")],
+   "alerts":          [("code",                  "INTEGER"),
+                       ("silenced",              "INTEGER")],
+   "pump_settings":   [("hash",                  "TEXT"),    # Content hash, see PumpSettingsCache
+                       ("settings",              "TEXT"),    # JSON
+                       ("active_basal_pattern",  "INTEGER")],
+}
+
+
+def epoch(date, drift=None):
+   if drift != None:
+      date = date + drift
+   return int(round(date.timestamp()))
+
+
+def event_epoch(event, drift):
+   return int(round(event.epochTime + drift.total_seconds()))
+
+
+# Local data store class
+class data_store(object):
+
+   def __init__(self, database):
+      self.lock = threading.Lock()
+      self.conn = sqlite3.connect(database, check_same_thread=False)
+      self.conn.row_factory = sqlite3.Row
+      # WAL mode lets readers query while a cycle is written
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      self.conn.execute("PRAGMA synchronous=NORMAL")
+      with self.conn:
+         for table, columns in TABLES.items():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {0} (pump_serial TEXT NOT NULL, ts INTEGER NOT NULL, {1}, "
+                              "PRIMARY KEY (pump_serial, ts))".format(table, ", ".join(name+" "+ctype for name,ctype in columns)))
+            self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_ts ON {0} (ts)".format(table))
+      self.inserts = dict((table, "INSERT OR IGNORE INTO {0} VALUES ({1})".format(table, ", ".join(["?"] * (len(columns)+2))))
+                          for table, columns in TABLES.items())
+
+
+   #########################################################
+   #
+   # Function:    insert()
+   # Description: Insert the rows of several tables in one
+   #              transaction. Rows which are already stored
+   #              (same pump and time) are ignored.
+   #
+   #########################################################
+   def insert(self, rows):
+      with self.lock:
+         with self.conn:
+            for table, tableRows in rows.items():
+               if len(tableRows) > 0:
+                  self.conn.executemany(self.inserts[table], tableRows)
+
+
+   #########################################################
+   #
+   # Function:    live_rows()
+   # Description: Convert the live data of one cycle (with
+   #              the pump time drift already applied to
+   #              pumpTime and sensorBGLTimestamp) into
+   #              table rows
+   #
+   #########################################################
+   def live_rows(self, data):
+
+      serial = data["pumpSerial"]
+      drift = data["pumpTimeDrift"]
+      rows = dict((table, []) for table in TABLES)
+
+      sgv = data["sensorBGL"]
+      if sgv != SENSOR_EXCEPTIONS.SENSOR_LOST:
+         exception = sgv if sgv >= 0x0300 else None
+         rows["sensor_readings"].append((serial, epoch(data["sensorBGLTimestamp"]),
+                                         None if exception else sgv, data["trendArrow"], exception, None, data["sensorRateOfChange"]))
+
+      rows["pump_status"].append((serial, epoch(data["pumpTime"]),
+                                  data["insulinUnitsRemaining"], data["batteryLevelPercentage"], data["activeInsulin"],
+                                  data["currentBasalRate"], data["tempBasalRate"], data["tempBasalPercentage"],
+                                  int(data["pumpStatus"]["suspended"]), data["sensorBatteryLevelPercentage"],
+                                  data["sensorCalMinutesRemaining"]))
+
+      if data["lastBolusAmount"] > 0:
+         rows["boluses"].append((serial, epoch(data["lastBolusTime"], drift), data["lastBolusAmount"], data["lastBolusReference"]))
+
+      # Only a changed basal rate is stored
+      latest = self.query_latest("basal_changes", 1, serial)
+      temp = int(data["pumpStatus"]["tempBasalActive"])
+      rate = data["tempBasalRate"] if temp else data["currentBasalRate"]
+      percentage = data["tempBasalPercentage"] if temp else None
+      if len(latest) == 0 or (latest[0]["rate"], latest[0]["percentage"], latest[0]["temp"]) != (rate, percentage, temp):
+         rows["basal_changes"].append((serial, epoch(data["pumpTime"]), rate, percentage,
+                                       data["tempBasalMinutesRemaining"] if temp else None, temp))
+
+      if data["alert"]:
+         rows["alerts"].append((serial, epoch(data["alertDate"], drift), data["alert"],
+                                int(data["isAlertSilenceHigh"] or data["isAlertSilenceHighLow"] or data["isAlertSilenceAll"])))
+
+      return rows
+
+
+   #########################################################
+   #
+   # Function:    history_rows()
+   # Description: Convert the events read from the pump
+   #              history and the sensor reading columns 
+   #              into table rows
+   #
+   #########################################################
+   def history_rows(self, data):
+
+      serial = data["pumpSerial"]
+      drift = data["pumpTimeDrift"]
+      rows = dict((table, []) for table in TABLES)
+
+      for event in data["events"]:
+         eventType = getattr(event, "eventType", None)
+         if eventType == None and hasattr(event, "sg"):
+            if event.sg == SENSOR_EXCEPTIONS.SENSOR_LOST:
+               continue
+            exception = event.sg if event.sg >= 0x0300 else None
+            rows["sensor_readings"].append((serial, event_epoch(event, drift), None if exception else event.sg,
+                                            event.trendArrow, exception, event.isig, event.rateOfChange))
+         elif eventType == NGP_HISTORY_EVENT_TYPE.NORMAL_BOLUS_DELIVERED:
+            rows["boluses"].append((serial, event_epoch(event, drift), event.deliveredAmount, event.bolusNumber))
+         elif eventType == NGP_HISTORY_EVENT_TYPE.TEMP_BASAL_PROGRAMMED:
+            rows["basal_changes"].append((serial, event_epoch(event, drift),
+                                          event.rate if event.type == 0 else None,
+                                          event.percentageOfRate if event.type != 0 else None,
+                                          event.duration, 1))
+
+      if data.get("sensorColumns") != None:
+         readings = iterSensorReadings(data["sensorColumns"], ("timestamp", "sg", "trendArrow", "isig", "rateOfChange"))
+         for timestamp, sg, trendArrow, isig, rateOfChange in readings:
+            if sg == SENSOR_EXCEPTIONS.SENSOR_LOST:
+               continue
+            exception = sg if sg >= 0x0300 else None
+            rows["sensor_readings"].append((serial, int(round(timestamp + drift.total_seconds())), None if exception else sg,
+                                            trendArrow, exception, isig, rateOfChange))
+
+      return rows
+
+
+   #########################################################
+   #
+   # Function:    store_live_data()
+   # Description: Store the live data of one cycle, all
+   #              tables in one transaction
+   #
+   #########################################################
+   def store_live_data(self, data):
+      if data != None:
+         self.insert(self.live_rows(data))
+
+
+   #########################################################
+   #
+   # Function:    store_history()
+   # Description: Store the events read from the pump
+   #              history, all in one transaction
+   #
+   #########################################################
+   def store_history(self, data):
+      if data != None:
+         self.insert(self.history_rows(data))
+
+
+   #########################################################
+   #
+   # Function:    store_settings()
+   # Description: Store a new version of the pump settings
+   #              (an entry of the PumpSettingsCache), with
+   #              the time when the version changed
+   #
+   #########################################################
+   def store_settings(self, pump_serial, entry):
+      self.insert({"pump_settings": [(pump_serial, int(entry["changedAt"]), entry["hash"],
+                                      json.dumps(entry["settings"], sort_keys=True),
+                                      entry["activeBasalPattern"])]})
+
+
+   #########################################################
+   #
+   # Function:    query_range()
+   # Description: Return the rows of a table with
+   #              start <= ts < end (seconds since the
+   #              epoch) as dicts, oldest first
+   #
+   #########################################################
+   def query_range(self, table, start, end, pump_serial=None):
+      if table not in TABLES:
+         raise ValueError("Unknown table "+table)
+      query = "SELECT * FROM {0} WHERE ts >= ? AND ts < ?".format(table)
+      args = [int(start), int(end)]
+      if pump_serial != None:
+         query += " AND pump_serial = ?"
+         args.append(pump_serial)
+      with self.lock:
+         return [dict(row) for row in self.conn.execute(query + " ORDER BY ts", args)]
+
+
+   #########################################################
+   #
+   # Function:    query_latest()
+   # Description: Return the latest count rows of a table
+   #              as dicts, newest first
+   #
+   #########################################################
+   def query_latest(self, table, count, pump_serial=None):
+      if table not in TABLES:
+         raise ValueError("Unknown table "+table)
+      query = "SELECT * FROM {0}".format(table)
+      args = []
+      if pump_serial != None:
+         query += " WHERE pump_serial = ?"
+         args.append(pump_serial)
+      with self.lock:
+         return [dict(row) for row in self.conn.execute(query + " ORDER BY ts DESC LIMIT ?", args + [count])]
+
+
+   def close(self):
+      with self.lock:
+         self.conn.close()
@@ -40,9 +40,20 @@
 #    28/06/2020 - Syntax updates for Python3
 #    09/11/2020 - Replace Blynk timer with Python timer,
 #                 Account for Pump Time drift
+#    17/10/2026 - Keep the CNL session open across upload cycles
+#    17/10/2026 - Limit the time of a pump read, cancel it on exit
+#    17/10/2026 - Upload missed pump history to Nightscout
+#    17/10/2026 - Backfill sensor readings missed while the pump was out of range
+#    17/10/2026 - Keep received data in a local database
+#    17/10/2026 - Keep the last 24 hours of live data in memory
+#    17/10/2026 - Serve several patients (CNL sticks) from one gateway
+#    17/10/2026 - Run the CNL session in a supervised worker process
+#    17/10/2026 - Trace each upload cycle, write the trace on SIGUSR2
+#    17/10/2026 - Serve gateway metrics for Prometheus
+#    17/10/2026 - Cache the pump settings, upload them as Nightscout profile
+#    17/10/2026 - Start the CNL workers from a fork server
 #
 #  TODO:
-#    - Upload missed data when the pump returns into range
 #    - Add some notification mechanism for alarms e.g. Telegram or Pushover message
 #    - Upload data to Tidepool
 #
@@ -76,8 +87,14 @@ if sys.version_info[0] < 3:
 else:
     from configparser import ConfigParser
 import datetime
+import functools
 import cnl24driverlib
+import cnl24worker
+import cnl24trace
 import nightscoutlib
+import datastorelib
+import ringbufferlib
+import metricslib
 from sensor_codes import SENSOR_EXCEPTIONS
 
 VERSION = "0.8"
@@ -86,6 +103,9 @@ UPDATE_INTERVAL = 300
 RETRY_INTERVAL  = 180
 RETRY_DELAY     = 5
 MAX_RETRIES_AT_FAILURE = 3
+READ_TIMEOUT    = 60
+HISTORY_SYNC_INTERVAL = 1800
+BACKFILL_MIN_GAP = 450 # 1.5 x sensor reading interval
 
 # virtual pin definitions
 VPIN_SENSOR  = 1
@@ -121,13 +141,9 @@ sensor_exception_codes = {
     SENSOR_EXCEPTIONS.SENSOR_LOST:             SENSOR_EXCEPTIONS.SENSOR_LOST_STR
 }
 
-is_connected = False
-lastBolusTime = None
-cycleTimer = None
-cycleCount = 0
-
-blynk = None
-nightscout = None
+patients = []
+datastore = None
+metrics = metricslib.gateway_metrics()
 
 CONFIG_FILE = "/etc/ddguard.conf"
 
@@ -140,6 +156,19 @@ def to_int(string):
    return i
 
 
+#########################################################
+#
+# Function:    config_value()
+# Description: Read an optional parameter from config 
+#              file, empty if not found
+# 
+#########################################################
+def config_value(config, section, option):
+   if not config.has_option(section, option):
+      return ""
+   return config.get(section, option).split("#")[0].strip('"').strip("'").strip()
+
+
 #########################################################
 #
 # Function:    read_config()
@@ -181,6 +210,50 @@ def read_config(cfilename):
       syslog.syslog(syslog.LOG_ERR, "ERROR - Needed bgl option not found in config file")
       return False
 
+   # Read patient parameters (optional sections), one per CNL stick.
+   # Without patient sections the blynk and nightscout sections
+   # above are used for the only CNL stick
+   read_config.patients = []
+   for section in config.sections():
+      if section.startswith("patient:"):
+         read_config.patients.append({
+            "name":                  section[len("patient:"):].strip(),
+            "usb_serial":            config_value(config, section, 'usb_serial'),
+            "usb_path":              config_value(config, section, 'usb_path'),
+            "blynk_server":          config_value(config, section, 'blynk_server'),
+            "blynk_token":           config_value(config, section, 'blynk_token'),
+            "blynk_heartbeat":       to_int(config_value(config, section, 'blynk_heartbeat')),
+            "nightscout_server":     config_value(config, section, 'nightscout_server'),
+            "nightscout_api_secret": config_value(config, section, 'nightscout_api_secret')
+         })
+   if len(read_config.patients) == 0:
+      read_config.patients.append({
+         "name":                  "default",
+         "usb_serial":            "",
+         "usb_path":              "",
+         "blynk_server":          read_config.blynk_server,
+         "blynk_token":           read_config.blynk_token,
+         "blynk_heartbeat":       read_config.blynk_heartbeat,
+         "nightscout_server":     read_config.nightscout_server,
+         "nightscout_api_secret": read_config.nightscout_api_secret
+      })
+
+   # Read local data store parameters (optional section)
+   if config.has_option('storage', 'database'):
+      read_config.storage_database = config.get('storage', 'database').split("#")[0].strip('"').strip("'").strip()
+   else:
+      read_config.storage_database = ""
+
+   # Read trace parameters (optional section)
+   if config.has_option('trace', 'file'):
+      read_config.trace_file = config.get('trace', 'file').split("#")[0].strip('"').strip("'").strip()
+   else:
+      read_config.trace_file = ""
+
+   # Read metrics parameters (optional section)
+   read_config.metrics_port    = to_int(config_value(config, 'metrics', 'port'))
+   read_config.metrics_address = config_value(config, 'metrics', 'address') or "127.0.0.1"
+
    # Disable BGL parameters if not specified in config
    if read_config.bgl_pre_high_val == 0:
       read_config.bgl_pre_high_val = 1000
@@ -196,6 +269,13 @@ def read_config(cfilename):
    print ("BGL pre low:  %d" % read_config.bgl_pre_low_val)
    print ("BGL pre high: %d" % read_config.bgl_pre_high_val)
    print ("BGL high:     %d\n" % read_config.bgl_high_val)
+   print ("Storage database: %s" % read_config.storage_database)
+   print ("Trace file:       %s" % read_config.trace_file)
+   print ("Metrics port:     %d\n" % read_config.metrics_port)
+   for patientConfig in read_config.patients:
+      print ("Patient %s: USB serial '%s', USB path '%s', Blynk server '%s', Nightscout server '%s'" %
+             (patientConfig["name"], patientConfig["usb_serial"], patientConfig["usb_path"],
+              patientConfig["blynk_server"], patientConfig["nightscout_server"]))
    return True
 
     
@@ -206,142 +286,287 @@ def read_config(cfilename):
 # 
 #########################################################
 def on_sigterm(signum, frame):
-   try:
-      if blynk != None:
-         blynk.disconnect()
-   except:
-      pass
-   try:
-      if cycleTimer != None:
-         cycleTimer.cancel()
-   except:
-      pass
+   for p in patients:
+      try:
+         if p.blynk != None:
+            p.blynk.disconnect()
+      except:
+         pass
+      try:
+         p.cnlSession.cancel()
+         p.cnlSession.close()
+      except:
+         pass
    syslog.syslog(syslog.LOG_NOTICE, "Exiting DD-Guard daemon")
    sys.exit()
 
 
+#########################################################
+#
+# Function:    on_sigusr2()
+# Description: signal handler for the USR2 signal, 
+#              writes the spans traced so far to the 
+#              trace file
+# 
+#########################################################
+def on_sigusr2(signum, frame):
+   try:
+      cnl24trace.tracer.write(read_config.trace_file)
+      syslog.syslog(syslog.LOG_NOTICE, "Trace written to "+read_config.trace_file)
+   except:
+      syslog.syslog(syslog.LOG_ERR, "Writing trace file ERROR")
+
+
 #########################################################
 #
 # Function:    blynk_upload()
 # Description: Blynk uploader
 # 
 #########################################################
-def blynk_upload(data):
+def blynk_upload(p, data):
 
-   global lastBolusTime
-   global cycleCount
-   
    if data != None:
-      print("Uploading data to Blynk")
+      print("[{0}] Uploading data to Blynk".format(p.name))
        
       # Send sensor data
       if data["sensorBGL"] in sensor_exception_codes:
          # Sensor exception occured
          
          # BGL gauge
-         blynk.virtual_write(VPIN_SENSOR, None)
-         blynk.set_property(VPIN_SENSOR, "color", BLYNK_WHITE)
+         p.blynk.virtual_write(VPIN_SENSOR, None)
+         p.blynk.set_property(VPIN_SENSOR, "color", BLYNK_WHITE)
          
          # Trend and active insulin
-         blynk.virtual_write(VPIN_ARROWS, "--"+" / "+str(data["activeInsulin"]))
+         p.blynk.virtual_write(VPIN_ARROWS, "--"+" / "+str(data["activeInsulin"]))
          
          # Status line
-         blynk.virtual_write(VPIN_STATUS, datetime.datetime.now().strftime("%H:%M")+" - "+sensor_exception_codes[data["sensorBGL"]])
-         blynk.set_property(VPIN_STATUS, "color", BLYNK_RED)
+         p.blynk.virtual_write(VPIN_STATUS, datetime.datetime.now().strftime("%H:%M")+" - "+sensor_exception_codes[data["sensorBGL"]])
+         p.blynk.set_property(VPIN_STATUS, "color", BLYNK_RED)
       else:
          # Regular BGL data
          
          # BLG gauge
-         blynk.virtual_write(VPIN_SENSOR, data["sensorBGL"])
+         p.blynk.virtual_write(VPIN_SENSOR, data["sensorBGL"])
          if data["pumpAlert"]["alertSuspend"] or data["pumpAlert"]["alertSuspendLow"]:
-            blynk.set_property(VPIN_SENSOR, "color", BLYNK_BLUE)
+            p.blynk.set_property(VPIN_SENSOR, "color", BLYNK_BLUE)
          elif data["sensorBGL"] < read_config.bgl_low_val or data["sensorBGL"] > read_config.bgl_high_val or \
               data["pumpAlert"]["alertOnLow"] or data["pumpAlert"]["alertOnHigh"]:
-            blynk.set_property(VPIN_SENSOR, "color", BLYNK_RED)
+            p.blynk.set_property(VPIN_SENSOR, "color", BLYNK_RED)
          elif data["sensorBGL"] < read_config.bgl_pre_low_val or data["sensorBGL"] > read_config.bgl_pre_high_val or \
               data["pumpAlert"]["alertBeforeLow"] or data["pumpAlert"]["alertBeforeHigh"]:
-            blynk.set_property(VPIN_SENSOR, "color", BLYNK_YELLOW)
+            p.blynk.set_property(VPIN_SENSOR, "color", BLYNK_YELLOW)
          else:
-            blynk.set_property(VPIN_SENSOR, "color", BLYNK_GREEN)
+            p.blynk.set_property(VPIN_SENSOR, "color", BLYNK_GREEN)
          
          # Trend and active insulin
-         blynk.virtual_write(VPIN_ARROWS, str(data["trendArrow"])+" / "+str(data["activeInsulin"]))
+         p.blynk.virtual_write(VPIN_ARROWS, str(data["trendArrow"])+" / "+str(data["activeInsulin"]))
          
          # Status line
          calTime = "Cal at {0}".format((data["sensorBGLTimestamp"] + datetime.timedelta(minutes=data["sensorCalMinutesRemaining"])).strftime("%H:%M"))
-         blynk.virtual_write(VPIN_STATUS, "Updated "+data["sensorBGLTimestamp"].strftime("%H:%M")+" - "+calTime)
-         blynk.set_property(VPIN_STATUS, "color", BLYNK_GREEN)
+         p.blynk.virtual_write(VPIN_STATUS, "Updated "+data["sensorBGLTimestamp"].strftime("%H:%M")+" - "+calTime)
+         p.blynk.set_property(VPIN_STATUS, "color", BLYNK_GREEN)
        
       # Send pump data
 
       # Battery bar
       # Alternate pump and sensor battery
-      if cycleCount%2 == 0:
+      if p.cycleCount%2 == 0:
          data_batt = data["batteryLevelPercentage"]
          label_batt = "PUMP BATTERY %"
       else:
          data_batt = data["sensorBatteryLevelPercentage"]
          label_batt = "SENSOR BATTERY %"
-      blynk.set_property(VPIN_BATTERY, "label", label_batt)
-      blynk.virtual_write(VPIN_BATTERY, data_batt)
+      p.blynk.set_property(VPIN_BATTERY, "label", label_batt)
+      p.blynk.virtual_write(VPIN_BATTERY, data_batt)
       if data_batt <= 25:
-         blynk.set_property(VPIN_BATTERY, "color", BLYNK_RED)
+         p.blynk.set_property(VPIN_BATTERY, "color", BLYNK_RED)
       elif data_batt <= 50:
-         blynk.set_property(VPIN_BATTERY, "color", BLYNK_YELLOW)
+         p.blynk.set_property(VPIN_BATTERY, "color", BLYNK_YELLOW)
       else:
-         blynk.set_property(VPIN_BATTERY, "color", BLYNK_GREEN)
+         p.blynk.set_property(VPIN_BATTERY, "color", BLYNK_GREEN)
       
       # Reservoir bar
-      blynk.virtual_write(VPIN_UNITS, int(round(data["insulinUnitsRemaining"])))
+      p.blynk.virtual_write(VPIN_UNITS, int(round(data["insulinUnitsRemaining"])))
       if data["insulinUnitsRemaining"] <= 25:
-         blynk.set_property(VPIN_UNITS, "color", BLYNK_RED)
+         p.blynk.set_property(VPIN_UNITS, "color", BLYNK_RED)
       elif data["insulinUnitsRemaining"] <= 75:
-         blynk.set_property(VPIN_UNITS, "color", BLYNK_YELLOW)
+         p.blynk.set_property(VPIN_UNITS, "color", BLYNK_YELLOW)
       else:
-         blynk.set_property(VPIN_UNITS, "color", BLYNK_GREEN)
+         p.blynk.set_property(VPIN_UNITS, "color", BLYNK_GREEN)
          
       # Active insulin / last bolus graph
-      if int(data["lastBolusTime"].strftime("%s")) != lastBolusTime: 
+      if int(data["lastBolusTime"].timestamp()) != p.lastBolusTime: 
          print("Bolus time changed")
-         lastBolusTime = int(data["lastBolusTime"].strftime("%s"))
+         p.lastBolusTime = int(data["lastBolusTime"].timestamp())
          # Check if last bolus time is recent
-         if int(time.time()) - lastBolusTime < 2*UPDATE_INTERVAL:
+         if int(time.time()) - p.lastBolusTime < 2*UPDATE_INTERVAL:
             print("Bolus time is recent")
-            blynk.virtual_write(VPIN_LASTBOLUS, data["lastBolusAmount"])
+            p.blynk.virtual_write(VPIN_LASTBOLUS, data["lastBolusAmount"])
       else:
-         blynk.virtual_write(VPIN_ACTINS, data["activeInsulin"])
+         p.blynk.virtual_write(VPIN_ACTINS, data["activeInsulin"])
       
    else:
       syslog.syslog(syslog.LOG_ERR, "Unable to get data from pump")
-      blynk.set_property(VPIN_STATUS, "color", BLYNK_RED)
+      p.blynk.set_property(VPIN_STATUS, "color", BLYNK_RED)
 
 
 #########################################################
 #
-# Function:    upload_live_data()
-# Description: Read live data from pump and upload it 
-#              to the enabled cloud services
-#              This runs once at startup and then as a 
-#              periodic timer every 5min
+# Function:    store_history()
+# Description: Keep the events read from the pump history
+#              in the local database
 # 
 #########################################################
-def upload_live_data():
-   
-   global cycleCount
-   global cycleTimer
-      
-   # Guard against multiple threads
-   if upload_live_data.active:
+def store_history(historyData):
+
+   if datastore != None:
+      try:
+         with cnl24trace.span("datastore.store_history"):
+            datastore.store_history(historyData)
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Local data store ERROR")
+
+
+#########################################################
+#
+# Function:    sync_history()
+# Description: Read the pump history since the last sync
+#              and upload it to Nightscout. This runs 
+#              periodically and when the pump returns
+#              into range
+# 
+#########################################################
+def sync_history(p):
+
+   if p.nightscout == None:
       return
-    
-   upload_live_data.active = True
+   if not p.lastReadFailed and time.time() - p.lastHistorySync < HISTORY_SYNC_INTERVAL:
+      return
+
+   print("[{0}] read pump history since last sync".format(p.name))
+   try:
+      historyData = p.cnlSession.readHistorySince(p.historySync, cnl24driverlib.HISTORY_DATA_TYPE.PUMP_DATA, READ_TIMEOUT)
+   except:
+      syslog.syslog(syslog.LOG_ERR, "Unexpected ERROR occured while reading pump history")
+      return
+   store_history(historyData)
+
+   try:
+      with cnl24trace.span("nightscout.upload_history"):
+         uploaded = p.nightscout.upload_history(historyData)
+      if uploaded:
+         # Only advance the sync time when the upload succeeded
+         p.historySync.store(historyData["pumpSerial"], historyData["historyType"], historyData["syncedUntil"])
+         p.lastHistorySync = time.time()
+   except:
+      syslog.syslog(syslog.LOG_ERR, "Nightscout history upload ERROR")
+
+
+#########################################################
+#
+# Function:    backfill_sensor_history()
+# Description: Upload the sensor readings between the 
+#              last uploaded and the current reading 
+#              from the pump history, if some were 
+#              missed (e.g. pump out of range)
+# 
+#########################################################
+def backfill_sensor_history(p, liveData):
+
+   if p.nightscout == None or liveData["sensorBGL"] == SENSOR_EXCEPTIONS.SENSOR_LOST:
+      return
+
+   # The sync state keeps the pump time of the last uploaded reading
+   sensorData = cnl24driverlib.HISTORY_DATA_TYPE.SENSOR_DATA
+   sensorTime = (liveData["sensorBGLTimestamp"] - liveData["pumpTimeDrift"]).timestamp()
+   lastUpload = p.historySync.lastSync(liveData["pumpSerial"], sensorData)
+
+   if lastUpload != None and sensorTime - lastUpload > BACKFILL_MIN_GAP:
+      print("[{0}] backfill sensor readings since {1}".format(p.name, datetime.datetime.fromtimestamp(lastUpload)))
+      try:
+         historyData = p.cnlSession.readHistorySince(p.historySync, sensorData, READ_TIMEOUT, until=sensorTime)
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Unexpected ERROR occured while reading sensor history")
+         return
+      store_history(historyData)
+      try:
+         with cnl24trace.span("nightscout.upload_sensor_history"):
+            uploaded = p.nightscout.upload_sensor_history(historyData)
+         if not uploaded:
+            # Keep the gap, it is read again in the next cycle
+            return
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Nightscout sensor history upload ERROR")
+         return
+
+   p.historySync.store(liveData["pumpSerial"], sensorData, sensorTime)
+
+
+#########################################################
+#
+# Function:    refresh_settings()
+# Description: Read the pump settings again if the cached
+#              ones are too old, follow switches of the
+#              active basal pattern, keep a changed version
+#              in the local database and upload it to
+#              Nightscout
+# 
+#########################################################
+def refresh_settings(p, liveData):
+
+   serial = liveData["pumpSerial"]
+   pattern = liveData["activeBasalPattern"]
+   labels = (("patient", p.name),)
+   if p.settingsCache.needsRefresh(serial):
+      print("[{0}] read pump settings".format(p.name))
+      try:
+         settings = p.cnlSession.readSettings(READ_TIMEOUT)
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Unexpected ERROR occured while reading pump settings")
+         p.settingsCache.failed(serial)
+         metrics.inc("ddguard_settings_reads_total", labels + (("result", "failed"),))
+         return
+      changed = p.settingsCache.store(serial, settings, pattern)
+      metrics.inc("ddguard_settings_reads_total", labels + (("result", "changed" if changed else "unchanged"),))
+   else:
+      # No radio read needed, the cached settings have all patterns
+      changed = p.settingsCache.setActiveBasalPattern(serial, pattern)
+   if changed:
+      print("[{0}] pump settings changed".format(p.name))
+      if datastore != None:
+         try:
+            datastore.store_settings(serial, p.settingsCache.get(serial))
+         except:
+            syslog.syslog(syslog.LOG_ERR, "Local data store ERROR")
+
+   # The profile is uploaded again until Nightscout accepted this version
+   entry = p.settingsCache.get(serial)
+   if p.nightscout != None and entry != None and p.settingsCache.version(entry) != p.profileVersion:
+      try:
+         with cnl24trace.span("nightscout.upload_profile"):
+            if p.nightscout.upload_profile(entry):
+               p.profileVersion = p.settingsCache.version(entry)
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Nightscout profile upload ERROR")
+
+
+#########################################################
+#
+# Function:    upload_live_data()
+# Description: Read live data from the pump of a patient
+#              and upload it to the enabled cloud services
+#              This runs once at startup and then every 
+#              5min, started by the scheduler
+# 
+#########################################################
+def upload_live_data(p):
    
-   print("read live data from pump")
+   print("[{0}] read live data from pump".format(p.name))
    hasFailed = True
    numRetries = MAX_RETRIES_AT_FAILURE
    while hasFailed and numRetries > 0:
       try:
-         liveData = cnl24driverlib.readLiveData()
+         liveData = p.cnlSession.readLiveData(READ_TIMEOUT)
          hasFailed = False
       except:
          print("unexpected ERROR occured while reading live data")
@@ -349,7 +574,9 @@ def upload_live_data():
          liveData = None
          numRetries -= 1
          if numRetries > 0:
+            metrics.inc("ddguard_read_retries_total", (("patient", p.name),))
             time.sleep(RETRY_DELAY)
+   metrics.update_session(p.name, p.cnlSession.statistics())
             
    # Account for pump RTC drift
    if liveData != None:
@@ -359,102 +586,239 @@ def upload_live_data():
       if liveData["sensorBGL"] != SENSOR_EXCEPTIONS.SENSOR_LOST:
          liveData["sensorBGLTimestamp"] += liveData["pumpTimeDrift"]
       print("   after : pumpTime {0},  sensorBGLTimestamp {1}".format(liveData["pumpTime"], liveData["sensorBGLTimestamp"]))
+      metrics.update_live_data(p.name, liveData, liveData["sensorBGL"] != SENSOR_EXCEPTIONS.SENSOR_LOST)
+
+   # Keep latest data in memory
+   if liveData != None:
+      p.liveBuffer.append(liveData)
+
+   # Keep data in local database
+   if datastore != None and liveData != None:
+      start = time.time()
+      stored = False
+      try:
+         with cnl24trace.span("datastore.store_live_data"):
+            datastore.store_live_data(liveData)
+         stored = True
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Local data store ERROR")
+      metrics.observe_upload(p.name, "datastore", time.time() - start, stored)
     
    # Upload data to Blynk server
-   if blynk != None:
+   if p.blynk != None:
+      start = time.time()
+      uploaded = False
       try:
-         blynk_upload(liveData)
+         with cnl24trace.span("blynk.upload"):
+            blynk_upload(p, liveData)
+         uploaded = True
       except:
          syslog.syslog(syslog.LOG_ERR, "Blynk upload ERROR")
+      metrics.observe_upload(p.name, "blynk", time.time() - start, uploaded)
 
    # Upload data to Nighscout server
-   if nightscout != None:
+   sensorUploaded = False
+   if p.nightscout != None and liveData != None:
+      start = time.time()
+      uploaded = False
       try:
-         nightscout.upload(liveData)
+         with cnl24trace.span("nightscout.upload"):
+            uploaded = p.nightscout.upload(liveData)
+         # Not uploaded e.g. while the sensor is lost
+         sensorUploaded = p.nightscout.sgv_uploaded
       except:
          syslog.syslog(syslog.LOG_ERR, "Nightscout upload ERROR")
+      metrics.observe_upload(p.name, "nightscout", time.time() - start, uploaded)
+
+   # Upload missed sensor readings and pump history (e.g. after the pump was out of range)
+   if liveData != None:
+      if sensorUploaded:
+         backfill_sensor_history(p, liveData)
+      sync_history(p)
+      # Read the pump settings only when they may have changed,
+      # after the live data went out
+      refresh_settings(p, liveData)
+   p.lastReadFailed = (liveData == None)
    
    # Calculate time until next reading
    if liveData != None:
       nextReading = liveData["sensorBGLTimestamp"] + datetime.timedelta(seconds=UPDATE_INTERVAL)
       tmoSeconds  = int((nextReading - datetime.datetime.now(liveData["pumpTime"].tzinfo)).total_seconds())
-      print("Next reading at {0}, {1} seconds from now\n".format(nextReading,tmoSeconds))
+      print("[{0}] Next reading at {1}, {2} seconds from now\n".format(p.name,nextReading,tmoSeconds))
       if tmoSeconds < 0:
          tmoSeconds = RETRY_INTERVAL
    else:
       tmoSeconds = RETRY_INTERVAL
-      print("Retry reading {0} seconds from now\n".format(tmoSeconds))
+      print("[{0}] Retry reading {1} seconds from now\n".format(p.name,tmoSeconds))
       
-   # Start timer for next cycle
-   cycleTimer = threading.Timer(tmoSeconds+10, upload_live_data)
-   cycleTimer.start()
+   # Schedule next cycle
+   p.nextCycle = time.time() + tmoSeconds + 10
    
-   cycleCount += 1
-   upload_live_data.active = False
+   p.cycleCount += 1
 
 
-##########################################################           
-# Setup
-##########################################################           
+#########################################################
+#
+# Class:       patient
+# Description: Everything which belongs to one patient: 
+#              the CNL stick with its session, the 
+#              uploaders the data is routed to and the
+#              state of the upload cycles
+# 
+#########################################################
+class patient(object):
+
+   def __init__(self, patientConfig):
+      self.name = patientConfig["name"]
+      self.is_connected = False
+      self.lastBolusTime = None
+      self.cycleCount = 0
+      self.lastHistorySync = 0
+      self.lastReadFailed = False
+      self.nextCycle = 0  # Start of the next upload cycle (time.time())
+      self.active = False # Upload cycle is running
+      self.liveBuffer = ringbufferlib.ring_buffer()
+      self.blynk = None
+      self.nightscout = None
+
+      # Init Blynk instance (if requested)
+      if patientConfig["blynk_token"] != "" and patientConfig["blynk_server"] != "":
+         print("[{0}] Blynk upload is enabled".format(self.name))
+         self.blynk = blynklib.Blynk(patientConfig["blynk_token"],
+                                     server=patientConfig["blynk_server"].strip(),
+                                     heartbeat=patientConfig["blynk_heartbeat"])
+
+         @self.blynk.handle_event("connect")
+         def connect_handler():
+            if not self.is_connected:
+               self.is_connected = True
+               print("[{0}] Connected to cloud server".format(self.name))
+               syslog.syslog(syslog.LOG_NOTICE, "Connected to cloud server ("+self.name+")")
+
+         @self.blynk.handle_event("disconnect")
+         def disconnect_handler():
+            if self.is_connected:
+               self.is_connected = False
+               print("[{0}] Disconnected from cloud server".format(self.name))
+               syslog.syslog(syslog.LOG_NOTICE, "Disconnected from cloud server ("+self.name+")")
+
+      # Init Nighscout instance (if requested)
+      if patientConfig["nightscout_server"] != "" and patientConfig["nightscout_api_secret"] != "":
+         print("[{0}] Nightscout upload is enabled".format(self.name))
+         self.nightscout = nightscoutlib.nightscout_uploader(server = patientConfig["nightscout_server"], 
+                                                             secret = patientConfig["nightscout_api_secret"])
+
+      # Init CNL session which is kept open across upload cycles,
+      # on the CNL stick with the given USB serial number or path.
+      # It runs in a worker process which is restarted if it hangs.
+      # The driver factory is passed to the fork server, so it must be picklable.
+      self.cnlSession = cnl24worker.WorkerSession(
+         functools.partial(cnl24driverlib.Medtronic600SeriesDriver,
+                           usbSerial=patientConfig["usb_serial"] or None,
+                           usbPath=patientConfig["usb_path"] or None))
+      self.historySync = cnl24driverlib.HistorySyncState()
+      self.settingsCache = cnl24driverlib.PumpSettingsCache()
+      self.profileVersion = None # Settings version which was uploaded to Nightscout
 
-# read configuration parameters
-if read_config(CONFIG_FILE) == False:
-   sys.exit()
 
-blynk_enabled = (read_config.blynk_token != "") and (read_config.blynk_server != "")
-nightscout_enabled = (read_config.nightscout_server != "") and (read_config.nightscout_api_secret != "")
-
-# Init Blynk instance
-if blynk_enabled:
-   print("Blynk upload is enabled")
-   blynk = blynklib.Blynk(read_config.blynk_token,
-                          server=read_config.blynk_server.strip(),
-                          heartbeat=read_config.blynk_heartbeat)
-
-   @blynk.handle_event("connect")
-   def connect_handler():
-      global is_connected
-      if not is_connected:
-         is_connected = True
-         print("Connected to cloud server")
-         syslog.syslog(syslog.LOG_NOTICE, "Connected to cloud server")
-
-   @blynk.handle_event("disconnect")
-   def disconnect_handler():
-      global is_connected
-      if is_connected:
-         is_connected = False
-         print("Disconnected from cloud server")
-         syslog.syslog(syslog.LOG_NOTICE, "Disconnected from cloud server")
-
-# Init Nighscout instance (if requested)
-if nightscout_enabled:
-   print("Nightscout upload is enabled")
-   nightscout = nightscoutlib.nightscout_uploader(server = read_config.nightscout_server, 
-                                                  secret = read_config.nightscout_api_secret)
-
-
-##########################################################           
-# Initialization
-##########################################################           
-syslog.syslog(syslog.LOG_NOTICE, "Starting DD-Guard daemon, version "+VERSION)
-
-# Init signal handler
-signal.signal(signal.SIGINT, on_sigterm)
-signal.signal(signal.SIGTERM, on_sigterm)
-
-upload_live_data.active = False
-
-# Perform first upload immediately
-# Subsequent uploads will be scheduled according to received data timestamp
-t = threading.Thread(target=upload_live_data, args=())
-t.start()
-
-##########################################################           
-# Main loop
-##########################################################           
-while True:
-   if blynk_enabled:
-      blynk.run()
-   else:
-      time.sleep(0.1)
+#########################################################
+#
+# Function:    run_cycle()
+# Description: Run one upload cycle of a patient as one
+#              trace, all its spans share the trace ID.
+#              The patient is released for the scheduler
+#              even if the cycle fails, a failed cycle is
+#              retried after RETRY_INTERVAL
+# 
+#########################################################
+def run_cycle(p):
+   cnl24trace.tracer.beginTrace()
+   start = time.time()
+   try:
+      with cnl24trace.span("cycle", {"patient": p.name} if cnl24trace.tracer.enabled else None):
+         upload_live_data(p)
+   except:
+      syslog.syslog(syslog.LOG_ERR, "Unexpected ERROR occured in upload cycle of "+p.name)
+      p.lastReadFailed = True
+      p.nextCycle = time.time() + RETRY_INTERVAL
+   finally:
+      p.active = False
+   metrics.observe_cycle(p.name, time.time() - start, not p.lastReadFailed)
+
+
+#########################################################
+#
+# Function:    run_scheduler()
+# Description: Start the upload cycle of each patient
+#              when it is due, each in its own thread
+#              so that a slow CNL stick does not delay 
+#              the others
+# 
+#########################################################
+def run_scheduler():
+   now = time.time()
+   for p in patients:
+      if not p.active and now >= p.nextCycle:
+         p.active = True
+         t = threading.Thread(target=run_cycle, args=(p,))
+         t.daemon = True
+         t.start()
+
+
+# The CNL workers are started by a fork server, which imports this
+# module without running the daemon
+if __name__ == "__main__":
+
+   ##########################################################           
+   # Setup
+   ##########################################################           
+
+   # read configuration parameters
+   if read_config(CONFIG_FILE) == False:
+      sys.exit()
+
+   # Init one instance per patient
+   for patientConfig in read_config.patients:
+      patients.append(patient(patientConfig))
+
+   # Init local data store (if requested)
+   if read_config.storage_database != "":
+      print("Local data store is enabled")
+      datastore = datastorelib.data_store(read_config.storage_database)
+
+   # Enable tracing (if requested)
+   if read_config.trace_file != "":
+      print("Tracing is enabled")
+      cnl24trace.tracer.enabled = True
+
+   # Start metrics server (if requested)
+   if read_config.metrics_port != 0:
+      print("Metrics server is enabled")
+      metricslib.start_server(metrics, read_config.metrics_address, read_config.metrics_port)
+
+
+   ##########################################################           
+   # Initialization
+   ##########################################################           
+   syslog.syslog(syslog.LOG_NOTICE, "Starting DD-Guard daemon, version "+VERSION)
+
+   # Init signal handler
+   signal.signal(signal.SIGINT, on_sigterm)
+   signal.signal(signal.SIGTERM, on_sigterm)
+   signal.signal(signal.SIGUSR2, on_sigusr2)
+
+   # First uploads are performed immediately
+   # Subsequent uploads will be scheduled according to received data timestamp
+
+   ##########################################################           
+   # Main loop
+   ##########################################################           
+   while True:
+      run_scheduler()
+      blynk_enabled = False
+      for p in patients:
+         if p.blynk != None:
+            p.blynk.run()
+            blynk_enabled = True
+      if not blynk_enabled:
+         time.sleep(0.1)
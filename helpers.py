@@ -1,6 +1,6 @@
 import datetime
 import struct
-from dateutil import tz
+import cnl24time
 
 
 class DateTimeHelper( object ):
@@ -26,8 +26,8 @@ class DateTimeHelper( object ):
         # For example, if baseTime + rtc + offset was 1463137668, this would be
         # Fri, 13 May 2016 21:07:48 UTC.
         # However, the time the pump *means* is Fri, 13 May 2016 21:07:48 in our own timezone
-        offsetFromUTC = (datetime.datetime.utcnow() - datetime.datetime.now()).total_seconds()
-        epochTime = DateTimeHelper.baseTime + rtc + offset + offsetFromUTC
+        # The UTC offset of our timezone at that time is taken from the cached table in cnl24time
+        epochTime = cnl24time.epochTime(rtc, offset)
         if epochTime < 0:
             epochTime = 0
 
@@ -35,11 +35,18 @@ class DateTimeHelper( object ):
 
         # Return a non-naive datetime in the local timezone
         # (so that we can convert to UTC for Nightscout later)
-        localTz = tz.tzlocal()
-        result = datetime.datetime.fromtimestamp( epochTime, localTz )
+        result = cnl24time.toDateTime(epochTime)
         #print ' ### DateTimeHelper.decodeDateTime {0:x} {1}'.format(pumpDateTime, result)        
         return result
 
+    @staticmethod
+    def pumpEpochTime(rtc, offset):
+        # Seconds since the epoch of the pump time, see decodeDateTime().
+        # Also works on whole NumPy columns of rtc and offset values.
+        if hasattr(rtc, 'shape'):
+            return cnl24time.epochTimes(rtc, offset)
+        return cnl24time.epochTime(rtc, offset)
+
     @staticmethod
     def rtcFromDate(userDate, offset):
         epochTime = int((userDate - DateTimeHelper.epoch).total_seconds())
@@ -49,6 +56,11 @@ class DateTimeHelper( object ):
         #print ' ### DateTimeHelper.rtcFromDate rtc:0x{0:x} {0} offset:0x{1:x} {1} epochTime:0x{2:x} {2}'.format(rtc, offset, epochTime)                    
         return rtc
 
+    @staticmethod
+    def dateFromRtc(rtc, offset):
+        # Inverse of rtcFromDate()
+        return DateTimeHelper.epoch + datetime.timedelta(seconds = rtc + offset + DateTimeHelper.baseTime)
+
 class NumberHelper( object):
     @staticmethod
     def make32BitIntFromNBitSignedInt(signedValue, nBits):
@@ -12,7 +12,15 @@ cp ddguard.py $BINDIR
 cp helpers.py $BINDIR
 cp sensor_codes.py $BINDIR
 cp cnl24driverlib.py $BINDIR
+cp cnl24codec.py $BINDIR
+cp cnl24history.py $BINDIR
+cp cnl24time.py $BINDIR
+cp cnl24worker.py $BINDIR
+cp cnl24trace.py $BINDIR
 cp nightscoutlib.py $BINDIR
+cp datastorelib.py $BINDIR
+cp ringbufferlib.py $BINDIR
+cp metricslib.py $BINDIR
 
 echo "Installing udev scripts"
 cp script/30-contour.rules /etc/udev/rules.d/
@@ -20,6 +28,7 @@ cp script/contour-hotplug.sh $BINDIR
 
 echo "Installing configuration file"
 cp conf/ddguard.conf /etc/
+mkdir -p /var/lib/ddguard
 
 echo "Enable and start daemon"
 cp init.d/ddguard /etc/init.d/
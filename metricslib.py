@@ -0,0 +1,279 @@
+###############################################################################
+#
+#  Diabetes Data Guard (DD-Guard): Metrics library
+#
+#  Description:
+#
+#    This library collects health and performance metrics of the gateway
+#    (upload cycles, CNL communication, uploads) and serves them in the
+#    Prometheus text format on a local HTTP port. The metrics are updated
+#    by the upload cycles, a scrape only reads the values kept in memory.
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    17/10/2026 - Initial version
+#    17/10/2026 - Count the pump settings reads
+#
+#  Copyright 2019-2020, Ondrej Wisniewski
+#
+#  This file is part of the DD-Guard project.
+#
+#  DD-Guard is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with crelay.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+CYCLE_BUCKETS  = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+UPLOAD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+# Metric definitions: name, type, help text
+METRICS = [
+   ("ddguard_cycles_total",                     "counter",   "Upload cycles by result"),
+   ("ddguard_cycle_duration_seconds",           "histogram", "Duration of the upload cycles"),
+   ("ddguard_read_retries_total",               "counter",   "Live data reads which were repeated after a failure"),
+   ("ddguard_pump_request_retries_total",       "counter",   "Pump requests repeated within the open session"),
+   ("ddguard_cleared_messages_total",           "counter",   "Unexpected messages drained from the CNL message stream"),
+   ("ddguard_worker_restarts_total",            "counter",   "Driver worker processes killed because they did not respond"),
+   ("ddguard_handshake_stage_seconds",          "gauge",     "Duration of the last run of each handshake stage"),
+   ("ddguard_protocol_latency_milliseconds",    "summary",   "Observed response latency per protocol phase"),
+   ("ddguard_protocol_timeout_milliseconds",    "gauge",     "Current read timeout per protocol phase"),
+   ("ddguard_radio_channel",                    "gauge",     "Negotiated radio channel"),
+   ("ddguard_radio_rssi",                       "gauge",     "RSSI reported when the channel was negotiated"),
+   ("ddguard_pump_time_drift_seconds",          "gauge",     "Drift of the pump clock"),
+   ("ddguard_sensor_reading_timestamp_seconds", "gauge",     "Time of the latest sensor reading"),
+   ("ddguard_sensor_reading_age_seconds",       "gauge",     "Age of the latest sensor reading"),
+   ("ddguard_upload_duration_seconds",          "histogram", "Duration of the uploads per sink"),
+   ("ddguard_upload_errors_total",              "counter",   "Failed uploads per sink"),
+   ("ddguard_settings_reads_total",             "counter",   "Pump settings reads by result"),
+]
+
+
+# Histogram with fixed buckets
+class histogram(object):
+
+   def __init__(self, buckets):
+      self.buckets = buckets
+      self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+      self.sum = 0.0
+      self.count = 0
+
+   def observe(self, value):
+      self.counts[bisect.bisect_left(self.buckets, value)] += 1
+      self.sum += value
+      self.count += 1
+
+
+def format_labels(labels, extra=()):
+   pairs = list(labels) + list(extra)
+   if len(pairs) == 0:
+      return ""
+   return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name,value in pairs) + "}"
+
+
+def format_value(value):
+   if isinstance(value, float):
+      return repr(value)
+   return str(value)
+
+
+# Gateway metrics class
+#
+# Values are kept per metric and label set, labels are a tuple of
+# (name, value) pairs. Updates and scrapes hold the lock only while
+# the values in memory are accessed.
+class gateway_metrics(object):
+
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.values = dict((name, {}) for name,_,_ in METRICS)
+
+   def inc(self, name, labels, amount=1):
+      with self.lock:
+         self.values[name][labels] = self.values[name].get(labels, 0) + amount
+
+   def set(self, name, labels, value):
+      with self.lock:
+         self.values[name][labels] = value
+
+   def observe(self, name, labels, value, buckets):
+      with self.lock:
+         if labels not in self.values[name]:
+            self.values[name][labels] = histogram(buckets)
+         self.values[name][labels].observe(value)
+
+
+   #########################################################
+   #
+   # Function:    observe_cycle()
+   # Description: Record the duration and result of one
+   #              upload cycle
+   #
+   #########################################################
+   def observe_cycle(self, patient, duration, ok):
+      labels = (("patient", patient),)
+      self.observe("ddguard_cycle_duration_seconds", labels, duration, CYCLE_BUCKETS)
+      self.inc("ddguard_cycles_total", labels + (("result", "ok" if ok else "failed"),))
+
+
+   #########################################################
+   #
+   # Function:    observe_upload()
+   # Description: Record the duration and result of an
+   #              upload to one sink (blynk, nightscout,
+   #              datastore)
+   #
+   #########################################################
+   def observe_upload(self, patient, sink, duration, ok):
+      labels = (("patient", patient), ("sink", sink))
+      self.observe("ddguard_upload_duration_seconds", labels, duration, UPLOAD_BUCKETS)
+      if not ok:
+         self.inc("ddguard_upload_errors_total", labels)
+      else:
+         # Makes the series visible before the first error
+         self.inc("ddguard_upload_errors_total", labels, 0)
+
+
+   #########################################################
+   #
+   # Function:    update_session()
+   # Description: Take over the statistics of the CNL
+   #              session (PersistentSession.statistics())
+   #
+   #########################################################
+   def update_session(self, patient, statistics):
+      labels = (("patient", patient),)
+      # The session counters are totals, they start again from 0 in a new worker
+      for name, key in [("ddguard_pump_request_retries_total", "requestRetries"),
+                        ("ddguard_cleared_messages_total",     "clearedMessages"),
+                        ("ddguard_worker_restarts_total",      "workerRestarts")]:
+         if key in statistics:
+            self.set(name, labels, statistics[key])
+      for stage, duration in statistics.get("stageDurations", {}).items():
+         self.set("ddguard_handshake_stage_seconds", labels + (("stage", stage),), duration)
+      for phase, (count, median, percentile, timeout) in statistics.get("phaseLatencies", {}).items():
+         phaseLabels = labels + (("phase", phase),)
+         self.set("ddguard_protocol_latency_milliseconds", phaseLabels, (count, median, percentile))
+         self.set("ddguard_protocol_timeout_milliseconds", phaseLabels, timeout)
+      if statistics.get("radioChannel") != None:
+         self.set("ddguard_radio_channel", labels, statistics["radioChannel"])
+      if statistics.get("rssi") != None:
+         self.set("ddguard_radio_rssi", labels, statistics["rssi"])
+
+
+   #########################################################
+   #
+   # Function:    update_live_data()
+   # Description: Take over the pump time drift and the
+   #              time of the sensor reading from the live
+   #              data (after the drift was applied)
+   #
+   #########################################################
+   def update_live_data(self, patient, data, sensor_valid):
+      labels = (("patient", patient),)
+      self.set("ddguard_pump_time_drift_seconds", labels, data["pumpTimeDrift"].total_seconds())
+      if sensor_valid:
+         self.set("ddguard_sensor_reading_timestamp_seconds", labels, data["sensorBGLTimestamp"].timestamp())
+
+
+   #########################################################
+   #
+   # Function:    render()
+   # Description: Return all metrics in the Prometheus
+   #              text format
+   #
+   #########################################################
+   def render(self):
+      now = time.time()
+      lines = []
+      values = {}
+      with self.lock:
+         for name, kind, _ in METRICS:
+            if kind == "histogram":
+               values[name] = dict((labels, (h.buckets, list(h.counts), h.sum, h.count)) for labels,h in self.values[name].items())
+            else:
+               values[name] = dict(self.values[name])
+      # The age is derived from the time of the reading when scraped
+      values["ddguard_sensor_reading_age_seconds"] = dict((labels, now - timestamp)
+         for labels,timestamp in values["ddguard_sensor_reading_timestamp_seconds"].items())
+
+      for name, kind, text in METRICS:
+         if len(values[name]) == 0:
+            continue
+         lines.append("# HELP {0} {1}".format(name, text))
+         lines.append("# TYPE {0} {1}".format(name, kind))
+         for labels, value in sorted(values[name].items()):
+            if kind == "histogram":
+               buckets, counts, total, count = value
+               cumulative = 0
+               for bound, bucketCount in zip(list(buckets) + ["+Inf"], counts):
+                  cumulative += bucketCount
+                  lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels, (("le", bound),)), cumulative))
+               lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), format_value(total)))
+               lines.append("{0}_count{1} {2}".format(name, format_labels(labels), count))
+            elif kind == "summary":
+               count, median, percentile = value
+               lines.append("{0}{1} {2}".format(name, format_labels(labels, (("quantile", "0.5"),)), format_value(median)))
+               lines.append("{0}{1} {2}".format(name, format_labels(labels, (("quantile", "0.95"),)), format_value(percentile)))
+               lines.append("{0}_count{1} {2}".format(name, format_labels(labels), count))
+            else:
+               lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(value)))
+      return "\n".join(lines) + "\n"
+
+
+# HTTP request handler for the /metrics path
+class metrics_handler(BaseHTTPRequestHandler):
+
+   def do_GET(self):
+      if self.path.split("?")[0] != "/metrics":
+         self.send_error(404)
+         return
+      body = self.server.metrics.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      # No log line per scrape
+      pass
+
+
+class metrics_server(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+
+
+#########################################################
+#
+# Function:    start_server()
+# Description: Serve the metrics on the given address
+#              and port in a background thread
+#
+#########################################################
+def start_server(metrics, address, port):
+   server = metrics_server((address, port), metrics_handler)
+   server.metrics = metrics
+   t = threading.Thread(target=server.serve_forever, name="metrics-server")
+   t.daemon = True
+   t.start()
+   return server
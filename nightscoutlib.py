@@ -22,6 +22,15 @@
 #    28/06/2020 - Syntax updates for Python3
 #    02/01/2021 - Upload latest bolus
 #    03/01/2021 - Upload current basal as temp basal
+#    17/10/2026 - Upload pump history events as treatments in bulk
+#    17/10/2026 - Backfill missed sensor readings from the pump history
+#    17/10/2026 - Convert times to Nightscout dates without strftime()
+#    17/10/2026 - Trace the API requests with cnl24trace
+#    17/10/2026 - Upload the pump settings as profile
+#    17/10/2026 - Upload boluses and temp basals only once from live and history data
+#    17/10/2026 - A lost sensor is no upload error, keep it apart in sgv_uploaded
+#    17/10/2026 - Upload the sensor history from its reading columns
+#    17/10/2026 - Convert the times of all history events at once
 #
 #  Copyright 2019-2020, Ondrej Wisniewski 
 #  
@@ -43,9 +52,13 @@
 ###############################################################################
 import json
 import syslog
+import collections
 import hashlib
 import requests
 from sensor_codes import SENSOR_EXCEPTIONS
+from cnl24history import NGP_HISTORY_EVENT_TYPE, iterSensorReadings
+import cnl24time
+import cnl24trace
 
 
 # Nightscout error codes
@@ -75,6 +88,14 @@ class NS_TREND:
    RATE_OUT_OF_RANGE     = "RATE OUT OF RANGE"
    NOT_SET               = "NONE"
 
+# Names of the pump basal patterns
+BASAL_PATTERN_NAMES = {1: "Pattern 1", 2: "Pattern 2", 3: "Pattern 3", 4: "Pattern 4", 5: "Pattern 5",
+                       6: "Work Day", 7: "Day Off", 8: "Sick Day"}
+
+# Number of recently uploaded boluses and live basal records which are
+# remembered to skip them in the history upload (one week of live cycles)
+UPLOADED_WINDOW = 2016
+
 # Nightscout uploader class
 class nightscout_uploader(object):
    
@@ -92,6 +113,11 @@ class nightscout_uploader(object):
                            "api-secret":self.api_secret
                         }
       self.latest_bolus = 0
+      self.sgv_uploaded = False # Sensor value of the last upload() was accepted
+      # Bolus references and live basal times (ms) already uploaded, the
+      # live and history uploads skip each other's records with these
+      self.uploaded_boluses = collections.deque(maxlen=UPLOADED_WINDOW)
+      self.uploaded_basals = collections.deque(maxlen=UPLOADED_WINDOW)
       
    # Trend mapping
    def direction_str(self, trend):
@@ -132,16 +158,31 @@ class nightscout_uploader(object):
          return NS_ERROR.NO_ANTENNA,NS_TREND.NOT_COMPUTABLE
       
       
+   #########################################################
+   #
+   # Function:    post()
+   # Description: Send a POST request to the API, traced
+   #              as one span per request
+   # 
+   #########################################################
+   def post(self, url, payload):
+      with cnl24trace.span("nightscout.post", {"url": url[len(self.ns_url):]} if cnl24trace.tracer.enabled else None):
+         return requests.post(url, headers = self.headers, data = json.dumps(payload))
+
+
    #########################################################
    #
    # Function:    upload_entries()
    # Description: Upload sensor data via the entries/ 
-   #              API endpoint
+   #              API endpoint. Returns False only if
+   #              the request failed, sgv_uploaded tells
+   #              whether a sensor value was uploaded.
    # 
    #########################################################
    def upload_entries(self, data):
 
       rc = True
+      self.sgv_uploaded = False
       url = self.ns_url + self.api_base + "entries.json"
       sgv = data["sensorBGL"]
       trend = data["trendArrow"]
@@ -151,7 +192,7 @@ class nightscout_uploader(object):
       # We don't upload any sensor data in this case
       if (sgv == 0) and (trend == -3): # and (date.strftime("%c").find("01:00:00 1970") != -1):
          print("Sensor lost, not uploading SGV data")
-         return False
+         return rc
       
       # Check for exception codes
       if sgv >= 0x0300:
@@ -163,7 +204,7 @@ class nightscout_uploader(object):
             "device":self.device+data["serial"],
             "type":"sgv",
             "dateString":date.isoformat(),
-            "date":int(date.strftime("%s"))*1000,
+            "date":cnl24time.dateMs(date),
             "sgv":sgv,
             "direction":trend_str
          }
@@ -173,11 +214,13 @@ class nightscout_uploader(object):
       
       try:
          #print "Send API request"
-         r = requests.post(url, headers = self.headers, data = json.dumps(payload))
+         r = self.post(url, payload)
          #print "API response: "+r.text
          if r.status_code != requests.codes.ok:
             syslog.syslog(syslog.LOG_ERR, "Uploading entries record returned error "+str(r.status_code))
             rc = False
+         else:
+            self.sgv_uploaded = True
       except:
          #print "Uploading entries record failed with exception"
          syslog.syslog(syslog.LOG_ERR, "Uploading entries record failed with exception")
@@ -211,16 +254,16 @@ class nightscout_uploader(object):
       
       payload = {
             "device":self.device+data["serial"],
-            "created_at": int(date.strftime("%s"))*1000,
+            "created_at": cnl24time.dateMs(date),
             "uploaderBattery":100, # FIXME
             "pump": {
-               "clock":int(date.strftime("%s"))*1000,
+               "clock":cnl24time.dateMs(date),
                "reservoir":data["insulinUnitsRemaining"],
                "battery": {
                   "percent":data["batteryLevelPercentage"]
                },
                "iob": {
-                  "timestamp":int(date.strftime("%s"))*1000,
+                  "timestamp":cnl24time.dateMs(date),
                   "bolusiob":data["activeInsulin"]
                },
                "status": {
@@ -235,7 +278,7 @@ class nightscout_uploader(object):
   
       try:
          #print "Send API request"
-         r = requests.post(url, headers = self.headers, data = json.dumps(payload))
+         r = self.post(url, payload)
          #print "API response: "+r.text
          if r.status_code != requests.codes.ok:
             syslog.syslog(syslog.LOG_ERR, "Uploading entries record returned error "+str(r.status_code))
@@ -265,14 +308,20 @@ class nightscout_uploader(object):
           # latest bolus entry already uploaded -> skipping upload
           return rc
 
+      if data["lastBolusReference"] in self.uploaded_boluses:
+          # already uploaded from the pump history -> skipping upload
+          self.latest_bolus = data["lastBolusReference"]
+          return rc
+
       url = self.ns_url + self.api_base + "treatments"
-      date = data["lastBolusTime"]
+      # Same pump time drift correction as the history events
+      date = data["lastBolusTime"] + data["pumpTimeDrift"]
 
       # TODO: send carbs and decide between correction- and
       #        "meals bolus" as eventType
       payload = {
          "eventType": "Correction Bolus",
-         "created_at": int(date.strftime("%s"))*1000,
+         "created_at": cnl24time.dateMs(date),
          "glucose": data["recentBGL"] or None,
          "insulin": data["lastBolusAmount"],
          "device": self.device+data["serial"],
@@ -283,7 +332,7 @@ class nightscout_uploader(object):
 
       try:
          #print "Send API request"
-         r = requests.post(url, headers = self.headers, data = json.dumps(payload))
+         r = self.post(url, payload)
          #print(r)
          #print "API response: "+r.text
          if r.status_code != requests.codes.ok:
@@ -292,6 +341,7 @@ class nightscout_uploader(object):
             pass
          else:
             self.latest_bolus = data["lastBolusReference"]
+            self.uploaded_boluses.append(data["lastBolusReference"])
             print("...uploaded new bolus entry")
             pass
       except:
@@ -323,7 +373,7 @@ class nightscout_uploader(object):
       payload = {
          "eventType": "Temp Basal",
          "device": self.device+data["serial"],
-         "created_at": int(date.strftime("%s"))*1000,
+         "created_at": cnl24time.dateMs(date),
          "absolute": data["currentBasalRate"],
          "duration": 5,
       }
@@ -333,12 +383,14 @@ class nightscout_uploader(object):
 
       try:
          #print "Send API request"
-         r = requests.post(url, headers = self.headers, data = json.dumps(payload))
+         r = self.post(url, payload)
          #print(r)
          #print("API response: "+r.text)
          if r.status_code != requests.codes.ok:
             syslog.syslog(syslog.LOG_ERR, "Uploading basal record returned error "+str(r.status_code))
             rc = False
+         else:
+            self.uploaded_basals.append(payload["created_at"])
       except:
          #print("Uploading basal record failed with exception")
          syslog.syslog(syslog.LOG_ERR, "Uploading basal record failed with exception")
@@ -349,6 +401,239 @@ class nightscout_uploader(object):
       return rc
    
 
+   #########################################################
+   #
+   # Function:    history_treatment()
+   # Description: Convert a pump history event with its
+   #              Nightscout time into a Nightscout 
+   #              treatment, None if the event is not 
+   #              uploaded
+   # 
+   #########################################################
+   def history_treatment(self, event, created_at, data):
+
+      eventType = getattr(event, "eventType", None)
+      treatment = {
+         "created_at": created_at,
+         "device": self.device+data["serial"],
+      }
+
+      if eventType == NGP_HISTORY_EVENT_TYPE.NORMAL_BOLUS_DELIVERED:
+         # Already uploaded as the last bolus of the live data
+         if event.bolusNumber in self.uploaded_boluses:
+            return None
+         treatment["eventType"] = "Correction Bolus"
+         treatment["insulin"] = event.deliveredAmount
+      elif eventType == NGP_HISTORY_EVENT_TYPE.BOLUS_WIZARD_ESTIMATE:
+         # The insulin is uploaded with the delivered bolus
+         if event.carbInput == 0 and event.bgInput == 0:
+            return None
+         treatment["eventType"] = "Bolus Wizard"
+         treatment["carbs"] = event.carbInput or None
+         treatment["glucose"] = event.bgInput or None
+      elif eventType == NGP_HISTORY_EVENT_TYPE.TEMP_BASAL_PROGRAMMED:
+         # The live data already reports the delivered basal rate
+         # while this temp basal was running
+         end = created_at + event.duration * 60000
+         if any(created_at <= t < end for t in self.uploaded_basals):
+            return None
+         treatment["eventType"] = "Temp Basal"
+         treatment["duration"] = event.duration
+         if event.type == 0:
+            treatment["absolute"] = event.rate
+         else:
+            treatment["percent"] = event.percentageOfRate - 100
+      elif eventType == NGP_HISTORY_EVENT_TYPE.INSULIN_DELIVERY_STOPPED:
+         treatment["eventType"] = "Suspend Pump"
+      elif eventType == NGP_HISTORY_EVENT_TYPE.INSULIN_DELIVERY_RESTARTED:
+         treatment["eventType"] = "Resume Pump"
+      elif eventType == NGP_HISTORY_EVENT_TYPE.BLOOD_GLUCOSE_READING:
+         treatment["eventType"] = "BG Check"
+         treatment["glucose"] = event.bgValue
+         treatment["glucoseType"] = "Finger"
+         treatment["units"] = "mg/dl"
+      else:
+         return None
+
+      return treatment
+
+
+   #########################################################
+   #
+   # Function:    upload_history()
+   # Description: Upload pump history events via the
+   #              treatments/API endpoint, all in one
+   #              request.
+   # 
+   #########################################################
+   def upload_history(self, data):
+
+      rc = True
+      url = self.ns_url + self.api_base + "treatments"
+
+      # The times of all events are converted at once
+      dates = cnl24time.epochMsBatch(((event.rtc, event.offset) for event in data["events"]),
+                                     data["pumpTimeDrift"].total_seconds())
+      treatments = [t for t in (self.history_treatment(event, created_at, data)
+                                for event, created_at in zip(data["events"], dates)) if t != None]
+      if len(treatments) == 0:
+         return rc
+
+      #print("url: " + url)
+      #print("payload: "+json.dumps(treatments))
+
+      try:
+         r = self.post(url, treatments)
+         if r.status_code != requests.codes.ok:
+            syslog.syslog(syslog.LOG_ERR, "Uploading history treatments returned error "+str(r.status_code))
+            rc = False
+         else:
+            for event in data["events"]:
+               if getattr(event, "eventType", None) == NGP_HISTORY_EVENT_TYPE.NORMAL_BOLUS_DELIVERED and \
+                  event.bolusNumber not in self.uploaded_boluses:
+                  self.uploaded_boluses.append(event.bolusNumber)
+            print("...uploaded {0} history treatments".format(len(treatments)))
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Uploading history treatments failed with exception")
+         rc = False
+
+      return rc
+
+
+   #########################################################
+   #
+   # Function:    history_entry()
+   # Description: Convert a sensor history reading (pump
+   #              epoch time, sg, trend arrow) into a
+   #              Nightscout SGV entry, None if the reading
+   #              is not uploaded
+   # 
+   #########################################################
+   def history_entry(self, epoch_time, sgv, trend_arrow, data):
+
+      if not sgv:
+         # No reading or sensor lost
+         return None
+
+      # Check for exception codes
+      if sgv >= 0x0300:
+         exception = self.exception_code(sgv)
+         if exception == None:
+            return None
+         sgv,trend_str = exception
+      else:
+         trend_str = self.direction_str(trend_arrow)
+
+      date = int(epoch_time + data["pumpTimeDrift"].total_seconds())*1000
+      return {
+            "device":self.device+data["serial"],
+            "type":"sgv",
+            "dateString":cnl24time.toDateTime(date/1000.0).isoformat(),
+            "date":date,
+            "sgv":sgv,
+            "direction":trend_str
+         }
+
+
+   #########################################################
+   #
+   # Function:    upload_sensor_history()
+   # Description: Upload sensor readings from the pump 
+   #              history (e.g. missed while the pump was 
+   #              out of range) via the entries/ API 
+   #              endpoint, all in one request.
+   # 
+   #########################################################
+   def upload_sensor_history(self, data):
+
+      rc = True
+      url = self.ns_url + self.api_base + "entries.json"
+
+      if data.get("sensorColumns") == None:
+         return rc
+      readings = iterSensorReadings(data["sensorColumns"], ("timestamp", "sg", "trendArrow"))
+      entries = [e for e in (self.history_entry(t, sgv, trend, data) for t, sgv, trend in readings) if e != None]
+      if len(entries) == 0:
+         return rc
+
+      try:
+         r = self.post(url, entries)
+         if r.status_code != requests.codes.ok:
+            syslog.syslog(syslog.LOG_ERR, "Uploading sensor history returned error "+str(r.status_code))
+            rc = False
+         else:
+            print("...uploaded {0} missed sensor readings".format(len(entries)))
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Uploading sensor history failed with exception")
+         rc = False
+
+      return rc
+
+
+   # Pump schedule (start in minutes after midnight) as Nightscout profile time slots
+   def profile_schedule(self, items, key):
+      return [{"time": "{0:02d}:{1:02d}".format(item["start"] // 60, item["start"] % 60),
+               "timeAsSeconds": item["start"] * 60,
+               "value": item[key]} for item in items]
+
+
+   #########################################################
+   #
+   # Function:    upload_profile()
+   # Description: Upload the pump settings (an entry of the
+   #              PumpSettingsCache) via the profile/ API
+   #              endpoint, one profile per basal pattern.
+   #              The active pattern is the default profile.
+   # 
+   #########################################################
+   def upload_profile(self, entry):
+
+      rc = True
+      url = self.ns_url + self.api_base + "profile"
+      settings = entry["settings"]
+      mills = int(entry["readAt"]) * 1000
+
+      store = {}
+      default = None
+      for pattern in settings["basalPatterns"]:
+         name = BASAL_PATTERN_NAMES.get(pattern["number"], "Pattern {0}".format(pattern["number"]))
+         if default == None or pattern["number"] == entry["activeBasalPattern"]:
+            default = name
+         store[name] = {
+            "basal":       self.profile_schedule(pattern["rates"], "rate"),
+            "carbratio":   self.profile_schedule(settings["carbRatios"], "grams"),
+            "sens":        self.profile_schedule(settings["sensitivityFactors"], "mgdl"),
+            "target_low":  self.profile_schedule(settings["bgTargets"], "lowMgdl"),
+            "target_high": self.profile_schedule(settings["bgTargets"], "highMgdl"),
+            "units":       "mg/dl",
+         }
+      if len(store) == 0:
+         return rc
+
+      payload = {
+         "defaultProfile": default,
+         "store": store,
+         "startDate": cnl24time.toDateTime(entry["readAt"]).isoformat(),
+         "mills": mills,
+         "created_at": mills,
+         "units": "mg/dl",
+         "enteredBy": "dd-guard",
+      }
+
+      try:
+         r = self.post(url, payload)
+         if r.status_code != requests.codes.ok:
+            syslog.syslog(syslog.LOG_ERR, "Uploading profile returned error "+str(r.status_code))
+            rc = False
+         else:
+            print("...uploaded pump settings as profile")
+      except:
+         syslog.syslog(syslog.LOG_ERR, "Uploading profile failed with exception")
+         rc = False
+
+      return rc
+
+
    #########################################################
    #
    # Function:    upload()
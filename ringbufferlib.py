@@ -0,0 +1,146 @@
+###############################################################################
+#
+#  Diabetes Data Guard (DD-Guard): Ring buffer library
+#
+#  Description:
+#
+#    This library keeps the latest live data snapshots (by default the
+#    last 24 hours) in memory, one fixed size array per data column
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    17/10/2026 - Initial version
+#
+#  Copyright 2019-2020, Ondrej Wisniewski
+#
+#  This file is part of the DD-Guard project.
+#
+#  DD-Guard is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with crelay.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+import array
+import bisect
+import threading
+from sensor_codes import SENSOR_EXCEPTIONS
+
+
+# Column names and array type codes
+COLUMNS = [("timestamp", "d"), # Seconds since the epoch
+           ("sgv",       "h"), # Sensor BGL or exception code
+           ("trend",     "b"), # Trend arrows, TREND_UNKNOWN if not known
+           ("iob",       "d"), # Active insulin
+           ("reservoir", "d"), # Insulin units remaining
+           ("battery",   "B")] # Pump battery level (%)
+
+TREND_UNKNOWN = -128
+
+# One snapshot every 5 minutes for 24 hours
+DEFAULT_CAPACITY = 24 * 60 // 5
+
+
+# Ring buffer class
+#
+# Each column is stored twice in a row (array of 2 x capacity), every value
+# is written at index i and i + capacity. This way the latest n values are
+# always in one contiguous part of the array and can be returned as a
+# memoryview without copying, even if they wrap around the end of the ring.
+class ring_buffer(object):
+
+   def __init__(self, capacity=DEFAULT_CAPACITY):
+      self.capacity = capacity
+      self.columns = dict((name, array.array(code, [0]) * (2 * capacity)) for name,code in COLUMNS)
+      self.head = 0   # Index of the next write (0..capacity-1)
+      self.count = 0
+      self.lock = threading.Lock()
+
+   def __len__(self):
+      return self.count
+
+   def put(self, index, values):
+      for name,_ in COLUMNS:
+         column = self.columns[name]
+         column[index] = column[index + self.capacity] = values[name]
+
+
+   #########################################################
+   #
+   # Function:    append()
+   # Description: Append the live data snapshot of one
+   #              cycle (after the pump time drift was
+   #              applied), O(1). A snapshot which is not
+   #              newer than the latest one replaces it.
+   #
+   #########################################################
+   def append(self, data):
+
+      if data["sensorBGL"] != SENSOR_EXCEPTIONS.SENSOR_LOST:
+         timestamp = data["sensorBGLTimestamp"].timestamp()
+      else:
+         timestamp = data["pumpTime"].timestamp()
+      values = {
+         "timestamp": timestamp,
+         "sgv":       data["sensorBGL"],
+         "trend":     data["trendArrow"] if data["trendArrow"] != None else TREND_UNKNOWN,
+         "iob":       data["activeInsulin"],
+         "reservoir": data["insulinUnitsRemaining"],
+         "battery":   data["batteryLevelPercentage"],
+      }
+
+      with self.lock:
+         last = (self.head - 1) % self.capacity
+         if self.count > 0 and timestamp <= self.columns["timestamp"][last]:
+            self.put(last, values)
+            return
+         self.put(self.head, values)
+         self.head = (self.head + 1) % self.capacity
+         self.count = min(self.count + 1, self.capacity)
+
+
+   #########################################################
+   #
+   # Function:    window()
+   # Description: Return the latest count values of a
+   #              column (all if count is None), oldest
+   #              first, as memoryview into the buffer.
+   #              numpy.frombuffer() can be used on it.
+   #              The view is only valid until the next
+   #              append() overwrites the oldest values.
+   #
+   #########################################################
+   def window(self, column, count=None):
+      with self.lock:
+         if count == None or count > self.count:
+            count = self.count
+         end = self.head + self.capacity
+         return memoryview(self.columns[column])[end - count:end]
+
+
+   #########################################################
+   #
+   # Function:    window_since()
+   # Description: Return the values of all columns since
+   #              the given time (seconds since the epoch)
+   #              as dict of memoryviews
+   #
+   #########################################################
+   def window_since(self, since):
+      with self.lock:
+         end = self.head + self.capacity
+         start = end - self.count
+         index = bisect.bisect_left(memoryview(self.columns["timestamp"])[start:end], since)
+         return dict((name, memoryview(self.columns[name])[start + index:end]) for name,_ in COLUMNS)
@@ -0,0 +1,159 @@
+###############################################################################
+#
+#  Tests of the CNL2.4 driver against the CNL2.4 / 670G emulator
+#
+#  Description:
+#
+#    Runs PersistentSession downloads against Cnl24Emulator, so the whole
+#    protocol stack is exercised without the real hardware:
+#
+#      python -m pytest tests
+#
+#  Changes:
+#    17/10/2026: Initial version
+#
+###############################################################################
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+import cnl24driverlib
+import cnl24emulator
+from cnl24driverlib import PersistentSession, Medtronic600SeriesDriver, HistoryTransfer, HISTORY_DATA_TYPE
+
+
+def eventsOf( segments ):
+    # Raw events of the history segments, events received twice are counted once
+    events = set()
+    for segment in segments:
+        for block in Medtronic600SeriesDriver().decodePumpSegment( segment ):
+            pos = 0
+            while pos < len( block ):
+                events.add( bytes( block[pos:pos + block[pos + 2]] ) )
+                pos += block[pos + 2]
+    return events
+
+
+class EmulatorSessionTest( unittest.TestCase ):
+
+    def setUp( self ):
+        # The driver keeps its credentials in read_minimed.db in the working directory
+        self.cwd = os.getcwd()
+        self.tempDir = tempfile.mkdtemp()
+        os.chdir( self.tempDir )
+        self.addCleanup( self.restoreCwd )
+
+    def restoreCwd( self ):
+        os.chdir( self.cwd )
+        shutil.rmtree( self.tempDir, ignore_errors = True )
+
+    def openSession( self, **emulatorOptions ):
+        self.emulator = cnl24emulator.Cnl24Emulator( timeScale = 0.05, **emulatorOptions )
+        session = PersistentSession( lambda: Medtronic600SeriesDriver( deviceFactory = self.emulator.device ) )
+        self.addCleanup( session.close )
+        return session
+
+    def quietly( self, download, *args ):
+        # The downloads print their results
+        with contextlib.redirect_stdout( io.StringIO() ):
+            return download( *args )
+
+    def testLiveRead( self ):
+        session = self.openSession()
+        self.emulator.pump.status["sensorBGL"] = 142
+
+        data = self.quietly( session.readLiveData )
+
+        self.assertEqual( data["sensorBGL"], 142 )
+        self.assertEqual( data["activeBasalPattern"], 1 )
+        self.assertTrue( session.isOpen )
+        # The second read reuses the open session
+        messages = self.emulator.stats['messages']
+        self.quietly( session.readLiveData )
+        self.assertLess( self.emulator.stats['messages'] - messages, messages )
+
+    def testHistoryReadWithPacketLossAndResume( self ):
+        session = self.openSession( packetLoss = 0.05, lossSeed = 3 )
+        pump = self.emulator.pump
+        pump.history[HISTORY_DATA_TYPE.PUMP_DATA] = [ pump.bgReadingEvent( m, 100 + m % 50 ) for m in range( 1430, 0, -5 ) ]
+
+        # The connection is lost after the first segment was completed
+        checkpoint = HistoryTransfer.checkpoint
+        checkpoints = []
+        def interruptedCheckpoint( transfer, *args ):
+            checkpoint( transfer, *args )
+            checkpoints.append( transfer )
+            if len( checkpoints ) == 1:
+                raise IOError( 'USB device disconnected' )
+
+        with mock.patch.object( HistoryTransfer, 'checkpoint', interruptedCheckpoint ):
+            with self.assertRaises( IOError ):
+                self.quietly( session.readHistoryData )
+            kept = list( session.historyTransfers.values() )
+            self.assertEqual( [ len( transfer.segments ) for transfer in kept ], [ 1 ] )
+            # The emulator statistics start again with the reconnect
+            lostPackets = self.emulator.stats['lostPackets']
+            resentPackets = self.emulator.stats['resentPackets']
+
+            segments = self.quietly( session.readHistoryData )
+
+        # The second read continued the kept transfer after a reconnect
+        self.assertIs( checkpoints[-1], kept[0] )
+        self.assertEqual( eventsOf( segments ), set( pump.history[HISTORY_DATA_TYPE.PUMP_DATA] ) )
+        # Lost packets were requested again
+        self.assertGreater( lostPackets + self.emulator.stats['lostPackets'], 0 )
+        self.assertGreater( resentPackets + self.emulator.stats['resentPackets'], 0 )
+
+    def testSettingsRead( self ):
+        session = self.openSession()
+
+        settings = self.quietly( session.readSettings )
+
+        self.assertEqual( settings["deviceSerial"], self.emulator.pump.serial )
+        self.assertEqual( [ pattern["number"] for pattern in settings["basalPatterns"] ], [ 1, 2 ] )
+        self.assertEqual( [ rate["rate"] for rate in settings["basalPatterns"][0]["rates"] ], [ 0.8, 1.1, 0.9 ] )
+        self.assertEqual( [ ratio["grams"] for ratio in settings["carbRatios"] ], [ 12.0, 10.0 ] )
+        self.assertEqual( settings["sensitivityFactors"][0]["mgdl"], 50 )
+        self.assertEqual( ( settings["bgTargets"][0]["lowMgdl"], settings["bgTargets"][0]["highMgdl"] ), ( 100, 120 ) )
+        self.assertEqual( self.emulator.stats['settingsRequests'], 12 )
+
+    def testCachedCredentialsRejected( self ):
+        session = self.openSession()
+        self.quietly( session.readLiveData )
+        self.assertTrue( cnl24driverlib.Config( self.emulator.stickSerial ).key )
+        session.close()
+
+        # After a reconnect the pump messages can no longer be decrypted with the cached link key
+        decode = cnl24driverlib.MedtronicReceiveMessage.decode
+        failures = [ Medtronic600SeriesDriver.CREDENTIAL_FAILURE_LIMIT ]
+        def rejectedDecode( *args, **kwargs ):
+            if failures[0] > 0:
+                failures[0] -= 1
+                raise cnl24driverlib.ChecksumException( 'Message checksum mismatch' )
+            return decode( *args, **kwargs )
+
+        with mock.patch.object( cnl24driverlib.MedtronicReceiveMessage, 'decode', staticmethod( rejectedDecode ) ):
+            with self.assertRaises( cnl24driverlib.CredentialsRejectedException ):
+                self.quietly( session.readLiveData )
+            self.assertFalse( cnl24driverlib.Config( self.emulator.stickSerial ).key )
+            self.assertEqual( session.stage, PersistentSession.CREDENTIALS_STAGE )
+
+            # The next read requests the credentials again
+            data = self.quietly( session.readLiveData )
+
+        self.assertEqual( data["sensorBGL"], 123 )
+        config = cnl24driverlib.Config( self.emulator.stickSerial )
+        self.assertTrue( config.key )
+        self.assertEqual( config.credentialFailures, 0 )
+
+
+if __name__ == '__main__':
+    unittest.main()